@@ -0,0 +1,28 @@
+#!/bin/sh
+
+# Sweep S3 uploads and downloads against the Minio container started by
+# run.sh and report MB/s, files/s and CPU per MB.  Extra arguments are
+# passed on to "benchmark.py transfers", e.g. --sizes 1K,1M,1G,20G
+
+d=`dirname $0`
+
+set -ex
+
+ENDPOINT=http://127.0.0.1:29000
+INI=$(mktemp)
+cat >${INI} <<INIEOF
+[s3]
+enable = true
+aws_endpoint = ${ENDPOINT}
+aws_profile = minio
+INIEOF
+
+aws --endpoint-url ${ENDPOINT} --profile minio s3 mb s3://bench || true
+
+python $d/../../src/benchmark.py transfers \
+    --backends s3 \
+    --s3-ini ${INI} \
+    --s3-url s3://bench/sweep \
+    "$@"
+
+rm -f ${INI}
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+
+# Author: Ben Langmead <ben.langmead@gmail.com>
+# License: MIT
+
+"""
+amover.py
+
+An asyncio interface to Mover, so that one thread can keep many transfers
+in flight and go on with other work while they run.  AsyncMover's aexists,
+aget, aput and amulti are coroutines wrapping the Mover methods of the same
+names, and run_transfers runs a batch of them with a limit on how many are
+in flight, a timeout per transfer, and optionally cancellation of the rest
+once one fails.
+
+Every backend runs in a pool of max_threads threads.  boto3, the Globus SDK
+and download.py are all blocking libraries and release the GIL while they
+wait on the network, so this costs little next to native asyncio clients,
+which would mean new dependencies.  When a transfer's coroutine is
+cancelled or times out, the transfer is told to stop through Mover's cancel
+event: S3 and web transfers stop at their next progress report, a local
+copy stops after the file it's on, and a Globus task runs to completion in
+the background.
+
+Needs Python 3.4 or later.  The coroutines are generators (yield from)
+rather than async def, which 3.4 doesn't have; conftest.py and unit_test.sh
+leave this module out of test runs on Python 2.
+"""
+
+import types
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# types.coroutine from 3.5 on; asyncio.coroutine, gone in 3.11, before that
+coroutine = getattr(types, 'coroutine', None) or asyncio.coroutine
+ensure_future = getattr(asyncio, 'ensure_future', None) or getattr(asyncio, 'async')
+
+
+class AsyncMover(object):
+
+    def __init__(self, mover, max_threads=16):
+        self.mover = mover
+        self.executor = ThreadPoolExecutor(max_workers=max_threads)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+    @coroutine
+    def _call(self, func, *args, **kwargs):
+        cancel = threading.Event()
+        loop = asyncio.get_event_loop()
+        future = loop.run_in_executor(self.executor, functools.partial(func, *args, cancel=cancel, **kwargs))
+        try:
+            result = yield from future
+        except asyncio.CancelledError:
+            cancel.set()
+            raise
+        return result
+
+    @coroutine
+    def aexists(self, url, logger=None):
+        loop = asyncio.get_event_loop()
+        result = yield from loop.run_in_executor(self.executor,
+                                                 functools.partial(self.mover.exists, url, logger=logger))
+        return result
+
+    @coroutine
+    def aget(self, url, destination='.', logger=None, priority='normal'):
+        result = yield from self._call(self.mover.get, url, destination, logger=logger, priority=priority)
+        return result
+
+    @coroutine
+    def aput(self, source, url, logger=None, priority='high'):
+        result = yield from self._call(self.mover.put, source, url, logger=logger, priority=priority)
+        return result
+
+    @coroutine
+    def amulti(self, source, url, files, logger=None, digests=None, priority='high'):
+        result = yield from self._call(self.mover.multi, source, url, files, logger=logger, digests=digests,
+                                       priority=priority)
+        return result
+
+
+@coroutine
+def run_transfers(transfers, concurrency=8, timeout=None, fail_fast=False):
+    """
+    Run transfers, a list of zero-argument callables each returning a
+    coroutine (e.g. lambda: amover.aput(src, dst)), at most concurrency at a
+    time, so a transfer doesn't start until it has a slot.  Each gets
+    timeout seconds once started.  If fail_fast, the first failure cancels
+    the transfers still running or waiting.  Returns a list, in the same
+    order, of each transfer's result or the exception it ended with.
+    """
+    slots = asyncio.Semaphore(concurrency)
+
+    @coroutine
+    def _one(transfer):
+        yield from slots.acquire()
+        try:
+            result = yield from asyncio.wait_for(transfer(), timeout)
+        finally:
+            slots.release()
+        return result
+
+    tasks = [ensure_future(_one(transfer)) for transfer in transfers]
+    if len(tasks) == 0:
+        return []
+    if fail_fast:
+        _, pending = yield from asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        for task in pending:
+            task.cancel()
+    yield from asyncio.gather(*tasks, return_exceptions=True)
+    results = []
+    for task in tasks:
+        if task.cancelled():
+            results.append(asyncio.CancelledError())
+        elif task.exception() is not None:
+            results.append(task.exception())
+        else:
+            results.append(task.result())
+    return results
+
+
+def run_sync(coroutine):
+    """
+    Run a coroutine to completion from blocking code, e.g. run_sync(
+    run_transfers(...)) in a worker
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+class _SlowMover(object):
+    """
+    Stands in for a Mover whose gets take secs, checking cancel as a
+    progress report would
+    """
+
+    def __init__(self, secs):
+        self.secs = secs
+        self.cancelled = []
+
+    def get(self, url, destination, logger=None, priority='normal', cancel=None):
+        if cancel.wait(self.secs):
+            self.cancelled.append(url)
+            raise RuntimeError('cancelled')
+        if url == 'bad':
+            raise IOError('no such file')
+        return url
+
+
+def test_local_transfers():
+    import os
+    import shutil
+    import tempfile
+    from mover import Mover
+    src, dst = tempfile.mkdtemp(), tempfile.mkdtemp()
+    fns = ['f%d' % i for i in range(5)]
+    for fn in fns:
+        with open(os.path.join(src, fn), 'w') as fh:
+            fh.write(fn + '\n')
+    amover = AsyncMover(Mover())
+
+    @coroutine
+    def _go():
+        results = yield from run_transfers([functools.partial(amover.aput, os.path.join(src, fn),
+                                                              os.path.join(dst, fn)) for fn in fns], concurrency=2)
+        assert [None] * 5 == results
+        yield from amover.amulti(src, os.path.join(dst, 'sub'), fns)
+        exists = yield from amover.aexists(os.path.join(dst, 'sub', 'f4'))
+        return exists
+
+    assert run_sync(_go())
+    amover.close()
+    shutil.rmtree(src)
+    shutil.rmtree(dst)
+
+
+def test_timeout_and_fail_fast():
+    slow = _SlowMover(0.2)
+    amover = AsyncMover(slow)
+    results = run_sync(run_transfers([lambda: amover.aget('a', '.'),
+                                      lambda: amover.aget('b', '.')], timeout=0.05))
+    assert all(isinstance(r, asyncio.TimeoutError) for r in results)
+    results = run_sync(run_transfers([lambda: amover.aget('bad', '.'),
+                                      lambda: amover.aget('c', '.')], concurrency=1, fail_fast=True))
+    assert isinstance(results[0], IOError)
+    assert isinstance(results[1], asyncio.CancelledError)
+    amover.executor.shutdown(wait=True)
+    # timed-out transfers were told to stop; 'c' may have started too
+    assert set(['a', 'b']) <= set(slow.cancelled)
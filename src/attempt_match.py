@@ -37,9 +37,28 @@ def shorten(fn):
     return '.'.join(fn.split('.')[1:])
 
 
+def read_sums(dr):
+    """
+    Return the digests from the checksummed manifest ("<attempt>.sums")
+    written next to an attempt directory, as a dictionary mapping file name
+    to (size, md5), or None if there is no such manifest.
+    """
+    sums_fn = dr.rstrip('/') + '.sums'
+    if not os.path.exists(sums_fn):
+        return None
+    sums = {}
+    with open(sums_fn, 'rt') as fh:
+        for ln in fh:
+            name, size, digest = ln.rstrip('\n').split('\t')
+            sums[name] = (int(size), digest)
+    return sums
+
+
 def compare(dir1, dir2, ignores=None):
     """
-    Compare the output files from two attempts for the same task
+    Compare the output files from two attempts for the same task.  Where an
+    attempt has a checksummed manifest, its digests are used instead of
+    reading the files again.
     """
     if ignores is None:
         ignores = ['.*\.log', '.*\.json']
@@ -47,6 +66,7 @@ def compare(dir1, dir2, ignores=None):
     bad_summary = defaultdict(int)
     bad_list = []
     ignored = 0
+    sums1, sums2 = read_sums(dir1) or {}, read_sums(dir2) or {}
     tups1 = list(os.walk(dir1))[0]
     tups2 = list(os.walk(dir2))[0]
     if not len(tups1[1]) == 0:
@@ -71,7 +91,8 @@ def compare(dir1, dir2, ignores=None):
                 break
         if skip_outer:
             continue
-        md5_1, md5_2 = md5(full1), md5(full2)
+        md5_1 = sums1[file][1] if file in sums1 else md5(full1)
+        md5_2 = sums2[file][1] if file in sums2 else md5(full2)
         if md5_1 == md5_2:
             good_summary[shorten(file)] += 1
         else:
@@ -186,6 +207,24 @@ def test_comapre_3():
     assert 2 == ignored
 
 
+def test_compare_sums():
+    dr = tempfile.mkdtemp()
+    dir1 = os.path.join(dr, 'proj1_input1_attempt1')
+    dir2 = os.path.join(dr, 'proj1_input1_attempt2')
+    os.makedirs(dir1)
+    os.makedirs(dir2)
+    _put_both(dir1, dir2, 'test1.txt', 'hello\n')
+    _put_both(dir1, dir2, 'test2.txt', 'world\n')
+    # digests recorded at upload time are trusted over the files themselves
+    _put(dir1 + '.sums', 'test1.txt\t6\taaa\ntest2.txt\t6\tbbb\n')
+    _put(dir2 + '.sums', 'test1.txt\t6\taaa\ntest2.txt\t6\tccc\n')
+    assert {'test1.txt': (6, 'aaa'), 'test2.txt': (6, 'bbb')} == read_sums(dir1)
+    good_summary, bad_summary, bad_list, ignored = compare(dir1, dir2)
+    assert 1 == good_summary['txt']
+    assert 1 == bad_summary['txt']
+    assert ('bbb', 'ccc') == bad_list[0][2:]
+
+
 def test_sweep_1():
     dr = tempfile.mkdtemp()
     dir1 = os.path.join(dr, 'proj1_input1_attempt1')
@@ -0,0 +1,400 @@
+#!/usr/bin/env python
+
+# Author: Ben Langmead <ben.langmead@gmail.com>
+# License: MIT
+
+"""benchmark
+
+Usage:
+  benchmark supervise [options]
+  benchmark mover-setup [options]
+  benchmark transfers [options]
+
+Options:
+  --jobs <int>             Number of jobs to run [default: 20].
+  --lines <int>            Lines of output written by each job [default: 1000].
+  --probe <url>            URL to check for existence once per job, so that
+                           connection setup is counted too.
+  --s3-ini=<path>          Path to S3 ini file [default: ~/.recount/s3.ini].
+  --s3-section=<string>    Name of section in S3 ini [default: s3].
+  --globus-ini=<path>      Path to globus ini file [default: ~/.recount/globus.ini].
+  --globus-section=<str>   Name of section in globus ini file describing the
+                           application [default: recount-app].
+  --backends <list>        Comma-separated backends to sweep, from local
+                           (links), copy, web and s3 [default: local,copy,web].
+  --sizes <list>           Comma-separated file sizes, with optional K, M or G
+                           suffix [default: 1K,1M,64M,1G].
+  --counts <list>          Comma-separated numbers of files [default: 1,16].
+  --concurrency <list>     Comma-separated numbers of files in flight at
+                           once [default: 1,4].
+  --max-bytes <size>       Skip combinations moving more than this many bytes
+                           in total [default: 20G].
+  --scratch <dir>          Directory for benchmark files [default: /tmp].
+  --s3-url <url>           S3 prefix to upload to and download from, e.g.
+                           s3://bench/run1 on the MinIO container.
+  -h, --help               Show this screen.
+  --version                Show version.
+"""
+
+from __future__ import print_function
+import os
+import sys
+import time
+import shutil
+import resource
+import tempfile
+import multiprocessing
+import run
+from mover import MoverConfig, Mover, parallel_apply
+from staging import fast_copy
+from docopt import docopt
+import subprocess
+if sys.version[:1] == '2':
+    from Queue import Queue
+else:
+    from queue import Queue
+
+"""
+Micro-benchmarks for the parts of the worker that run once per job or once
+per transfer, so that changes to them can be evaluated quantitatively.  Each
+benchmark returns a dictionary of measurements and go() prints it.
+"""
+
+
+def _job_command(lines):
+    if lines == 0:
+        return 'true'
+    return 'seq 1 %d; echo COUNT_BenchComplete 1' % lines
+
+
+def bench_supervise(jobs=20, lines=1000):
+    """
+    Measure the per-job overhead of run.supervise, i.e. the time beyond what
+    it takes to simply run the same command with its output discarded.
+    """
+    cmd = _job_command(lines)
+    devnull = open(os.devnull, 'w')
+    base_secs = 0.0
+    for _ in range(jobs):
+        t0 = time.time()
+        subprocess.call(cmd, shell=True, stdout=devnull, stderr=devnull)
+        base_secs += time.time() - t0
+    devnull.close()
+    queue = Queue()
+    heartbeats = []
+    sup_secs = 0.0
+    for _ in range(jobs):
+        t0 = time.time()
+        ret = run.supervise(cmd, 'node', 'worker', queue, heartbeats.append)
+        sup_secs += time.time() - t0
+        assert 0 == ret
+    puts, relayed = 0, 0
+    while not queue.empty():
+        msgs, _ = queue.get()
+        if isinstance(msgs, list):  # skip the worker's own log messages
+            puts += 1
+            relayed += len(msgs)
+    return {'jobs': jobs,
+            'lines_per_job': lines,
+            'base_secs_per_job': base_secs / jobs,
+            'supervise_secs_per_job': sup_secs / jobs,
+            'overhead_secs_per_job': (sup_secs - base_secs) / jobs,
+            'lines_relayed': relayed,
+            'queue_puts': puts,
+            'heartbeats': len(heartbeats)}
+
+
+def bench_mover_setup(mover_config, jobs=20, probe=None):
+    """
+    Measure the per-job cost of getting a mover (and, given a probe URL,
+    making one request with it) when each job makes its own, versus when
+    jobs share the process's pooled mover.
+    """
+    def _job(mover):
+        if probe is not None:
+            mover.exists(probe)
+
+    fresh_secs = 0.0
+    for _ in range(jobs):
+        t0 = time.time()
+        mover = mover_config.new_mover()
+        _job(mover)
+        mover.close()
+        fresh_secs += time.time() - t0
+    mover_config.discard_pooled_mover()
+    pooled_secs = 0.0
+    pooled_movers = []
+    for _ in range(jobs):
+        t0 = time.time()
+        mover = mover_config.pooled_mover()
+        _job(mover)
+        pooled_secs += time.time() - t0
+        if not any(mover is m for m in pooled_movers):
+            pooled_movers.append(mover)
+    mover_config.discard_pooled_mover()
+    return {'jobs': jobs,
+            's3': mover_config.enable_s3,
+            'globus': mover_config.enable_globus,
+            'probe': str(probe),
+            'fresh_movers': jobs,
+            'pooled_movers': len(pooled_movers),
+            'fresh_secs_per_job': fresh_secs / jobs,
+            'pooled_secs_per_job': pooled_secs / jobs,
+            'saved_secs_per_job': (fresh_secs - pooled_secs) / jobs}
+
+
+def parse_size(st):
+    """
+    Parse a size like 512, 4K, 64M or 20G into bytes
+    """
+    st = st.strip().upper()
+    mult = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    if len(st) > 0 and st[-1] in mult:
+        return int(float(st[:-1]) * mult[st[-1]])
+    return int(st)
+
+
+def _cpu_secs():
+    ru = resource.getrusage(resource.RUSAGE_SELF)
+    return ru.ru_utime + ru.ru_stime
+
+
+def _make_files(dr, size, count):
+    """
+    Write count files of size bytes to dr.  Contents are random so that
+    nothing along the way can compress them, but one random block is
+    repeated so that making a 20 GB file isn't itself the bottleneck.
+    """
+    block = os.urandom(min(size, 1024 * 1024))
+    fns = []
+    for i in range(count):
+        fn = 'f%d.bin' % i
+        with open(os.path.join(dr, fn), 'wb') as fh:
+            left = size
+            while left > 0:
+                fh.write(block[:min(left, len(block))])
+                left -= len(block)
+        fns.append(fn)
+    return fns
+
+
+def _serve_dir(dr, port_queue):
+    """
+    Serve files in dr over HTTP, honoring single byte ranges, until killed.
+    Runs in its own process so its CPU isn't charged to the mover.
+    """
+    if sys.version[:1] == '2':
+        from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+        from SocketServer import ThreadingMixIn
+    else:
+        from http.server import HTTPServer, BaseHTTPRequestHandler
+        from socketserver import ThreadingMixIn
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            fn = os.path.normpath(os.path.join(dr, self.path.lstrip('/')))
+            if not fn.startswith(dr) or not os.path.isfile(fn):
+                self.send_error(404)
+                return
+            size = os.path.getsize(fn)
+            start, end = 0, size
+            rng = self.headers.get('Range')
+            if rng is not None:
+                a, b = rng.split('=')[1].split('-')
+                start, end = int(a), (size if b == '' else min(size, int(b) + 1))
+                self.send_response(206)
+                self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end - 1, size))
+            else:
+                self.send_response(200)
+            self.send_header('Content-Length', str(end - start))
+            self.end_headers()
+            with open(fn, 'rb') as fh:
+                fh.seek(start)
+                left = end - start
+                while left > 0:
+                    buf = fh.read(min(left, 1024 * 1024))
+                    if not buf:
+                        break
+                    self.wfile.write(buf)
+                    left -= len(buf)
+
+    class Server(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    server = Server(('127.0.0.1', 0), Handler)
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+def _timed(func):
+    cpu0, t0 = _cpu_secs(), time.time()
+    func()
+    return time.time() - t0, _cpu_secs() - cpu0
+
+
+def bench_transfers(backends=('local', 'copy', 'web'), sizes=(1024, 1024 ** 2), counts=(1, 16), concurrency=(1, 4),
+                    scratch=None, s3_url=None, mover_config=None, max_bytes=20 * 1024 ** 3):
+    """
+    Time moving count files of each size with each backend, with the given
+    numbers of files in flight: local multi-puts (Mover.multi), kernel
+    copies (staging.fast_copy), web gets
+    from a local HTTP server (WebMover, via download.py), and S3 multi-puts
+    then gets against s3_url (e.g. the MinIO container).  Returns one row
+    per combination with MB/s, files/s and CPU seconds per MB, where CPU is
+    this process's, i.e. the mover's, not the server's.
+    """
+    rows = []
+    http_server, port = None, None
+    scratch = os.path.abspath(scratch or tempfile.gettempdir())
+    for size in sizes:
+        for count in counts:
+            if size * count > max_bytes:
+                continue
+            tmpdir = tempfile.mkdtemp(dir=scratch)
+            src = os.path.join(tmpdir, 'src')
+            os.makedirs(src)
+            fns = _make_files(src, size, count)
+            if 'web' in backends and http_server is None:
+                port_queue = multiprocessing.Queue()
+                http_server = multiprocessing.Process(target=_serve_dir, args=(scratch, port_queue))
+                http_server.daemon = True
+                http_server.start()
+                port = port_queue.get(timeout=30)
+            for conc in concurrency:
+                trials = []
+                for backend in backends:
+                    dst = os.path.join(tmpdir, 'dst_%s_%d' % (backend, conc))
+                    os.makedirs(dst)
+                    if backend == 'local':
+                        # links, since src and dst share a filesystem
+                        mover = Mover(local_concurrency=conc)
+                        trials.append(('local', 'multi', _timed(lambda: mover.multi(src, dst, fns))))
+                    elif backend == 'copy':
+                        # the kernel copy that local transfers fall back
+                        # to across filesystems
+                        def _copy():
+                            parallel_apply(lambda fn: fast_copy(os.path.join(src, fn), os.path.join(dst, fn)),
+                                           fns, conc)
+
+                        trials.append(('copy', 'copy', _timed(_copy)))
+                    elif backend == 'web':
+                        mover = Mover(enable_web=True)
+                        base = 'http://127.0.0.1:%d/%s/' % (port, os.path.basename(tmpdir))
+
+                        def _web():
+                            parallel_apply(lambda fn: mover.get(base + 'src/' + fn, os.path.join(dst, fn)), fns, conc)
+
+                        trials.append(('web', 'get', _timed(_web)))
+                    elif backend == 's3':
+                        if s3_url is None or mover_config is None:
+                            raise RuntimeError('s3 backend needs an S3 URL and configuration')
+                        transfer = dict(mover_config.s3_transfer)
+                        transfer['file_concurrency'] = conc
+                        mover = Mover(profile=mover_config.aws_profile, endpoint_url=mover_config.aws_endpoint_url,
+                                      enable_s3=True, s3_transfer=transfer)
+                        prefix = '%s/%d_%d_%d/' % (s3_url.rstrip('/'), size, count, conc)
+                        trials.append(('s3', 'multi', _timed(lambda: mover.multi(src, prefix, fns))))
+
+                        def _s3_get():
+                            parallel_apply(lambda fn: mover.get(prefix + fn, os.path.join(dst, fn)), fns, conc)
+
+                        trials.append(('s3', 'get', _timed(_s3_get)))
+                        for fn in fns:
+                            mover.s3_mover.remove(prefix + fn)
+                    shutil.rmtree(dst)
+                for backend, op, (secs, cpu) in trials:
+                    mb = size * count / (1024.0 * 1024.0)
+                    rows.append({'backend': backend, 'op': op, 'size': size, 'count': count,
+                                 'concurrency': conc, 'secs': secs,
+                                 'mb_per_sec': mb / secs if secs > 0 else 0.0,
+                                 'files_per_sec': count / secs if secs > 0 else 0.0,
+                                 'cpu_secs_per_mb': cpu / mb if mb > 0 else 0.0})
+            shutil.rmtree(tmpdir)
+    if http_server is not None:
+        http_server.terminate()
+        http_server.join()
+    return rows
+
+
+TRANSFER_COLUMNS = ['backend', 'op', 'size', 'count', 'concurrency', 'secs', 'mb_per_sec',
+                    'files_per_sec', 'cpu_secs_per_mb']
+
+
+def report_rows(rows, columns):
+    print('\t'.join(columns))
+    for row in rows:
+        print('\t'.join(('%0.4f' % row[c]) if isinstance(row[c], float) else str(row[c]) for c in columns))
+
+
+def report(results):
+    width = max(map(len, results.keys()))
+    for k in sorted(results.keys()):
+        v = results[k]
+        if isinstance(v, float):
+            print('%s  %0.4f' % (k.ljust(width), v))
+        else:
+            print('%s  %s' % (k.ljust(width), str(v)))
+
+
+def test_bench_supervise():
+    results = bench_supervise(jobs=2, lines=100)
+    assert 2 * 101 == results['lines_relayed']
+    assert results['queue_puts'] <= results['lines_relayed']
+    assert 2 == results['heartbeats']
+    # far less than the old 5-second polling interval
+    assert results['overhead_secs_per_job'] < 1.0
+
+
+def test_bench_mover_setup():
+    config = MoverConfig()
+    config.enable_s3 = True  # session and client setup needs no network
+    results = bench_mover_setup(config, jobs=3)
+    # every pooled job got the same mover
+    assert (3, 1) == (results['fresh_movers'], results['pooled_movers'])
+
+
+def test_parse_size():
+    assert 512 == parse_size('512')
+    assert 4096 == parse_size('4K')
+    assert 20 * 1024 ** 3 == parse_size('20g')
+
+
+def test_bench_transfers():
+    rows = bench_transfers(sizes=[1024, 100 * 1024], counts=[1, 3], concurrency=[1, 2], max_bytes=200 * 1024)
+    # (100K, 3) is over max_bytes, leaving 3 (size, count) pairs
+    assert 3 * 2 * 3 == len(rows)
+    assert set(['local', 'copy', 'web']) == set(r['backend'] for r in rows)
+    assert all(r['mb_per_sec'] > 0 for r in rows)
+
+
+def go():
+    args = docopt(__doc__)
+    if args['supervise']:
+        report(bench_supervise(jobs=int(args['--jobs']), lines=int(args['--lines'])))
+    if args['mover-setup']:
+        mover_config = MoverConfig(
+            s3_ini=os.path.expanduser(args['--s3-ini']),
+            s3_section=args['--s3-section'],
+            globus_ini=os.path.expanduser(args['--globus-ini']),
+            globus_section=args['--globus-section'],
+            enable_web=True)
+        report(bench_mover_setup(mover_config, jobs=int(args['--jobs']), probe=args['--probe']))
+    if args['transfers']:
+        mover_config = MoverConfig(
+            s3_ini=os.path.expanduser(args['--s3-ini']),
+            s3_section=args['--s3-section'])
+        rows = bench_transfers(backends=args['--backends'].split(','),
+                               sizes=[parse_size(x) for x in args['--sizes'].split(',')],
+                               counts=[int(x) for x in args['--counts'].split(',')],
+                               concurrency=[int(x) for x in args['--concurrency'].split(',')],
+                               scratch=os.path.expanduser(args['--scratch']),
+                               s3_url=args['--s3-url'], mover_config=mover_config,
+                               max_bytes=parse_size(args['--max-bytes']))
+        report_rows(rows, TRANSFER_COLUMNS)
+
+
+if __name__ == '__main__':
+    go()
@@ -6,9 +6,9 @@
 """cluster
 
 Usage:
-  cluster prepare [options] <project-id>
-  cluster run [options] <project-id>
-  cluster cleanup [options] <project-id>
+  cluster prepare [options] <project-id>...
+  cluster run [options] <project-id>...
+  cluster cleanup [options] <project-id>...
 
 Options:
   --cluster-ini <ini>          Cluster ini file [default: ~/.recount/cluster.ini].
@@ -24,6 +24,9 @@ Options:
   --max-job-fail <int>         Maximum # consecutive job failures before quitting [default: 6].
   --poll-seconds <int>         Seconds to wait before re-polling after failed poll [default: 5].
   --sysmon-interval <int>      Seconds between sysmon updated; 0 disables [default: 5]
+  --affinity-idle <int>        When running several projects, seconds a worker
+                               stays idle before taking jobs whose reference
+                               is not already warm; 0 disables [default: 0].
   --s3-ini=<path>              Path to S3 ini file [default: ~/.recount/s3.ini].
   --s3-section=<string>        Name pf section in S3 ini [default: s3].
   --globus-ini=<path>          Path to globus ini file [default: ~/.recount/globus.ini].
@@ -48,6 +51,12 @@ import tempfile
 import shutil
 import pytest
 import run
+import stats
+import scratch
+import staging
+import governor
+import transfers
+import instance
 import subprocess
 import boto3
 import multiprocessing
@@ -61,14 +70,16 @@ from resmon import SysmonThread
 from datetime import datetime
 from docopt import docopt
 from toolbox import engine_from_config, session_maker_from_config, parse_queue_config, md5
+from base import Base
 from analysis import Analysis, add_analysis
 from input import Input, import_input_set
-from pump import Project, TaskAttempt, TaskFailure, TaskSuccess, add_project
+from pump import Project, TaskAttempt, TaskFailure, TaskSuccess, add_project, add_job_metrics
 from reference import Reference, SourceSet, AnnotationSet, add_reference, add_source_set, \
     add_annotation_set, add_sources_to_set, add_annotations_to_set, add_source, add_annotation
 from sqlalchemy import func
 from sqlalchemy.orm import Session
-from mover import Mover, MoverConfig, CommandThread
+from mover import Mover, MoverConfig, CommandThread, Url
+from globus_batch import GlobusBatcher
 if sys.version[:1] == '2':
     from ConfigParser import RawConfigParser
 else:
@@ -260,11 +271,13 @@ def do_job(body, proj, cluster_ini, my_attempt, node_name,
            worker_name, session, heartbeat_func,
            mover_config=None, destination=None, source_prefix=None,
            shared_log_queue=log_queue, keep=False,
-           singularity_suffix='.sif'):
+           singularity_suffix='.sif', footprint=None, batch_ticket=None):
     """
     Given a job-attempt description string, parse the string and execute the
     corresponding job attempt.  The description string itself is composed in
-    pump.py.
+    pump.py.  footprint is the job's predicted disk usage, if any.
+    batch_ticket is handed to the Globus batcher with the job's outputs, if
+    they go that way (see BatchedJobs).
     """
     name, system, analysis_dir, _, _, _, _ = read_cluster_config(cluster_ini)
     assert analysis_dir is not None
@@ -302,18 +315,45 @@ def do_job(body, proj, cluster_ini, my_attempt, node_name,
     attempt_name = '%s%d_in%d_att%d' % (task.proj_name, task.proj_id, task.input_id, my_attempt)
     mover = None
     if mover_config is not None:
-        mover = mover_config.new_mover()
+        mover = mover_config.pooled_mover()
     log_info_detailed(node_name, worker_name, 'Starting attempt "%s"' % attempt_name, shared_log_queue=shared_log_queue)
     partitioned_destination = destination
     if destination is not None:
         for partition_id in task.partition_id():
             partitioned_destination = os.path.join(partitioned_destination, partition_id)
+
+    def _metrics_func(job_metrics):
+        n = add_job_metrics(task.proj_id, task.input_id, attempt_name, job_metrics,
+                            datetime.utcnow(), session)
+        log_info_detailed(node_name, worker_name, 'recorded %d metrics' % n, shared_log_queue=shared_log_queue)
+
+    def _runtime_func(runtimes, input_bases):
+        n = stats.add_rule_runtimes(session, runtimes, datetime.utcnow(), input_bases=input_bases,
+                                    project_id=task.proj_id, input_id=task.input_id,
+                                    attempt_name=attempt_name, node_name=node_name,
+                                    node_type=stats.node_type(), cluster_name=name,
+                                    reference=task.reference_name,
+                                    workflow_version=stats.workflow_version(image_url))
+        log_info_detailed(node_name, worker_name, 'recorded %d rule runtimes' % n, shared_log_queue=shared_log_queue)
+
+    def _footprint_func(peaks, input_bases, succeeded):
+        stats.add_job_footprint(session, peaks, datetime.utcnow(), succeeded, input_bases=input_bases,
+                                project_id=task.proj_id, input_id=task.input_id,
+                                attempt_name=attempt_name, node_name=node_name)
+
     ret = run.run_job(attempt_name, [tmp_fn], image_url, image_fn,
                       config, cluster_ini, heartbeat_func,
                       log_queue=shared_log_queue, node_name=node_name,
                       worker_name=worker_name,
                       mover=mover, destination=partitioned_destination,
-                      source_prefix=source_prefix, keep=keep)
+                      source_prefix=source_prefix, keep=keep,
+                      metrics_func=_metrics_func,
+                      runtime_func=_runtime_func,
+                      footprint=footprint,
+                      footprint_func=_footprint_func,
+                      globus_batch_queue=None if mover_config is None else mover_config.globus_batch_queue,
+                      globus_batch_pid=None if mover_config is None else mover_config.globus_batch_pid,
+                      globus_batch_ticket=batch_ticket)
     return ret
 
 
@@ -328,7 +368,7 @@ def download_image(url, cluster_name, analysis_dir, mover):
         if not os.path.isdir(analysis_dir):
             raise RuntimeError('"%s" exists but is not a directory' % analysis_dir)
     image_fn = os.path.join(analysis_dir, image_bn)
-    mover.get(url, image_fn)
+    mover.get(url, image_fn, priority='low')
 
 
 def _remove_ext(fn):
@@ -353,12 +393,54 @@ def _download_file(mover, url, typ, cluster_name, reference_dir):
         raise RuntimeError('Local %s file "%s" already exists' % (typ, local_fn))
     log.info('Downloading "%s" to cluster "%s" directory "%s"' %
              (url, cluster_name, reference_dir))
-    mover.get(url, local_fn)
-    if base.endswith('.tar.gz') or base.endswith('.tgz'):
-        cmd = 'tar -C %s -xzf %s' % (local_genome_dir, local_fn)
-        ret = os.system(cmd)
+    is_tarball = base.endswith('.tar.gz') or base.endswith('.tgz')
+    if is_tarball and not Url(url).is_globus:
+        _stream_untar(mover, url, local_genome_dir)
+        return
+    mover.get(url, local_fn, priority='low')
+    if is_tarball:
+        _untar(['tar', '-xzf', local_fn], None, url, local_genome_dir)
+
+
+def _stream_untar(mover, url, dest_dir):
+    """
+    Untar a .tar.gz as it downloads, so it's decompressed and unpacked in
+    the same pass and the tarball never lands on disk
+    """
+    _untar(['tar', '-xzf', '-'], mover.open_stream(url, priority='low'), url, dest_dir)
+
+
+def _untar(cmd, stream, url, dest_dir):
+    """
+    Run the tar command cmd in a temporary directory under dest_dir, feeding
+    it the chunks from stream if given, and move what it unpacked into
+    dest_dir only if it succeeded.  ready_reference takes any directory of
+    the right name as ready, so a failed or partial extract must not leave
+    anything there; the temporary directory is removed either way.
+    """
+    tmp_dir = tempfile.mkdtemp(prefix='.untar.', dir=dest_dir)
+    try:
+        cmd = cmd[:1] + ['-C', tmp_dir] + cmd[1:]
+        proc = subprocess.Popen(cmd, stdin=None if stream is None else subprocess.PIPE)
+        if stream is not None:
+            try:
+                for buf in stream:
+                    proc.stdin.write(buf)
+                proc.stdin.close()
+            except Exception:
+                proc.kill()
+                proc.wait()
+                raise
+        ret = proc.wait()
         if ret != 0:
-            raise RuntimeError('Error running "%s"' % cmd)
+            raise RuntimeError('Error running "%s" on "%s"' % (' '.join(cmd), url))
+        for fn in os.listdir(tmp_dir):
+            dest_fn = os.path.join(dest_dir, fn)
+            if os.path.exists(dest_fn):
+                raise RuntimeError('"%s" from "%s" already exists' % (dest_fn, url))
+            os.rename(os.path.join(tmp_dir, fn), dest_fn)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
 
 
 def download_reference(reference, cluster_name, reference_dir, session, mover):
@@ -588,7 +670,8 @@ def get_num_successes(job, session):
 
 def do_job_wrapper(msg, handle, session, proj, node_name, worker_name, 
                    visibility_timeout, q_client, q_url, cluster_ini, 
-                   mover_config, destination, source_prefix, shared_log_queue=log_queue, keep=False):
+                   mover_config, destination, source_prefix, shared_log_queue=log_queue, keep=False,
+                   footprint=None):
     body = msg['Body']
     job = Task(body, proj)
     nattempts = get_num_attempts(job, session)
@@ -613,29 +696,162 @@ def do_job_wrapper(msg, handle, session, proj, node_name, worker_name,
             log_warn_detailed(node_name, worker_name,
                               'Exception during heartbeat (%s): %s' % (st, str(exc)), shared_log_queue=shared_log_queue)
 
+    # lets the Globus batcher finish the job, if it's handed one
+    batch_ticket = {'q_url': q_url, 'handle': handle, 'visibility_timeout': visibility_timeout,
+                    'proj_id': job.proj_id, 'input_id': job.input_id,
+                    'node_name': node_name, 'worker_name': worker_name}
     try:
         succeeded = do_job(body, proj, cluster_ini, my_attempt, node_name,
                            worker_name, session, heartbeat_func,
                            mover_config=mover_config,
                            destination=destination,
-                           source_prefix=source_prefix, shared_log_queue=shared_log_queue, keep=keep)
+                           source_prefix=source_prefix, shared_log_queue=shared_log_queue, keep=keep,
+                           footprint=footprint, batch_ticket=batch_ticket)
     except BaseException as e:
         log_warning_detailed(node_name, worker_name,
                              'job attempt %d yielded exception: %s\n%s'
                              % (nattempts, str(e), traceback.format_exc()), shared_log_queue=shared_log_queue)
 
     if not succeeded:
+        if mover_config is not None:
+            mover_config.discard_pooled_mover()
         log_failure(job, node_name, worker_name, session)
         log_info_detailed(node_name, worker_name, 'job failure', shared_log_queue=shared_log_queue)
         #raise BaseException('job attempt %d failed' % (nattempts))
         return False
+    if succeeded == run.DEFERRED:
+        log_info_detailed(node_name, worker_name, 'job handed to Globus batcher, which will record its outcome',
+                          shared_log_queue=shared_log_queue)
+        return succeeded
     log_success(job, node_name, worker_name, session)
     return succeeded
 
 
+class _TicketJob(object):
+    def __init__(self, ticket):
+        self.proj_id = ticket['proj_id']
+        self.input_id = ticket['input_id']
+
+
+class BatchedJobs(object):
+    """
+    Finishes the jobs handed to the node's GlobusBatcher, from the parent
+    process.  While a job's transfers run, heartbeat keeps its queue message
+    invisible.  Once the job is published, its message is deleted and its
+    success recorded.  If the batcher abandons it, its failure is recorded
+    and the message is made visible again so another worker retries it.
+    """
+
+    def __init__(self, q_ini, engine):
+        aws_profile, region, endpoint, _, _, _, _ = parse_queue_config(q_ini)
+        self.q_client = boto3.session.Session(profile_name=aws_profile).client('sqs', endpoint_url=endpoint,
+                                                                               region_name=region)
+        self.engine = engine
+        self.session = None
+
+    def _session(self):
+        if self.session is None:
+            self.session = db_connect_wrapper(self.engine)
+        return self.session
+
+    def heartbeat(self, job):
+        ticket = job['ticket']
+        if ticket is not None:
+            self.q_client.change_message_visibility(QueueUrl=ticket['q_url'], ReceiptHandle=ticket['handle'],
+                                                    VisibilityTimeout=ticket['visibility_timeout'])
+
+    def published(self, job):
+        ticket = job['ticket']
+        if ticket is None:
+            return
+        log_success(_TicketJob(ticket), ticket['node_name'], ticket['worker_name'], self._session())
+        self.q_client.delete_message(QueueUrl=ticket['q_url'], ReceiptHandle=ticket['handle'])
+        log.info('%s published; deleted its message' % job['name'], 'cluster.py')
+
+    def abandoned(self, job):
+        ticket = job['ticket']
+        if ticket is None:
+            return
+        log_failure(_TicketJob(ticket), ticket['node_name'], ticket['worker_name'], self._session())
+        self.q_client.change_message_visibility(QueueUrl=ticket['q_url'], ReceiptHandle=ticket['handle'],
+                                                VisibilityTimeout=0)
+        log.warning('%s abandoned by Globus batcher; released its message for a retry' % job['name'], 'cluster.py')
+
+
+def predict_footprint(msg, proj, session):
+    """
+    Predict a queued job's peak disk usage from earlier jobs in its project,
+    using its input's size if an earlier attempt measured it
+    """
+    task = Task(msg['Body'], proj)
+    model = scratch.FootprintModel(stats.footprint_history(session, project_id=task.proj_id))
+    return model.predict(stats.known_input_bases(session, task.input_id))
+
+
+def queues_to_poll(queues, warm_references, idle_seconds, affinity_idle):
+    """
+    Given a list of (queue url, project, reference name) tuples, return the
+    ones to poll this time around the job loop.  Queues whose reference is
+    warm on this worker come first, most recently used reference first
+    (warm_references is kept in that order; see use_reference).  Queues for
+    other references are only
+    polled once the worker has been idle for at least affinity_idle seconds,
+    or when nothing is warm yet.  An affinity_idle of 0 disables the
+    preference and polls every queue.
+    """
+    if affinity_idle <= 0 or len(warm_references) == 0:
+        return list(queues)
+    warm = sorted([q for q in queues if q[2] in warm_references], key=lambda q: warm_references.index(q[2]))
+    if idle_seconds < affinity_idle:
+        return warm
+    return warm + [q for q in queues if q[2] not in warm_references]
+
+
+def use_reference(warm_references, reference_name, max_warm):
+    """
+    Move reference_name to the front of warm_references, a most recently
+    used list, and forget the least recently used references beyond the
+    first max_warm, as their files will have left the cache by now.
+    """
+    if reference_name in warm_references:
+        warm_references.remove(reference_name)
+    warm_references.insert(0, reference_name)
+    del warm_references[max_warm:]
+
+
+def read_max_warm_references(cluster_fn, warm_references, section=None):
+    """
+    Return how many references a worker should consider warm at once: the
+    cluster.ini's max_warm_references if set, or else as many as it lists
+    in warm_references.  Always at least 1.
+    """
+    cfg = RawConfigParser()
+    cfg.read(cluster_fn)
+    if section is None:
+        section = cfg.sections()[0]
+    if cfg.has_option(section, 'max_warm_references'):
+        return max(1, int(cfg.get(section, 'max_warm_references')))
+    return max(1, len(warm_references))
+
+
+def read_warm_references(cluster_fn, section=None):
+    """
+    Return the list of reference names that the cluster.ini file says are
+    already warm (e.g. pre-loaded in shared memory) on this cluster's nodes.
+    """
+    cfg = RawConfigParser()
+    cfg.read(cluster_fn)
+    if section is None:
+        section = cfg.sections()[0]
+    if not cfg.has_option(section, 'warm_references'):
+        return []
+    return [x.strip() for x in cfg.get(section, 'warm_references').split(',') if len(x.strip()) > 0]
+
+
 def job_loop(shared_log_queue, project_id_or_name, q_ini, cluster_ini, worker_name, session,
              max_fails=10, sleep_seconds=10,
-             mover_config=None, destination=None, source_prefix=None, max_job_fails=MAX_JOB_FAILS, keep=False):
+             mover_config=None, destination=None, source_prefix=None, max_job_fails=MAX_JOB_FAILS, keep=False,
+             affinity_idle=0):
     log_info_detailed('', worker_name, 'Getting node name', shared_log_queue=shared_log_queue)
     node_name = socket.gethostname().split('.', 1)[0]
     log_info_detailed(node_name, worker_name, 'Getting queue client', shared_log_queue=shared_log_queue)
@@ -644,22 +860,45 @@ def job_loop(shared_log_queue, project_id_or_name, q_ini, cluster_ini, worker_na
     q_client = boto3_session.client('sqs',
                                     endpoint_url=endpoint,
                                     region_name=region)
-    log_info_detailed(node_name, worker_name, 'Getting project', shared_log_queue=shared_log_queue)
-    proj = proj_from_id_or_name(project_id_or_name, session)
-    log_info_detailed(node_name, worker_name, 'Getting queue', shared_log_queue=shared_log_queue)
-    q_name = proj.queue_name()
-    resp = q_client.create_queue(QueueName=q_name)
-    q_url = resp['QueueUrl']
+    project_ids = project_id_or_name
+    if not isinstance(project_ids, list):
+        project_ids = [project_ids]
+    queues = []
+    for project_id in project_ids:
+        log_info_detailed(node_name, worker_name, 'Getting project %s' % str(project_id), shared_log_queue=shared_log_queue)
+        proj = proj_from_id_or_name(project_id, session)
+        reference_name = session.query(Reference).get(proj.reference_id).name
+        log_info_detailed(node_name, worker_name, 'Getting queue', shared_log_queue=shared_log_queue)
+        resp = q_client.create_queue(QueueName=proj.queue_name())
+        queues.append((resp['QueueUrl'], proj, reference_name))
+    warm_references = read_warm_references(cluster_ini)
+    max_warm = read_max_warm_references(cluster_ini, warm_references)
+    warm_references = warm_references[:max_warm]
+    cfg = RawConfigParser()
+    cfg.read(cluster_ini)
+    section = cfg.sections()[0]
+    admission = cfg.has_option(section, 'footprint_admission') and \
+        cfg.get(section, 'footprint_admission').lower() == 'true'
+    temp_roots, temp_big_roots, output_base = scratch.job_roots(cfg, section)
     only_delete_on_success = True
     attempt, success, fail = 0, 0, 0
     num_job_fails = 0
-    log_info_detailed(node_name, worker_name, 'Entering job loop, queue "%s"' % q_name, shared_log_queue=shared_log_queue)
+    last_job_time = time.time()
+    log_info_detailed(node_name, worker_name, 'Entering job loop, queues %s, warm references %s' %
+                      (str([q[1].queue_name() for q in queues]), str(warm_references)),
+                      shared_log_queue=shared_log_queue)
     while True:
         attempt += 1
         log_info_detailed(node_name, worker_name, 'Top of job loop, iteration %d' % attempt, shared_log_queue=shared_log_queue)
-        msg_set = q_client.receive_message(QueueUrl=q_url)
+        to_poll = queues_to_poll(queues, warm_references, time.time() - last_job_time, affinity_idle)
+        msg_set, q_url, proj, reference_name = {}, None, None, None
+        for q_url, proj, reference_name in to_poll:
+            msg_set = q_client.receive_message(QueueUrl=q_url)
+            if 'Messages' in msg_set:
+                break
         if 'Messages' not in msg_set:
-            fail += 1
+            if len(to_poll) == len(queues):
+                fail += 1
             if fail >= max_fails:
                 log_info_detailed(node_name, worker_name, 'exit job loop after %d poll failures' % fail, shared_log_queue=shared_log_queue)
                 break
@@ -667,10 +906,33 @@ def job_loop(shared_log_queue, project_id_or_name, q_ini, cluster_ini, worker_na
         else:
             for msg in msg_set.get('Messages', []):
                 handle = msg['ReceiptHandle']
-                succeeded = do_job_wrapper(msg, handle, session, proj, node_name, worker_name, 
-                                            visibility_timeout, q_client, q_url, cluster_ini, 
-                                            mover_config, destination, source_prefix, shared_log_queue=shared_log_queue, keep=keep)
-                if succeeded or not only_delete_on_success:
+                footprint = None
+                if admission:
+                    footprint = predict_footprint(msg, proj, session)
+                    ok, reason = scratch.fits(footprint, temp_roots, temp_big_roots, output_base)
+                    if not ok:
+                        # hand the job back for a node with more room, and
+                        # give our own disks time to drain
+                        log_warning_detailed(node_name, worker_name, 'Releasing job for lack of space: ' + reason,
+                                             shared_log_queue=shared_log_queue)
+                        log_info('COUNT_JobReleasedForSpace 1', shared_log_queue)
+                        q_client.change_message_visibility(QueueUrl=q_url, ReceiptHandle=handle,
+                                                           VisibilityTimeout=0)
+                        time.sleep(sleep_seconds)
+                        continue
+                    log_info_detailed(node_name, worker_name, 'predicted footprint: ' +
+                                      ', '.join('%s=%s' % (k, str(v)) for k, v in sorted(footprint.items())),
+                                      shared_log_queue=shared_log_queue)
+                succeeded = do_job_wrapper(msg, handle, session, proj, node_name, worker_name,
+                                            visibility_timeout, q_client, q_url, cluster_ini,
+                                            mover_config, destination, source_prefix, shared_log_queue=shared_log_queue, keep=keep,
+                                            footprint=footprint)
+                last_job_time = time.time()
+                use_reference(warm_references, reference_name, max_warm)
+                if succeeded == run.DEFERRED:
+                    log_info_detailed(node_name, worker_name, 'Leaving %s for the Globus batcher to delete' % handle,
+                                      shared_log_queue=shared_log_queue)
+                elif succeeded or not only_delete_on_success:
                     log_info_detailed(node_name, worker_name, 'Deleting ' + handle, shared_log_queue=shared_log_queue)
                     q_client.delete_message(QueueUrl=q_url, ReceiptHandle=handle)
                 if succeeded:
@@ -791,6 +1053,30 @@ def test_download_file():
     shutil.rmtree(dstdir)
 
 
+def test_stream_untar_failure():
+    srcdir, dstdir = tempfile.mkdtemp(), tempfile.mkdtemp()
+    os.makedirs(os.path.join(srcdir, 'files'))
+    with open(os.path.join(srcdir, 'files', 'big'), 'wb') as fh:
+        fh.write(os.urandom(1024 * 1024))
+    assert 0 == os.system('cd %s && tar -czf file.tar.gz files' % srcdir)
+    with open(os.path.join(srcdir, 'file.tar.gz'), 'rb') as fh:
+        payload = fh.read()
+
+    class _BrokenMover(object):
+        def open_stream(self, url, priority='normal'):
+            yield payload[:len(payload) // 2]
+            raise IOError('connection reset')
+
+    with pytest.raises(IOError):
+        _stream_untar(_BrokenMover(), 'http://example.org/file.tar.gz', dstdir)
+    assert [] == os.listdir(dstdir)  # nothing half-extracted left behind
+    _stream_untar(Mover(), os.path.join(srcdir, 'file.tar.gz'), dstdir)
+    assert ['files'] == os.listdir(dstdir)
+    assert os.path.getsize(os.path.join(dstdir, 'files', 'big')) == 1024 * 1024
+    shutil.rmtree(srcdir)
+    shutil.rmtree(dstdir)
+
+
 def test_integration(db_integration):
     if not db_integration:
         pytest.skip('db integration testing disabled')
@@ -863,6 +1149,59 @@ def test_with_db(session):
     assert os.path.exists(os.path.join(reference_dir, 'ce10', 'annotation1.txt'))
 
 
+def test_queues_to_poll_1():
+    queues = [('q1', None, 'hg38'), ('q2', None, 'grcm38'), ('q3', None, 'hg38')]
+    assert queues == queues_to_poll(queues, ['hg38'], 0, 0)
+    assert queues == queues_to_poll(queues, [], 0, 600)
+    assert [queues[0], queues[2]] == queues_to_poll(queues, ['hg38'], 10, 600)
+    assert [queues[1]] == queues_to_poll(queues, ['grcm38'], 10, 600)
+
+
+def test_queues_to_poll_2():
+    queues = [('q1', None, 'hg38'), ('q2', None, 'grcm38')]
+    assert [queues[1], queues[0]] == queues_to_poll(queues, ['grcm38'], 600, 600)
+
+
+def test_queues_to_poll_mru():
+    queues = [('q1', None, 'hg38'), ('q2', None, 'grcm38'), ('q3', None, 'hg38')]
+    assert [queues[1], queues[0], queues[2]] == queues_to_poll(queues, ['grcm38', 'hg38'], 10, 600)
+
+
+def test_use_reference():
+    warm = ['hg38', 'grcm38']
+    use_reference(warm, 'grcm38', 2)
+    assert ['grcm38', 'hg38'] == warm
+    use_reference(warm, 'dm6', 2)
+    assert ['dm6', 'grcm38'] == warm
+    use_reference(warm, 'hg38', 1)
+    assert ['hg38'] == warm
+
+
+def test_read_max_warm_references():
+    tmpdir = tempfile.mkdtemp()
+    test_fn = os.path.join(tmpdir, 'cluster.ini')
+    with open(test_fn, 'w') as fh:
+        fh.write('[cluster]\nname = test\n')
+    assert 1 == read_max_warm_references(test_fn, [])
+    assert 2 == read_max_warm_references(test_fn, ['hg38', 'grcm38'])
+    with open(test_fn, 'a') as fh:
+        fh.write('max_warm_references = 3\n')
+    assert 3 == read_max_warm_references(test_fn, [])
+    shutil.rmtree(tmpdir)
+
+
+def test_read_warm_references():
+    tmpdir = tempfile.mkdtemp()
+    test_fn = os.path.join(tmpdir, 'cluster.ini')
+    with open(test_fn, 'w') as fh:
+        fh.write('[cluster]\nname = test\nwarm_references = hg38, grcm38\n')
+    assert ['hg38', 'grcm38'] == read_warm_references(test_fn)
+    with open(test_fn, 'w') as fh:
+        fh.write('[cluster]\nname = test\n')
+    assert [] == read_warm_references(test_fn)
+    shutil.rmtree(tmpdir)
+
+
 def test_parse_image_url_1():
     image_fn, typ = parse_image_url('shub://langmead-lab/recount-pump:workflow_base',
                                     'singularity', cachedir='/cache')
@@ -895,18 +1234,25 @@ def db_connect_wrapper(engine):
 
 def worker(engine, shared_log_queue, project_id_or_name, worker_name, q_ini, cluster_ini, max_fail,
            poll_seconds,
-           mover_config=None, destination=None, source_prefix=None, max_job_fail=MAX_JOB_FAILS, keep=False):
+           mover_config=None, destination=None, source_prefix=None, max_job_fail=MAX_JOB_FAILS, keep=False,
+           affinity_idle=0):
     log_info_detailed('', worker_name, 'Starting worker', shared_log_queue=shared_log_queue)
     session = db_connect_wrapper(engine)
     log_info_detailed('', worker_name, 'DB connected & keep=%s' % keep, shared_log_queue=shared_log_queue)
     #signal.signal(signal.SIGUSR1, lambda sig, stack: traceback.print_stack(stack))
-    print(job_loop(shared_log_queue, project_id_or_name, q_ini, cluster_ini, worker_name, session,
-                   max_fails=max_fail,
-                   sleep_seconds=poll_seconds,
-                   mover_config=mover_config,
-                   destination=destination,
-                   source_prefix=source_prefix,
-                   max_job_fails=max_job_fail, keep=keep))
+    try:
+        print(job_loop(shared_log_queue, project_id_or_name, q_ini, cluster_ini, worker_name, session,
+                       max_fails=max_fail,
+                       sleep_seconds=poll_seconds,
+                       mover_config=mover_config,
+                       destination=destination,
+                       source_prefix=source_prefix,
+                       max_job_fails=max_job_fail, keep=keep,
+                       affinity_idle=affinity_idle))
+    finally:
+        # stop this worker's persistent container, if it has one
+        instance.shutdown(logger=lambda x: log_info_detailed('', worker_name, x,
+                                                             shared_log_queue=shared_log_queue))
 
 
 def log_worker():
@@ -916,7 +1262,12 @@ def log_worker():
         if message == 'AllDone':
             log.warning('Log-worker thread interrupted by AllDone message', 'cluster.py')
             break
-        log.info(message, module)
+        if isinstance(message, list):
+            # batch of lines relayed from a container by run.reader
+            for line in message:
+                log.info(line, module)
+        else:
+            log.info(message, module)
     log.info('Exiting worker log-relay thread', 'cluster.py')
 
 
@@ -992,22 +1343,30 @@ def go():
             globus_section=args['--globus-section'],
             enable_web=True,
             curl_exe=args['--curl'])
-        project_id_or_name = args['<project-id>']
+        mover_config.governor = governor.from_ini(cluster_ini)
+        mover_config.transfer_log = transfers.log_from_ini(cluster_ini)
+        mover_config.staging_methods = staging.staging_methods_from_ini(cluster_ini)
+        project_ids = args['<project-id>']
         if args['prepare']:
             session_maker = session_maker_from_config(db_ini, args['--db-section'])
-            print(prepare(project_id_or_name, cluster_ini, session_maker(),
-                          mover_config.new_mover()))
+            for project_id_or_name in project_ids:
+                print(prepare(project_id_or_name, cluster_ini, session_maker(),
+                              mover_config.new_mover()))
         if args['cleanup']:
             session_maker = session_maker_from_config(db_ini, args['--db-section'])
-            print(clean_up(project_id_or_name, cluster_ini, session_maker()))
+            for project_id_or_name in project_ids:
+                print(clean_up(project_id_or_name, cluster_ini, session_maker()))
         if args['run']:
             enabled, destination_url, source_prefix, aws_endpoint, aws_profile = \
                 parse_destination_ini(dest_ini)
             (engine, engine_url) = engine_from_config(db_ini, args['--db-section'])
+            Base.metadata.create_all(engine)  # tables added since the project was made
             connection = engine.connect()
             session = Session(bind=connection)
-            prepare(project_id_or_name, cluster_ini, session, mover_config.new_mover())
+            for project_id_or_name in project_ids:
+                prepare(project_id_or_name, cluster_ini, session, mover_config.new_mover())
             max_fails = int(args['--max-fail'])
+            affinity_idle = int(args['--affinity-idle'])
             MAX_JOB_FAILS = int(args['--max-job-fail'])
             sleep_seconds = int(args['--poll-seconds'])
             KEEP = '--keep' in args
@@ -1026,13 +1385,44 @@ def go():
             log_thread = threading.Thread(target=log_worker)
             log_thread.start()
             engine.dispose()
+            # one reaper per node empties the trash areas the workers fill
+            reaper = None
+            cluster_cfg = RawConfigParser()
+            cluster_cfg.read(cluster_ini)
+            reap_roots = scratch.cleanup_roots(cluster_cfg, cluster_cfg.sections()[0])
+            if reap_roots is not None:
+                log.info('Starting scratch reaper for %s' % ','.join(reap_roots), 'cluster.py')
+                reaper = scratch.Reaper(reap_roots, log_queue=log_queue)
+                reaper.start()
+            # one batcher per node coalesces the workers' Globus transfers
+            batcher = None
+            batch_seconds, batch_join_seconds = 0, 3600
+            if cluster_cfg.has_option(cluster_cfg.sections()[0], 'globus_batch_seconds'):
+                batch_seconds = int(cluster_cfg.get(cluster_cfg.sections()[0], 'globus_batch_seconds'))
+            if cluster_cfg.has_option(cluster_cfg.sections()[0], 'globus_batch_join_seconds'):
+                batch_join_seconds = int(cluster_cfg.get(cluster_cfg.sections()[0], 'globus_batch_join_seconds'))
+            if batch_seconds > 0 and mover_config.enable_globus:
+                log.info('Starting Globus batcher with interval %d' % batch_seconds, 'cluster.py')
+                mover_config.globus_batch_queue = multiprocessing.Queue()
+                mover_config.globus_batch_pid = os.getpid()
+                batched_jobs = BatchedJobs(q_ini, engine)
+                visibility_timeout = parse_queue_config(q_ini)[3]
+                batcher = GlobusBatcher(mover_config.new_mover().globus_mover, mover_config.globus_batch_queue,
+                                        interval=batch_seconds,
+                                        cleanup=shutil.rmtree if reap_roots is None else scratch.trash,
+                                        on_published=batched_jobs.published,
+                                        on_abandoned=batched_jobs.abandoned,
+                                        heartbeat=batched_jobs.heartbeat,
+                                        heartbeat_interval=max(1, visibility_timeout // 3) if visibility_timeout else 60)
+                batcher.start()
             for i in range(nworkers):
                 worker_name = 'worker_%d_of_%d' % (i+1, nworkers)
                 t = multiprocessing.Process(target=worker,
-                                            args=(engine, log_queue, project_id_or_name, worker_name, q_ini, cluster_ini,
+                                            args=(engine, log_queue, project_ids, worker_name, q_ini, cluster_ini,
                                                   max_fails, sleep_seconds,
                                                   mover_config, destination_url,
-                                                  source_prefix, MAX_JOB_FAILS, KEEP))
+                                                  source_prefix, MAX_JOB_FAILS, KEEP,
+                                                  affinity_idle))
                 t.start()
                 log.info('Spawned process %d (pid=%d)' % (i+1, t.pid), 'cluster.py')
                 procs.append(t)
@@ -1067,6 +1457,20 @@ def go():
                         log.info('Joined process %d of %d, nprocs_finished=%d (pid=%d, exitlevel=%d)' %
                             (i + 1, nworkers, len(nprocs_finished_pids), pid, exitlevels[-1]), 'cluster.py')
             log.info('All processes joined', 'cluster.py')
+            if batcher is not None:
+                log.info('Waiting for Globus batcher to finish', 'cluster.py')
+                batcher.close()
+                batcher.join(batch_join_seconds)
+                if batcher.is_alive():
+                    # their messages become visible again, so other nodes retry them
+                    log.warning('Globus batcher still busy after %d seconds; leaving %d jobs unfinished' %
+                                (batch_join_seconds, len(batcher.active)), 'cluster.py')
+                log.info('Globus batcher done; %d jobs published, %d abandoned' %
+                         (batcher.published, batcher.abandoned), 'cluster.py')
+            if reaper is not None:
+                reaper.close()
+                reaper.join()
+                log.info('Scratch reaper joined', 'cluster.py')
             log_queue.put(('AllDone', 'cluster.py'))
             log_thread.join()
             log.info('Logging thread joined', 'cluster.py')
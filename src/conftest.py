@@ -10,6 +10,7 @@ pytest fixtures for the project
 """
 
 import os
+import sys
 import pytest
 import boto3
 import time
@@ -18,6 +19,10 @@ from base import Base
 from mover import S3Mover
 from sqlalchemy.orm import Session
 
+# amover.py uses yield from, which Python 2 can't compile; unit_test.sh
+# names files explicitly, so it leaves it out there too
+collect_ignore = ['amover.py'] if sys.version_info < (3, 4) else []
+
 
 def check_test_db(metafunc):
     varname = 'RECOUNT_TEST_DB'
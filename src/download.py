@@ -0,0 +1,552 @@
+#!/usr/bin/env python
+
+# Author: Ben Langmead <ben.langmead@gmail.com>
+# License: MIT
+
+"""
+download.py
+
+In-process HTTP(S)/FTP downloads for WebMover.get, replacing the curl
+subprocess.  The file is written to <dest>.part, with the progress of each
+segment kept in <dest>.part.json, and renamed to dest when complete:
+
+- If the server reports a size and accepts byte ranges, a large file is
+  split into segments fetched in parallel with Range requests (FTP: REST),
+  each on its own connection and file handle.
+- A connection that delivers no bytes for stall_timeout seconds, or that
+  ends early, is retried from where it left off rather than from zero.
+- An interrupted download picks up from <dest>.part.json the next time.
+
+Nothing here changes the working directory or other process-wide state, so
+several threads can download at once.
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import ftplib
+import threading
+
+if sys.version[:1] == '2':
+    from urllib2 import Request, urlopen, HTTPError, URLError
+    from urlparse import urlparse
+    from httplib import HTTPException
+else:
+    from urllib.request import Request, urlopen
+    from urllib.error import HTTPError, URLError
+    from urllib.parse import urlparse
+    from http.client import HTTPException
+
+CHUNK_BYTES = 1024 * 1024
+TRANSIENT_ERRORS = (IOError, OSError, socket.timeout, ftplib.Error, HTTPError, URLError, HTTPException)
+DEFAULT_MIN_SEGMENT_BYTES = 64 * 1024 * 1024
+
+
+class Segment(object):
+    """
+    Bytes [start, end) of the file, of which [start, pos) are on disk.  end
+    is None when the size isn't known.
+    """
+
+    def __init__(self, start, end, pos=None):
+        self.start = start
+        self.end = end
+        self.pos = start if pos is None else pos
+        self.error = None
+        self.fatal = False
+
+    def done(self):
+        return self.end is not None and self.pos >= self.end
+
+    def to_list(self):
+        return [self.start, self.end, self.pos]
+
+
+def remote_info(url, timeout=60):
+    """
+    Return (size, accepts ranges) for the file at url; size is None if the
+    server doesn't say
+    """
+    parsed = urlparse(url)
+    if parsed.scheme == 'ftp':
+        ftp = _ftp_connect(parsed, timeout)
+        try:
+            ftp.voidcmd('TYPE I')
+            return ftp.size(parsed.path), True
+        except ftplib.all_errors:
+            return None, False
+        finally:
+            ftp.close()
+    # ask for one byte; a 206 tells us both the size and that ranges work
+    req = Request(url, headers={'Range': 'bytes=0-0'})
+    try:
+        resp = urlopen(req, timeout=timeout)
+    except HTTPError as e:
+        if e.code == 416:
+            # there is no byte 0 to give, i.e. the file is empty
+            return 0, False
+        raise
+    try:
+        if resp.getcode() == 206:
+            content_range = resp.info().get('Content-Range', '')
+            total = content_range.rsplit('/', 1)[-1]
+            return (int(total) if total.isdigit() else None), True
+        length = resp.info().get('Content-Length')
+        return (int(length) if length is not None else None), False
+    finally:
+        resp.close()
+
+
+def _remote_info_retrying(url, timeout, tries, logger):
+    for attempt in range(tries):
+        try:
+            return remote_info(url, timeout=timeout)
+        except TRANSIENT_ERRORS as e:
+            if isinstance(e, HTTPError) and 400 <= e.code < 500 and e.code not in (408, 429):
+                raise
+            if attempt == tries - 1:
+                raise
+            logger is None or logger('size probe of %s failed (%s); retrying' % (url, str(e)))
+            time.sleep(min(2 ** attempt, 30))
+
+
+def _ftp_connect(parsed, timeout):
+    ftp = ftplib.FTP(timeout=timeout)
+    ftp.connect(parsed.hostname, parsed.port or 21)
+    ftp.login(parsed.username or 'anonymous', parsed.password or 'anonymous@')
+    return ftp
+
+
+def _copy_stream(read, fh, seg, lock, progress=None):
+    """
+    Copy from read() into fh until EOF or the end of the segment, passing
+    the size of each chunk to progress
+    """
+    while not seg.done():
+        want = CHUNK_BYTES if seg.end is None else min(CHUNK_BYTES, seg.end - seg.pos)
+        buf = read(want)
+        if not buf:
+            break
+        fh.write(buf)
+        with lock:
+            seg.pos += len(buf)
+        progress is None or progress(len(buf))
+
+
+def _fetch_http(url, part_fn, seg, lock, ranged, stall_timeout, progress):
+    headers = {}
+    if ranged:
+        headers['Range'] = 'bytes=%d-%s' % (seg.pos, '' if seg.end is None else str(seg.end - 1))
+    resp = urlopen(Request(url, headers=headers), timeout=stall_timeout)
+    try:
+        if ranged and resp.getcode() != 206:
+            raise IOError('server ignored Range request for %s' % url)
+        with open(part_fn, 'r+b') as fh:
+            fh.seek(seg.pos)
+            _copy_stream(resp.read, fh, seg, lock, progress)
+    finally:
+        resp.close()
+
+
+def _fetch_ftp(url, part_fn, seg, lock, ranged, stall_timeout, progress):
+    parsed = urlparse(url)
+    ftp = _ftp_connect(parsed, stall_timeout)
+    try:
+        ftp.voidcmd('TYPE I')
+        conn = ftp.transfercmd('RETR ' + parsed.path, rest=seg.pos if ranged and seg.pos > 0 else None)
+        conn.settimeout(stall_timeout)
+        try:
+            with open(part_fn, 'r+b') as fh:
+                fh.seek(seg.pos)
+                _copy_stream(conn.recv, fh, seg, lock, progress)
+        finally:
+            conn.close()
+    finally:
+        ftp.close()
+
+
+def _fetch_segment(url, part_fn, seg, lock, ranged, stall_timeout, tries, logger, progress=None, on_retry=None):
+    fetch = _fetch_ftp if url.startswith('ftp://') else _fetch_http
+    for attempt in range(tries):
+        if attempt > 0 and on_retry is not None:
+            on_retry()
+        before = seg.pos
+        try:
+            fetch(url, part_fn, seg, lock, ranged, stall_timeout, progress)
+        except TRANSIENT_ERRORS as e:
+            seg.error = e
+            logger is None or logger('segment at %d of %s failed (%s); retrying from %d' %
+                                     (seg.start, url, str(e), seg.pos))
+        except Exception as e:
+            # e.g. raised by progress to cancel the download; not retried
+            seg.error = e
+            seg.fatal = True
+            return
+        else:
+            if seg.end is None or seg.done():
+                seg.error = None
+                return
+            seg.error = IOError('connection ended at %d of %d' % (seg.pos, seg.end))
+            logger is None or logger('segment at %d of %s ended early at %d; resuming' %
+                                     (seg.start, url, seg.pos))
+        if not ranged:
+            # can't resume without ranges, so start this segment over and
+            # drop whatever the failed attempt left past its start
+            seg.pos = seg.start
+            with open(part_fn, 'r+b') as fh:
+                fh.truncate(seg.start)
+        if seg.pos == before:
+            time.sleep(min(2 ** attempt, 30))
+
+
+def _plan(size, ranged, segments, min_segment_bytes):
+    if size is None or not ranged or size < 2 * min_segment_bytes or segments <= 1:
+        return [Segment(0, size)]
+    n = int(min(segments, size // min_segment_bytes))
+    step = size // n
+    return [Segment(i * step, size if i == n - 1 else (i + 1) * step) for i in range(n)]
+
+
+def _load_state(state_fn, size):
+    try:
+        with open(state_fn) as fh:
+            state = json.load(fh)
+    except (IOError, OSError, ValueError):
+        return None
+    if state.get('size') != size or size is None:
+        return None
+    return [Segment(*x) for x in state['segments']]
+
+
+def _save_state(state_fn, url, size, segs, lock):
+    with lock:
+        state = {'url': url, 'size': size, 'segments': [s.to_list() for s in segs]}
+    tmp_fn = state_fn + '.tmp'
+    with open(tmp_fn, 'w') as fh:
+        json.dump(state, fh)
+    os.rename(tmp_fn, state_fn)
+
+
+def download(url, dest, segments=4, min_segment_bytes=DEFAULT_MIN_SEGMENT_BYTES, stall_timeout=120,
+             tries=5, logger=None, progress=None, on_retry=None):
+    """
+    Download url to the file dest, resuming an earlier interrupted download
+    of the same file if there is one.  progress, if given, is called with
+    the size of each chunk received, from whichever thread received it, and
+    on_retry each time a segment's connection is retried.
+    Returns the number of bytes in dest.
+    """
+    size, ranged = _remote_info_retrying(url, stall_timeout, tries, logger)
+    part_fn, state_fn = dest + '.part', dest + '.part.json'
+    segs = _load_state(state_fn, size) if ranged and os.path.exists(part_fn) else None
+    if segs is None:
+        segs = _plan(size, ranged, segments, min_segment_bytes)
+        with open(part_fn, 'wb') as fh:
+            if size is not None and len(segs) > 1:
+                fh.truncate(size)
+    else:
+        logger is None or logger('resuming %s with %d of %d bytes done' %
+                                 (url, sum(s.pos - s.start for s in segs), size))
+    logger is None or logger('downloading %s (%s bytes) in %d segment(s)' %
+                             (url, 'unknown' if size is None else str(size), len(segs)))
+    lock = threading.Lock()
+    threads = []
+    for seg in segs:
+        if seg.done():
+            continue
+        t = threading.Thread(target=_fetch_segment,
+                             args=(url, part_fn, seg, lock, ranged, stall_timeout, tries, logger, progress,
+                                   on_retry))
+        t.daemon = True
+        t.start()
+        threads.append(t)
+    while any(t.is_alive() for t in threads):
+        for t in threads:
+            t.join(5)
+        if ranged:
+            _save_state(state_fn, url, size, segs, lock)
+    failed = [s for s in segs if s.error is not None or (s.end is not None and not s.done())]
+    if len(failed) > 0:
+        for seg in failed:
+            if seg.fatal:
+                raise seg.error
+        raise RuntimeError('Download of %s failed after %d tries: %s' % (url, tries, str(failed[0].error)))
+    # when the size wasn't known there is one segment, and what it received
+    # is the whole file
+    expected = segs[0].pos if size is None else size
+    if os.path.getsize(part_fn) != expected:
+        raise RuntimeError('Download of %s has %d bytes on disk; expected %d' %
+                           (url, os.path.getsize(part_fn), expected))
+    os.rename(part_fn, dest)
+    if os.path.exists(state_fn):
+        os.remove(state_fn)
+    return os.path.getsize(dest)
+
+
+class _NoResume(Exception):
+    """ The server won't start partway through the file """
+
+
+def _open_at(url, pos, chunk_bytes, stall_timeout, info):
+    """
+    Yield the bytes of url from offset pos on over one connection, setting
+    info['size'] if the server says how big the file is
+    """
+    parsed = urlparse(url)
+    if parsed.scheme == 'ftp':
+        ftp = _ftp_connect(parsed, stall_timeout)
+        try:
+            ftp.voidcmd('TYPE I')
+            if info.get('size') is None:
+                try:
+                    info['size'] = ftp.size(parsed.path)
+                except ftplib.all_errors:
+                    pass
+            conn = ftp.transfercmd('RETR ' + parsed.path, rest=pos if pos > 0 else None)
+            conn.settimeout(stall_timeout)
+            try:
+                while True:
+                    buf = conn.recv(chunk_bytes)
+                    if not buf:
+                        break
+                    yield buf
+            finally:
+                conn.close()
+        finally:
+            ftp.close()
+        return
+    resp = urlopen(Request(url, headers={'Range': 'bytes=%d-' % pos} if pos > 0 else {}), timeout=stall_timeout)
+    try:
+        if pos > 0 and resp.getcode() != 206:
+            raise _NoResume('server ignored Range request for %s' % url)
+        if resp.getcode() == 206:
+            total = resp.info().get('Content-Range', '').rsplit('/', 1)[-1]
+            info['size'] = int(total) if total.isdigit() else info.get('size')
+        elif resp.info().get('Content-Length') is not None:
+            info['size'] = int(resp.info().get('Content-Length'))
+        while True:
+            buf = resp.read(chunk_bytes)
+            if not buf:
+                break
+            yield buf
+    finally:
+        resp.close()
+
+
+def stream(url, chunk_bytes=CHUNK_BYTES, stall_timeout=120, tries=5, logger=None, on_retry=None):
+    """
+    Yield the bytes of url in order, for callers that process a file as it
+    arrives.  A connection that fails or ends short of the size the server
+    gave is retried from where it left off (FTP: REST), up to tries times;
+    a server that won't resume fails the stream rather than repeat bytes
+    already yielded.
+    """
+    pos, info = 0, {}
+    for attempt in range(tries):
+        if attempt > 0:
+            on_retry is None or on_retry()
+        before = pos
+        try:
+            for buf in _open_at(url, pos, chunk_bytes, stall_timeout, info):
+                pos += len(buf)
+                yield buf
+            if info.get('size') is None or pos >= info['size']:
+                return
+            error = IOError('connection ended at %d of %d' % (pos, info['size']))
+        except _NoResume as e:
+            raise RuntimeError('Stream of %s failed at byte %d: %s' % (url, pos, str(e)))
+        except TRANSIENT_ERRORS as e:
+            if isinstance(e, HTTPError) and 400 <= e.code < 500 and e.code not in (408, 429):
+                raise
+            error = e
+        logger is None or logger('stream of %s failed at %d (%s); resuming' % (url, pos, str(error)))
+        if pos == before:
+            time.sleep(min(2 ** attempt, 30))
+    raise RuntimeError('Stream of %s failed after %d tries: %s' % (url, tries, str(error)))
+
+
+def _serve(payload, ranges=True, truncate_first=0, fail_first=0):
+    """
+    Start an HTTP server on localhost serving payload at any path.  If
+    truncate_first > 0, the first that many responses are cut off halfway;
+    if fail_first > 0, the first that many requests get a 503.
+    Returns (server, list of Range headers received).
+    """
+    if sys.version[:1] == '2':
+        from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+        from SocketServer import ThreadingMixIn
+    else:
+        from http.server import HTTPServer, BaseHTTPRequestHandler
+        from socketserver import ThreadingMixIn
+    seen = []
+    state = {'truncate': truncate_first, 'fail': fail_first}
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            rng = self.headers.get('Range')
+            seen.append(rng)
+            with lock:
+                fail = state['fail'] > 0
+                if fail:
+                    state['fail'] -= 1
+            if fail:
+                self.send_error(503)
+                return
+            start, end = 0, len(payload)
+            if ranges and rng is not None:
+                a, b = rng.split('=')[1].split('-')
+                start, end = int(a), (len(payload) if b == '' else min(len(payload), int(b) + 1))
+                if start >= len(payload):
+                    self.send_error(416)
+                    return
+                self.send_response(206)
+                self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end - 1, len(payload)))
+            else:
+                self.send_response(200)
+            self.send_header('Content-Length', str(end - start))
+            self.end_headers()
+            body = payload[start:end]
+            with lock:
+                cut = state['truncate'] > 0 and len(body) > 1
+                if cut:
+                    state['truncate'] -= 1
+            self.wfile.write(body[:len(body) // 2] if cut else body)
+
+    lock = threading.Lock()
+
+    class Server(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    server = Server(('127.0.0.1', 0), Handler)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    return server, seen
+
+
+def _test_payload():
+    return bytes(bytearray((i * 7) % 251 for i in range(100000)))
+
+
+def test_segmented_download():
+    import tempfile
+    import shutil
+    payload = _test_payload()
+    server, seen = _serve(payload)
+    tmpdir = tempfile.mkdtemp()
+    dest = os.path.join(tmpdir, 'f.bin')
+    url = 'http://127.0.0.1:%d/f.bin' % server.server_address[1]
+    received = []
+    assert len(payload) == download(url, dest, segments=4, min_segment_bytes=10000, progress=received.append)
+    with open(dest, 'rb') as fh:
+        assert payload == fh.read()
+    assert len(payload) == sum(received)
+    assert 1 + 4 == len(seen)  # probe, then one request per segment
+    assert not os.path.exists(dest + '.part.json')
+    server.shutdown()
+    shutil.rmtree(tmpdir)
+
+
+def test_resume_after_truncation():
+    import tempfile
+    import shutil
+    payload = _test_payload()
+    server, seen = _serve(payload, truncate_first=1)
+    tmpdir = tempfile.mkdtemp()
+    dest = os.path.join(tmpdir, 'f.bin')
+    url = 'http://127.0.0.1:%d/f.bin' % server.server_address[1]
+    retries = []
+    assert len(payload) == download(url, dest, segments=1, stall_timeout=5, on_retry=lambda: retries.append(1))
+    assert 1 == len(retries)
+    with open(dest, 'rb') as fh:
+        assert payload == fh.read()
+    assert 'bytes=%d-%d' % (len(payload) // 2, len(payload) - 1) == seen[-1]
+    server.shutdown()
+    shutil.rmtree(tmpdir)
+
+
+def test_progress_raises():
+    import tempfile
+    import shutil
+    payload = _test_payload()
+    server, _ = _serve(payload)
+    tmpdir = tempfile.mkdtemp()
+    url = 'http://127.0.0.1:%d/f.bin' % server.server_address[1]
+
+    def _stop(nbytes):
+        raise ValueError('stop')
+
+    try:
+        download(url, os.path.join(tmpdir, 'f.bin'), segments=4, min_segment_bytes=10000, progress=_stop)
+        assert False
+    except ValueError:
+        pass
+    server.shutdown()
+    shutil.rmtree(tmpdir)
+
+
+def test_stream():
+    payload = _test_payload()
+    server, seen = _serve(payload)
+    url = 'http://127.0.0.1:%d/f.bin' % server.server_address[1]
+    assert payload == b''.join(stream(url, chunk_bytes=4096))
+    assert [None] == seen
+    server.shutdown()
+
+
+def test_stream_resumes():
+    payload = _test_payload()
+    server, seen = _serve(payload, truncate_first=1)
+    url = 'http://127.0.0.1:%d/f.bin' % server.server_address[1]
+    retries = []
+    assert payload == b''.join(stream(url, chunk_bytes=4096, stall_timeout=5, on_retry=lambda: retries.append(1)))
+    assert 1 == len(retries)
+    assert [None, 'bytes=%d-' % (len(payload) // 2)] == seen
+    server.shutdown()
+
+
+def test_no_ranges():
+    import tempfile
+    import shutil
+    payload = _test_payload()
+    server, seen = _serve(payload, ranges=False)
+    tmpdir = tempfile.mkdtemp()
+    dest = os.path.join(tmpdir, 'f.bin')
+    url = 'http://127.0.0.1:%d/f.bin' % server.server_address[1]
+    assert len(payload) == download(url, dest, segments=4, min_segment_bytes=10000)
+    with open(dest, 'rb') as fh:
+        assert payload == fh.read()
+    server.shutdown()
+    shutil.rmtree(tmpdir)
+
+
+def test_empty_file():
+    import tempfile
+    import shutil
+    server, seen = _serve(b'')
+    tmpdir = tempfile.mkdtemp()
+    dest = os.path.join(tmpdir, 'f.bin')
+    url = 'http://127.0.0.1:%d/f.bin' % server.server_address[1]
+    assert 0 == download(url, dest)
+    assert ['bytes=0-0'] == seen
+    server.shutdown()
+    shutil.rmtree(tmpdir)
+
+
+def test_probe_retried():
+    import tempfile
+    import shutil
+    payload = _test_payload()
+    server, seen = _serve(payload, fail_first=1)
+    tmpdir = tempfile.mkdtemp()
+    dest = os.path.join(tmpdir, 'f.bin')
+    url = 'http://127.0.0.1:%d/f.bin' % server.server_address[1]
+    assert len(payload) == download(url, dest, segments=1)
+    assert ['bytes=0-0', 'bytes=0-0'] == seen[:2]
+    server.shutdown()
+    shutil.rmtree(tmpdir)
@@ -0,0 +1,551 @@
+#!/usr/bin/env python
+
+# Author: Ben Langmead <ben.langmead@gmail.com>
+# License: MIT
+
+"""
+globus_batch.py
+
+Node-level aggregation of Globus transfers.  Without it, every job submits
+its own transfer tasks (outputs, then .sums, then .done) and its worker
+waits in task_wait for each.  With it, workers hand a finished job's
+transfers to a GlobusBatcher thread in the cluster.py parent process via a
+multiprocessing queue and go straight on to their next job.
+
+The batcher coalesces the outputs of all jobs handed to it in the last
+interval seconds into one transfer task per (source, destination) endpoint
+pair, and polls those tasks without blocking.  Once a job's outputs have
+landed (along with its .sums), its .done marker goes out in a second
+batched task, so a .done never appears at the destination before the data
+it vouches for.
+Only once the markers land is the job's local output directory removed.
+
+A job handed to the batcher isn't finished: its worker leaves the queue
+message alone and records no success.  The batcher keeps the message
+invisible while the job's transfers run, through the heartbeat callback,
+and hands the job to on_published once its markers land or to on_abandoned
+once it gives up on them.  cluster.py uses these to delete the message and
+record the success, or to record a failure and make the message visible
+again so another worker retries the job.  If the node dies first, the
+message becomes visible again on its own.
+"""
+
+import os
+import sys
+import time
+import threading
+import log
+import scratch
+from mover import parse_globus_url
+
+if sys.version[:1] == '2':
+    from Queue import Empty
+else:
+    from queue import Empty
+
+
+def submit_job(queue, name, source, destination, files, markers, extras=None, cleanup_dir=None, ticket=None,
+               reservation=None):
+    """
+    Hand a job's transfers to the batcher: files (names relative to the
+    source directory URL) go to the destination directory URL, along with
+    extras, a list of (source URL, destination URL) pairs.  Then markers,
+    another such list, are published.  cleanup_dir, if given, is removed
+    once everything has landed or the batcher gives up.  ticket is passed
+    back to the batcher's callbacks, to say which queue message and task
+    the job belongs to.  reservation, if given, is the (root, kind) of a
+    scratch reservation for cleanup_dir, already handed over to the
+    batcher's process (see scratch.hand_over), which releases it along
+    with cleanup_dir.
+    """
+    queue.put({'name': name, 'source': source, 'destination': destination, 'files': list(files),
+               'extras': list(extras or []), 'markers': list(markers), 'cleanup_dir': cleanup_dir,
+               'ticket': ticket, 'reservation': reservation})
+
+
+def _endpoints(source, destination):
+    return parse_globus_url(source)[0], parse_globus_url(destination)[0]
+
+
+class GlobusBatcher(threading.Thread):
+    """
+    globus_mover is a mover.GlobusMover used only by this thread.  cleanup
+    is called with each finished or abandoned job's cleanup_dir.
+
+    A task that fails, or can't be submitted, is resubmitted up to
+    max_retries times; only the failed endpoint pair's transfers go again.
+    A task whose status can't be had max_poll_errors times in a row is
+    cancelled and counted as failed.  Once a task covering several jobs
+    runs out of retries, it is split into one task per job, each tried
+    once more, so that one bad job or path doesn't sink the batch.  A job
+    whose own task still fails is abandoned, and its other tasks are
+    cancelled unless other jobs still need them.
+
+    on_published and on_abandoned are called with each job (the dictionary
+    made by submit_job) as it finishes, and heartbeat with each job still
+    in the batcher every heartbeat_interval seconds.
+    """
+
+    def __init__(self, globus_mover, queue, interval=60, max_items=5000, max_retries=3,
+                 poll_interval=5, cleanup=None, max_poll_errors=10,
+                 on_published=None, on_abandoned=None, heartbeat=None, heartbeat_interval=60):
+        super(GlobusBatcher, self).__init__()
+        self.mover = globus_mover
+        self.queue = queue
+        self.interval = interval
+        self.max_items = max_items
+        self.max_retries = max_retries
+        self.max_poll_errors = max_poll_errors
+        self.poll_interval = poll_interval
+        self.cleanup = cleanup
+        self.on_published = on_published
+        self.on_abandoned = on_abandoned
+        self.heartbeat = heartbeat
+        self.heartbeat_interval = heartbeat_interval
+        self.pending = []      # jobs whose outputs haven't been submitted
+        self.active = {}       # job name -> job, for every job not yet finished
+        self.outstanding = {}  # job name -> tasks it still needs for its stage
+        self.in_flight = {}    # task id -> unit (see _submit)
+        self.resubmit = []     # units to submit again
+        self.poll_errors = {}  # task id -> consecutive failures to get its status
+        self.doomed = []       # abandoned jobs whose output is still being read
+        self.close_event = threading.Event()
+        self.published = 0
+        self.abandoned = 0
+        self.daemon = True
+
+    def close(self):
+        """
+        Stop accepting work once the queue is drained, submit what's pending
+        right away, and exit when every task has finished
+        """
+        self.close_event.set()
+
+    def _pending_items(self):
+        return sum(len(job['files']) for job in self.pending)
+
+    def _drain(self, timeout):
+        deadline = time.time() + timeout
+        while True:
+            try:
+                job = self.queue.get(timeout=max(0.0, deadline - time.time()))
+            except Empty:
+                return
+            self.pending.append(job)
+            self.active[job['name']] = job
+            if self._pending_items() >= self.max_items:
+                return
+
+    def _items(self, stage, job):
+        """
+        Return a list of ((source endpoint, destination endpoint),
+        (source URL, destination URL, [(source path, destination path)],
+        job name)) for the job's transfers in the stage
+        """
+        items = []
+        if stage == 'data':
+            _, src_path, _, _ = parse_globus_url(job['source'])
+            _, dst_path, _, _ = parse_globus_url(job['destination'])
+            pairs = [(os.path.join(src_path, fn), os.path.join(dst_path, fn)) for fn in job['files']]
+            items.append((_endpoints(job['source'], job['destination']),
+                          (job['source'], job['destination'], pairs, job['name'])))
+        for src, dst in job['extras' if stage == 'data' else 'markers']:
+            pairs = [(parse_globus_url(src)[1], parse_globus_url(dst)[1])]
+            items.append((_endpoints(src, dst), (src, dst, pairs, job['name'])))
+        return items
+
+    def _live(self, unit):
+        return [job for job in unit['jobs'] if job['name'] in self.active]
+
+    def _submit(self, stage, jobs):
+        """
+        Submit one task per endpoint pair covering the given jobs' transfers
+        for the stage.  Each task is tracked as a unit, a dictionary with
+        the stage, the endpoint pair, its items, the jobs they belong to and
+        the tries so far.  A job is done with the stage once every unit it
+        has items in has succeeded.
+        """
+        by_pair, done = {}, []
+        for job in jobs:
+            self.active.setdefault(job['name'], job)
+            items = self._items(stage, job)
+            if len(items) == 0:
+                done.append(job)
+                continue
+            self.outstanding[job['name']] = len(set(pair for pair, _ in items))
+            for pair, item in items:
+                unit = by_pair.setdefault(pair, {'stage': stage, 'pair': pair, 'items': [], 'jobs': [],
+                                                 'tries': 0})
+                unit['items'].append(item)
+                if job not in unit['jobs']:
+                    unit['jobs'].append(job)
+        for pair in sorted(by_pair.keys()):
+            self._submit_unit(by_pair[pair])
+        if len(done) > 0:
+            self._stage_done(stage, done)
+
+    def _submit_unit(self, unit):
+        names = set(job['name'] for job in self._live(unit))
+        items = [item for item in unit['items'] if item[3] in names]
+        if len(items) == 0:
+            return  # every job it was for has been abandoned
+        stage = unit['stage']
+        src, dst, _, _ = items[0]
+        tdata = self.mover._xfer_data(src, dst, 'batch-' + stage)
+        nitems = 0
+        for _, _, pairs, _ in items:
+            for src_path, dst_path in pairs:
+                tdata.add_item(src_path, dst_path)
+                nitems += 1
+        try:
+            task_id = self.mover.client.submit_transfer(tdata)['task_id']
+        except Exception as e:
+            self._failed(unit, 'could not submit %s batch of %d items: %s' % (stage, nitems, str(e)))
+            return
+        log.info('submitted %s batch task %s: %d items from %d jobs' %
+                 (stage, task_id, nitems, len(names)), 'globus_batch.py')
+        log.info('COUNT_GlobusBatchTasks 1', 'globus_batch.py')
+        log.info('COUNT_GlobusBatchItems %d' % nitems, 'globus_batch.py')
+        self.in_flight[task_id] = unit
+
+    def _failed(self, unit, why):
+        """
+        Resubmit a unit's transfers; once they've failed max_retries + 1
+        times, split the unit into one per job, or abandon its job if it
+        has only one
+        """
+        live = self._live(unit)
+        if unit['tries'] < self.max_retries:
+            log.warning('%s; resubmitting (try %d of %d)' % (why, unit['tries'] + 2, self.max_retries + 1),
+                        'globus_batch.py')
+            unit['tries'] += 1
+            self.resubmit.append(unit)
+        elif len(live) > 1:
+            log.warning('%s; failed %d times, so trying its %d jobs separately' %
+                        (why, unit['tries'] + 1, len(live)), 'globus_batch.py')
+            log.info('COUNT_GlobusBatchSplits 1', 'globus_batch.py')
+            for job in live:
+                # one more try each; a job whose own transfer fails is dropped
+                self.resubmit.append(dict(unit, jobs=[job], tries=self.max_retries,
+                                          items=[item for item in unit['items'] if item[3] == job['name']]))
+        else:
+            log.error('%s; failed %d times' % (why, unit['tries'] + 1), 'globus_batch.py')
+            for job in live:
+                self._abandon(job)
+
+    def _cancel(self, task_id):
+        try:
+            self.mover.client.cancel_task(task_id)
+        except Exception as e:
+            log.warning('could not cancel task %s: %s' % (task_id, str(e)), 'globus_batch.py')
+
+    def _abandon(self, job):
+        """
+        Give up on a job, cancelling the tasks that no other job needs.  Its
+        output directory is only removed once no task is reading from it.
+        """
+        if job['name'] not in self.active:
+            return
+        del self.active[job['name']]
+        self.outstanding.pop(job['name'], None)
+        for task_id in sorted(self.in_flight.keys()):
+            if len(self._live(self.in_flight[task_id])) == 0:
+                del self.in_flight[task_id]
+                self.poll_errors.pop(task_id, None)
+                self._cancel(task_id)
+        self.resubmit = [unit for unit in self.resubmit if len(self._live(unit)) > 0]
+        log.error('abandoning job %s' % job['name'], 'globus_batch.py')
+        self.abandoned += 1
+        log.info('COUNT_GlobusBatchJobsAbandoned 1', 'globus_batch.py')
+        self._retire(job, self.on_abandoned, cleanup=False)
+        self.doomed.append(job)
+        self._clean_doomed()
+
+    def _clean_doomed(self):
+        reading = set(job['name'] for unit in self.in_flight.values() for job in unit['jobs'])
+        for job in [job for job in self.doomed if job['name'] not in reading]:
+            self.doomed.remove(job)
+            self._cleanup(job)
+
+    def _retire(self, job, callback, cleanup=True):
+        self.active.pop(job['name'], None)
+        if callback is not None:
+            try:
+                callback(job)
+            except Exception as e:
+                log.warning('could not finish up %s: %s' % (job['name'], str(e)), 'globus_batch.py')
+        if cleanup:
+            self._cleanup(job)
+
+    def _cleanup(self, job):
+        if job['cleanup_dir'] is not None and self.cleanup is not None:
+            try:
+                self.cleanup(job['cleanup_dir'])
+            except Exception as e:
+                log.warning('could not remove %s: %s' % (job['cleanup_dir'], str(e)), 'globus_batch.py')
+        if job['reservation'] is not None:
+            root, kind = job['reservation']
+            scratch.release(root, job['name'], kind=kind)
+
+    def _stage_done(self, stage, jobs):
+        if stage == 'data':
+            self._submit('markers', jobs)
+            return
+        for job in jobs:
+            log.info('published %s' % job['name'], 'globus_batch.py')
+            self.published += 1
+            self._retire(job, self.on_published)
+        log.info('COUNT_GlobusBatchJobsPublished %d' % len(jobs), 'globus_batch.py')
+
+    def flush(self):
+        jobs, self.pending = self.pending, []
+        if len(jobs) > 0:
+            self._submit('data', jobs)
+
+    def poll(self):
+        retry, self.resubmit = self.resubmit, []
+        for unit in retry:
+            self._submit_unit(unit)
+        ready = {'data': [], 'markers': []}
+        for task_id in list(self.in_flight.keys()):
+            if task_id not in self.in_flight:
+                continue  # cancelled along with an abandoned job
+            unit = self.in_flight[task_id]
+            try:
+                status = self.mover.client.get_task(task_id)['status']
+            except Exception as e:
+                self.poll_errors[task_id] = self.poll_errors.get(task_id, 0) + 1
+                log.warning('could not get status of task %s (%d in a row): %s' %
+                            (task_id, self.poll_errors[task_id], str(e)), 'globus_batch.py')
+                if self.poll_errors[task_id] >= self.max_poll_errors:
+                    del self.in_flight[task_id]
+                    del self.poll_errors[task_id]
+                    self._cancel(task_id)
+                    self._failed(unit, 'lost track of %s batch task %s' % (unit['stage'], task_id))
+                continue
+            self.poll_errors.pop(task_id, None)
+            if status == 'SUCCEEDED':
+                del self.in_flight[task_id]
+                for job in self._live(unit):
+                    self.outstanding[job['name']] -= 1
+                    if self.outstanding[job['name']] == 0:
+                        ready[unit['stage']].append(job)
+            elif status == 'FAILED':
+                del self.in_flight[task_id]
+                self._failed(unit, '%s batch task %s failed' % (unit['stage'], task_id))
+        # jobs whose data landed in this poll share their markers' task
+        for stage in ['data', 'markers']:
+            jobs = [job for job in ready[stage] if job['name'] in self.active]
+            if len(jobs) > 0:
+                self._stage_done(stage, jobs)
+        self._clean_doomed()
+
+    def beat(self):
+        if self.heartbeat is None:
+            return
+        for job in list(self.active.values()):
+            try:
+                self.heartbeat(job)
+            except Exception as e:
+                log.warning('heartbeat for %s failed: %s' % (job['name'], str(e)), 'globus_batch.py')
+
+    def idle(self):
+        return len(self.pending) == 0 and len(self.in_flight) == 0 and len(self.resubmit) == 0
+
+    def run(self):
+        last_flush = last_beat = time.time()
+        while True:
+            closing = self.close_event.is_set()
+            self._drain(self.poll_interval)
+            if closing or time.time() - last_flush >= self.interval or self._pending_items() >= self.max_items:
+                self.flush()
+                last_flush = time.time()
+            self.poll()
+            if time.time() - last_beat >= self.heartbeat_interval:
+                self.beat()
+                last_beat = time.time()
+            if closing and self.idle() and self.queue.empty():
+                break
+
+
+class _FakeTransferData(list):
+    def add_item(self, src, dst):
+        self.append((src, dst))
+
+
+class _FakeClient(object):
+    def __init__(self, fail_first=0, submit_errors=0, status_errors=0, fail_paths=None, slow_paths=None):
+        self.tasks = {}
+        self.cancelled = []
+        self.fail_first = fail_first
+        self.submit_errors = submit_errors
+        self.status_errors = status_errors
+        self.fail_paths = fail_paths or []  # tasks with these sources always fail
+        self.slow_paths = slow_paths or []  # ... and these stay active
+
+    def submit_transfer(self, tdata):
+        if self.submit_errors > 0:
+            self.submit_errors -= 1
+            raise RuntimeError('service unavailable')
+        task_id = 'task%d' % len(self.tasks)
+        self.tasks[task_id] = list(tdata)
+        return {'task_id': task_id}
+
+    def get_task(self, task_id):
+        if self.status_errors > 0:
+            self.status_errors -= 1
+            raise RuntimeError('service unavailable')
+        if self.fail_first > 0 or any(src in self.fail_paths for src, _ in self.tasks[task_id]):
+            self.fail_first = max(0, self.fail_first - 1)
+            return {'status': 'FAILED'}
+        if task_id in self.cancelled:
+            return {'status': 'FAILED'}
+        if any(src in self.slow_paths for src, _ in self.tasks[task_id]):
+            return {'status': 'ACTIVE'}
+        return {'status': 'SUCCEEDED'}
+
+    def cancel_task(self, task_id):
+        self.cancelled.append(task_id)
+
+
+class _FakeGlobusMover(object):
+    def __init__(self, client):
+        self.client = client
+
+    def _xfer_data(self, source, destination, typ):
+        return _FakeTransferData()
+
+
+def _job(name):
+    return {'name': name, 'source': 'globus://src/out/' + name, 'destination': 'globus://dst/dest/' + name,
+            'files': ['a', 'b'], 'extras': [], 'markers': [('globus://src/out/%s.done' % name, 'globus://dst/dest/%s.done' % name)],
+            'cleanup_dir': '/out/' + name, 'reservation': None}
+
+
+def test_batching():
+    import multiprocessing
+    import shutil
+    import tempfile
+    client = _FakeClient()
+    cleaned = []
+    batcher = GlobusBatcher(_FakeGlobusMover(client), multiprocessing.Queue(), cleanup=cleaned.append)
+    root = tempfile.mkdtemp()
+    scratch.reserve(root, 'j1', 1000, kind='output')
+    jobs = [_job('j1'), _job('j2')]
+    jobs[0]['reservation'] = (root, 'output')
+    batcher.pending = jobs
+    batcher.flush()
+    assert 1 == len(client.tasks)
+    assert ('/out/j1/a', '/dest/j1/a') == client.tasks['task0'][0]
+    assert 4 == len(client.tasks['task0'])
+    batcher.poll()  # data landed; markers go out together
+    assert [('/out/j1.done', '/dest/j1.done'), ('/out/j2.done', '/dest/j2.done')] == client.tasks['task1']
+    assert [] == cleaned
+    assert 1000 == scratch.reserved_bytes(root)
+    batcher.poll()
+    assert ['/out/j1', '/out/j2'] == cleaned
+    assert 0 == scratch.reserved_bytes(root)
+    shutil.rmtree(root)
+    assert 2 == batcher.published
+    assert batcher.idle()
+
+
+def test_retry_and_close():
+    import multiprocessing
+    client = _FakeClient(fail_first=1)
+    queue = multiprocessing.Queue()
+    batcher = GlobusBatcher(_FakeGlobusMover(client), queue, interval=1000, poll_interval=0.01)
+    submit_job(queue, 'j1', 'globus://src/out/j1', 'globus://dst/dest/j1', ['a'],
+               [('globus://src/out/j1.done', 'globus://dst/dest/j1.done')])
+    time.sleep(0.1)  # let the queue's feeder thread catch up
+    batcher.start()
+    batcher.close()
+    batcher.join(10)
+    assert not batcher.is_alive()
+    assert 1 == batcher.published
+    assert 3 == len(client.tasks)  # data, data again, markers
+
+
+def test_abandon_cancels_siblings():
+    import multiprocessing
+    # the extra goes to a second endpoint pair, whose task always fails
+    client = _FakeClient(fail_paths=['/x/j1.sums'], slow_paths=['/out/j1/a'])
+    published, abandoned, cleaned = [], [], []
+    batcher = GlobusBatcher(_FakeGlobusMover(client), multiprocessing.Queue(), max_retries=1,
+                            cleanup=cleaned.append, on_published=published.append,
+                            on_abandoned=abandoned.append)
+    job = _job('j1')
+    job['extras'] = [('globus://other/x/j1.sums', 'globus://dst/dest/j1.sums')]
+    batcher.pending = [job]
+    batcher.flush()
+    assert 2 == len(batcher.in_flight)
+    batcher.poll()  # the extra's task fails
+    assert 1 == len(batcher.resubmit)
+    batcher.poll()  # only it is resubmitted, and fails again, so the data task still running is cancelled
+    assert [('/x/j1.sums', '/dest/j1.sums')] == client.tasks['task2']
+    assert 3 == len(client.tasks)
+    assert batcher.idle()
+    assert ['task1'] == client.cancelled
+    assert [] == published
+    assert ['j1'] == [j['name'] for j in abandoned]
+    assert ['/out/j1'] == cleaned
+    assert 1 == batcher.abandoned
+
+
+def test_split_after_failure():
+    import multiprocessing
+    # j2's output can't be read, which fails the task it shares with j1
+    client = _FakeClient(fail_paths=['/out/j2/a'])
+    published, abandoned, cleaned = [], [], []
+    batcher = GlobusBatcher(_FakeGlobusMover(client), multiprocessing.Queue(), max_retries=1,
+                            cleanup=cleaned.append, on_published=published.append,
+                            on_abandoned=abandoned.append)
+    batcher.pending = [_job('j1'), _job('j2'), _job('j3')]
+    batcher.flush()
+    batcher.poll()  # fails once
+    batcher.poll()  # fails again, so the jobs go separately
+    assert 2 == len(client.tasks)
+    assert 3 == len(batcher.resubmit)
+    batcher.poll()  # j1 and j3 land and their markers go out together; j2 fails on its own
+    assert [('/out/j1.done', '/dest/j1.done'), ('/out/j3.done', '/dest/j3.done')] == client.tasks['task5']
+    assert ['j2'] == [j['name'] for j in abandoned]
+    assert ['/out/j2'] == cleaned
+    batcher.poll()
+    assert ['j1', 'j3'] == [j['name'] for j in published]
+    assert 1 == batcher.abandoned
+    assert batcher.idle()
+
+
+def test_submit_and_status_errors():
+    import multiprocessing
+    client = _FakeClient(submit_errors=1, status_errors=2)
+    published = []
+    batcher = GlobusBatcher(_FakeGlobusMover(client), multiprocessing.Queue(), max_poll_errors=2,
+                            on_published=published.append)
+    batcher.pending = [_job('j1')]
+    batcher.flush()  # can't submit; tried again on the next poll
+    assert 0 == len(client.tasks)
+    for _ in range(4):
+        batcher.poll()
+    # task0 went unanswered twice, so it was cancelled and resubmitted
+    assert ['task0'] == client.cancelled
+    assert ['j1'] == [j['name'] for j in published]
+    assert batcher.idle()
+    # submission failures count against the retries too
+    client = _FakeClient(submit_errors=100)
+    abandoned = []
+    batcher = GlobusBatcher(_FakeGlobusMover(client), multiprocessing.Queue(), on_abandoned=abandoned.append)
+    batcher.pending = [_job('j1')]
+    batcher.flush()
+    for _ in range(10):
+        batcher.poll()
+    assert batcher.idle() and 1 == len(abandoned)
+
+
+def test_heartbeat():
+    import multiprocessing
+    beats = []
+    batcher = GlobusBatcher(_FakeGlobusMover(_FakeClient()), multiprocessing.Queue(), heartbeat=beats.append)
+    batcher.active = {'j1': _job('j1')}
+    batcher.beat()
+    assert ['j1'] == [j['name'] for j in beats]
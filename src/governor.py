@@ -0,0 +1,346 @@
+#!/usr/bin/env python
+
+# Author: Ben Langmead <ben.langmead@gmail.com>
+# License: MIT
+
+"""
+governor.py
+
+A node-wide budget for transfers, shared by every worker process on the
+node through a small JSON state file guarded by an fcntl lock.  Ingress
+("in": SRA downloads, reference pulls, image pulls) and egress ("out":
+shipping finished jobs) have separate budgets, each with:
+
+- a cap on concurrent transfers, enforced with leases that are dropped
+  when their process dies, and
+- a token bucket limiting bytes/sec, charged as transfers progress.
+  Each transfer's throttle adds up its bytes in-process and settles with
+  the shared bucket only every sync_secs' worth of the rate (or sync_secs,
+  whichever comes first), so progress callbacks don't each lock and
+  rewrite the state file.
+
+Transfers have a priority: "high" (shipping finished jobs), "normal"
+(inputs for the job about to run) or "low" (prefetches).  A transfer
+doesn't take a slot while a higher-priority transfer is waiting for one.
+Low-priority transfers leave one slot free and only spend tokens while
+the bucket is at least low_reserve full, so they can't starve the rest.
+
+Mover consults the governor for every transfer when one is configured
+(see from_ini).
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import tempfile
+import threading
+import itertools
+from contextlib import contextmanager
+
+if sys.version[:1] == '2':
+    from ConfigParser import RawConfigParser
+else:
+    from configparser import RawConfigParser
+
+DIRECTIONS = ['in', 'out']
+PRIORITIES = {'high': 0, 'normal': 1, 'low': 2}
+
+_lease_ids = itertools.count()
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == 1  # EPERM: exists, but not ours
+    return True
+
+
+class Governor(object):
+    """
+    rates and max_transfers map each direction to bytes/sec and to a number
+    of concurrent transfers; a missing or None entry means no limit.
+    Holds no open files, so it can be handed to forked worker processes.
+    """
+
+    def __init__(self, state_dir, rates=None, max_transfers=None, burst_secs=2.0, low_reserve=0.25, poll=0.1,
+                 sync_secs=0.25):
+        self.state_dir = state_dir
+        self.rates = rates or {}
+        self.max_transfers = max_transfers or {}
+        self.burst_secs = burst_secs
+        self.low_reserve = low_reserve
+        self.poll = poll
+        self.sync_secs = sync_secs
+        self.lock_fn = os.path.join(state_dir, 'governor.lock')
+        self.state_fn = os.path.join(state_dir, 'governor.json')
+
+    @contextmanager
+    def _state(self):
+        """
+        Yield the shared state, locked, and write it back afterwards
+        """
+        import fcntl
+        if not os.path.exists(self.state_dir):
+            try:
+                os.makedirs(self.state_dir)
+            except OSError:
+                pass  # another worker made it
+        with open(self.lock_fn, 'a') as lock_fh:
+            fcntl.flock(lock_fh.fileno(), fcntl.LOCK_EX)
+            try:
+                state = {}
+                if os.path.exists(self.state_fn):
+                    with open(self.state_fn) as fh:
+                        try:
+                            state = json.load(fh)
+                        except ValueError:
+                            state = {}
+                for direction in DIRECTIONS:
+                    st = state.setdefault(direction, {'tokens': None, 'stamp': time.time(),
+                                                      'active': [], 'waiting': []})
+                    # forget leases and waits of processes that died
+                    st['active'] = [x for x in st['active'] if _pid_alive(x[0])]
+                    st['waiting'] = [x for x in st['waiting'] if _pid_alive(x[0])]
+                yield state
+                tmp_fn = self.state_fn + '.tmp'
+                with open(tmp_fn, 'w') as fh:
+                    json.dump(state, fh)
+                os.rename(tmp_fn, self.state_fn)
+            finally:
+                fcntl.flock(lock_fh.fileno(), fcntl.LOCK_UN)
+
+    def _slot_free(self, st, direction, prio, lease):
+        limit = self.max_transfers.get(direction)
+        if limit is None:
+            return True
+        if any(w[2] < prio for w in st['waiting'] if w[1] != lease):
+            return False
+        if prio == PRIORITIES['low'] and limit > 1:
+            limit -= 1
+        return len(st['active']) < limit
+
+    def acquire(self, direction, priority='normal'):
+        """
+        Block until a transfer slot in the given direction is free, then
+        take it.  Returns a lease to pass to release().
+        """
+        prio = PRIORITIES[priority]
+        lease = '%d.%d' % (os.getpid(), next(_lease_ids))
+        waiting = False
+        while True:
+            with self._state() as state:
+                st = state[direction]
+                if self._slot_free(st, direction, prio, lease):
+                    st['waiting'] = [w for w in st['waiting'] if w[1] != lease]
+                    st['active'].append([os.getpid(), lease, prio])
+                    return lease
+                if not waiting:
+                    st['waiting'].append([os.getpid(), lease, prio])
+                    waiting = True
+            time.sleep(self.poll)
+
+    def release(self, direction, lease):
+        with self._state() as state:
+            st = state[direction]
+            st['active'] = [x for x in st['active'] if x[1] != lease]
+
+    @contextmanager
+    def transfer(self, direction, priority='normal'):
+        lease = self.acquire(direction, priority)
+        try:
+            yield
+        finally:
+            self.release(direction, lease)
+
+    def consume(self, direction, nbytes, priority='normal', wait=True):
+        """
+        Charge nbytes against the direction's bucket, first waiting until it
+        holds enough tokens for a transfer of this priority to proceed
+        (unless not wait).  A charge bigger than the bucket puts it into
+        debt, which later transfers wait out.
+        """
+        rate = self.rates.get(direction)
+        if rate is None or nbytes <= 0:
+            return
+        burst = rate * self.burst_secs
+        floor = self.low_reserve * burst if PRIORITIES[priority] == PRIORITIES['low'] else 0.0
+        while True:
+            with self._state() as state:
+                st = state[direction]
+                now = time.time()
+                tokens = burst if st['tokens'] is None else st['tokens']
+                tokens = min(burst, tokens + rate * max(0.0, now - st['stamp']))
+                st['stamp'] = now
+                if tokens > floor or not wait:
+                    st['tokens'] = tokens - nbytes
+                    return
+                st['tokens'] = tokens
+                delay = (floor - tokens) / rate + self.poll
+            time.sleep(min(delay, 1.0))
+
+    def throttle(self, direction, priority='normal'):
+        """
+        Return a callback that charges each byte count it's called with,
+        suitable for boto3's Callback or download.download's progress.  Call
+        its flush method when the transfer is done.
+        """
+        return Throttle(self, direction, priority)
+
+
+class Throttle(object):
+    """
+    Charges a transfer's bytes to a Governor's bucket in batches: once
+    sync_secs of the rate has built up, or sync_secs has passed, whichever
+    is first.  Between batches a transfer can run ahead of the rate by at
+    most one batch, which the bucket's debt then holds back.
+    """
+
+    def __init__(self, governor, direction, priority='normal'):
+        self.governor = governor
+        self.direction = direction
+        self.priority = priority
+        rate = governor.rates.get(direction)
+        self.batch = None if rate is None else max(64 * 1024, rate * governor.sync_secs)
+        self.pending = 0
+        self.last_sync = time.time()
+        self.lock = threading.Lock()
+
+    def __call__(self, nbytes):
+        if self.batch is None:
+            return
+        with self.lock:
+            self.pending += nbytes
+            if self.pending < self.batch and time.time() - self.last_sync < self.governor.sync_secs:
+                return
+            nbytes, self.pending = self.pending, 0
+            self.last_sync = time.time()
+        self.governor.consume(self.direction, nbytes, self.priority)
+
+    def flush(self):
+        """
+        Charge what's left without waiting; the transfer is already over
+        """
+        with self.lock:
+            nbytes, self.pending = self.pending, 0
+        if nbytes > 0:
+            self.governor.consume(self.direction, nbytes, self.priority, wait=False)
+
+
+def from_ini(cluster_ini, section=None):
+    """
+    Make a Governor from the governor_* options in cluster.ini, or return
+    None if none are set.  Rates are in MB/s.
+    """
+    cfg = RawConfigParser()
+    cfg.read(cluster_ini)
+    if len(cfg.sections()) == 0:
+        return None
+    section = section or cfg.sections()[0]
+    rates, max_transfers = {}, {}
+    for direction, word in [('in', 'ingress'), ('out', 'egress')]:
+        if cfg.has_option(section, 'governor_%s_mbps' % word):
+            rates[direction] = float(cfg.get(section, 'governor_%s_mbps' % word)) * 1024 * 1024
+        if cfg.has_option(section, 'governor_%s_transfers' % word):
+            max_transfers[direction] = int(cfg.get(section, 'governor_%s_transfers' % word))
+    if len(rates) == 0 and len(max_transfers) == 0:
+        return None
+    state_dir = os.path.join(tempfile.gettempdir(), 'recount-governor-%s' % socket.gethostname().split('.')[0])
+    if cfg.has_option(section, 'governor_dir'):
+        state_dir = os.path.expanduser(cfg.get(section, 'governor_dir'))
+    return Governor(state_dir, rates=rates, max_transfers=max_transfers)
+
+
+def test_concurrency_and_priority():
+    import shutil
+    tmpdir = tempfile.mkdtemp()
+    gov = Governor(tmpdir, max_transfers={'out': 2}, poll=0.01)
+    first = gov.acquire('out', 'low')
+    # low priority leaves the last slot for others
+    order = []
+
+    def _take(priority):
+        lease = gov.acquire('out', priority)
+        order.append(priority)
+        gov.release('out', lease)
+
+    t_low = threading.Thread(target=_take, args=('low',))
+    t_low.start()
+    time.sleep(0.1)
+    assert [] == order
+    with gov.transfer('out', 'high'):
+        order.append('high-in')
+    gov.release('out', first)
+    t_low.join()
+    assert ['high-in', 'low'] == order
+    # ingress has its own, unlimited budget
+    with gov.transfer('in', 'low'):
+        pass
+    shutil.rmtree(tmpdir)
+
+
+def test_waiting_high_priority_blocks_low():
+    import shutil
+    tmpdir = tempfile.mkdtemp()
+    gov = Governor(tmpdir, max_transfers={'in': 3}, poll=0.01)
+    with gov._state() as state:
+        state['in']['waiting'].append([os.getpid(), 'other', PRIORITIES['high']])
+        st = state['in']
+        assert not gov._slot_free(st, 'in', PRIORITIES['normal'], 'mine')
+        assert gov._slot_free(st, 'in', PRIORITIES['high'], 'mine')
+    shutil.rmtree(tmpdir)
+
+
+def test_dead_lease_dropped():
+    import shutil
+    tmpdir = tempfile.mkdtemp()
+    gov = Governor(tmpdir, max_transfers={'in': 1}, poll=0.01)
+    with gov._state() as state:
+        state['in']['active'].append([2 ** 22 + 1, 'dead.0', 1])
+    with gov.transfer('in'):
+        pass
+    shutil.rmtree(tmpdir)
+
+
+def test_token_bucket():
+    import shutil
+    tmpdir = tempfile.mkdtemp()
+    gov = Governor(tmpdir, rates={'in': 1000.0}, burst_secs=0.1, poll=0.01)
+    t0 = time.time()
+    for _ in range(3):
+        gov.consume('in', 100)  # the burst, then two refills' worth
+    assert 0.1 <= time.time() - t0 < 2.0
+    shutil.rmtree(tmpdir)
+
+
+def test_throttle_batches():
+    import shutil
+    tmpdir = tempfile.mkdtemp()
+    gov = Governor(tmpdir, rates={'in': 1024.0 * 1024}, sync_secs=10.0)
+    syncs = []
+    consume = gov.consume
+    gov.consume = lambda *args, **kwargs: (syncs.append(args[1]), consume(*args, **kwargs))
+    throttle = gov.throttle('in')
+    for _ in range(100):
+        throttle(128 * 1024)  # 12.5 MB in 100 callbacks
+    assert [10 * 1024 * 1024] == syncs  # one batch of 10 seconds' worth
+    throttle.flush()
+    assert [10 * 1024 * 1024, 2560 * 1024] == syncs
+    shutil.rmtree(tmpdir)
+
+
+def test_from_ini():
+    import shutil
+    tmpdir = tempfile.mkdtemp()
+    ini = os.path.join(tmpdir, 'cluster.ini')
+    with open(ini, 'w') as fh:
+        fh.write('[cluster]\nname = c\n')
+    assert from_ini(ini) is None
+    with open(ini, 'a') as fh:
+        fh.write('governor_ingress_mbps = 100\ngovernor_egress_transfers = 4\ngovernor_dir = %s\n' % tmpdir)
+    gov = from_ini(ini)
+    assert 100 * 1024 * 1024 == gov.rates['in']
+    assert {'out': 4} == gov.max_transfers
+    shutil.rmtree(tmpdir)
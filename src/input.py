@@ -15,9 +15,11 @@ Usage:
   input list-input-set [options] <name>
   input import-json [options] <json-file> <input-set-name>
   input import-text [options] <file> <input-set-name>
+  input add-natural-key [options]
 
 Options:
   --limit <ceiling>        Import at most this many records.
+  --chunk-size <rows>      Rows per bulk insert when importing [default: 10000].
   --profile=<profile>      AWS credentials profile section [default: default].
   --endpoint-url=<url>     Endpoint URL for S3 API.  If not set, uses AWS default.
   --db-ini <ini>           Database ini file [default: ~/.recount/db.ini].
@@ -31,16 +33,20 @@ Options:
 """
 
 from __future__ import print_function
+import io
 import os
 import log
+import time
 import pytest
 import json
+import shutil
 import tempfile
+import itertools
 from docopt import docopt
-from sqlalchemy import Column, ForeignKey, Integer, String, Sequence, Table
+from sqlalchemy import Column, ForeignKey, Index, Integer, MetaData, String, Sequence, Table, func, inspect, text
 from sqlalchemy.orm import relationship
 from base import Base
-from toolbox import session_maker_from_config, openex
+from toolbox import session_maker_from_config, openex, iter_json_array
 
 
 class Input(Base):
@@ -50,6 +56,8 @@ class Input(Base):
     needed input data and the right tools can be run, in the right modes.
     """
     __tablename__ = 'input'
+    # the natural key: importing the same run again reuses its input
+    __table_args__ = (Index('input_natural_key', 'acc_r', 'acc_s', 'url_1', unique=True),)
 
     id = Column(Integer, Sequence('input_id_seq'), primary_key=True)
     acc_r = Column(String(64))        # run accession
@@ -211,13 +219,251 @@ def add_inputs_to_set(set_ids, input_ids, my_session):
     my_session.commit()
 
 
-def import_input_set(name, csv_fn, my_session):
+INPUT_COLUMNS = ['acc_r', 'acc_s', 'url_1', 'url_2', 'url_3',
+                 'checksum_1', 'checksum_2', 'checksum_3', 'retrieval_method']
+
+# most values bound in one IN (...); SQLite allows 999 variables per statement
+IN_BATCH = 500
+
+
+def _batches(items, n=IN_BATCH):
+    items = list(items)
+    for i in range(0, len(items), n):
+        yield items[i:i + n]
+
+
+def _allocate_ids(session, n):
     """
-    Import all the entries from the CSV file into a new InputSet of the given
-    name.
+    Reserve n new Input ids in one round trip from PostgreSQL's
+    input_id_seq, so concurrent imports and ORM inserts can't collide
+    """
+    res = session.execute(text("SELECT nextval('input_id_seq') FROM generate_series(1, :n)"), {'n': n})
+    return [row[0] for row in res]
+
+
+def _number_new_inputs(session, rows):
+    """
+    Without a sequence to draw ids from (e.g. SQLite), leave numbering to
+    the database's autoincrement, so concurrent imports can't pick the same
+    id.  Rows with a NULL in their natural key can't be found again by it,
+    so they're inserted here, one by one, and take the id each insert made.
+    Returns the rest, to be inserted together and their ids read back by
+    natural key.
+    """
+    keyed = []
+    for row in rows:
+        if None in _natural_key(row):
+            row['id'] = session.execute(Input.__table__.insert(), row).inserted_primary_key[0]
+        else:
+            keyed.append(row)
+    return keyed
+
+
+def _can_copy(session):
+    dialect = session.get_bind().dialect
+    return dialect.name == 'postgresql' and dialect.driver == 'psycopg2'
+
+
+def _copy_value(x):
+    """
+    Render a value for PostgreSQL COPY's text format
+    """
+    if x is None:
+        return '\\N'
+    x = str(x)
+    for c, esc in [('\\', '\\\\'), ('\t', '\\t'), ('\n', '\\n'), ('\r', '\\r')]:
+        x = x.replace(c, esc)
+    return x
+
+
+def _copy_rows(session, table_name, columns, rows):
+    """
+    Load rows (dicts) into a table with COPY ... FROM STDIN
+    """
+    buf = io.StringIO(u''.join(u'\t'.join(_copy_value(row[col]) for col in columns) + u'\n' for row in rows))
+    cursor = session.connection().connection.cursor()
+    try:
+        cursor.copy_expert('COPY %s (%s) FROM STDIN' % (table_name, ', '.join(columns)), buf)
+    finally:
+        cursor.close()
+
+
+def _natural_key(row):
+    return row['acc_r'], row['acc_s'], row['url_1']
+
+
+def _lookup_ids(session, keys):
+    """
+    Return a dict mapping those of the given natural keys that are already
+    in the input table to their ids
+    """
+    keys = set(keys)
+    if len(keys) == 0:
+        return {}
+    ids = {}
+    for accs in _batches(set(key[0] for key in keys)):
+        q = session.query(Input.id, Input.acc_r, Input.acc_s, Input.url_1).filter(Input.acc_r.in_(accs))
+        ids.update(((acc_r, acc_s, url_1), input_id) for input_id, acc_r, acc_s, url_1 in q
+                   if (acc_r, acc_s, url_1) in keys)
+    return ids
+
+
+def _insert_new_inputs(session, rows, use_copy):
+    """
+    Insert rows into the input table, skipping any whose natural key another
+    import added in the meantime
+    """
+    dialect = session.get_bind().dialect.name
+    if use_copy:
+        # COPY can't skip conflicts, so stage the rows and insert from there
+        session.execute(text('CREATE TEMP TABLE IF NOT EXISTS input_import (LIKE input) ON COMMIT DELETE ROWS'))
+        columns = ', '.join(['id'] + INPUT_COLUMNS)
+        _copy_rows(session, 'input_import', ['id'] + INPUT_COLUMNS, rows)
+        session.execute(text('INSERT INTO input (%s) SELECT %s FROM input_import ON CONFLICT DO NOTHING' %
+                             (columns, columns)))
+    elif dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+        session.execute(insert(Input.__table__).on_conflict_do_nothing(), rows)
+    elif dialect == 'sqlite':
+        session.execute(Input.__table__.insert().prefix_with('OR IGNORE'), rows)
+    elif dialect == 'mysql':
+        session.execute(Input.__table__.insert().prefix_with('IGNORE'), rows)
+    else:
+        session.execute(Input.__table__.insert(), rows)
+
+
+def bulk_import(rows, set_id, session, chunk_size=10000, limit=None):
+    """
+    Import Inputs, given as an iterable of dicts keyed by INPUT_COLUMNS, into
+    the InputSet with id set_id, keeping their order.  An input whose
+    natural key (acc_r, acc_s, url_1) is already in the table is reused
+    rather than added again, and inputs already in the set aren't added
+    twice, so re-importing an updated list only adds what's new.
+
+    rows is consumed chunk_size at a time, so it can stream from a file of
+    any size.  Each chunk is looked up in one query, gets ids for its new
+    inputs in one query, goes in with COPY (PostgreSQL via psycopg2) or one
+    executemany per table, and is committed.  Returns the number of rows
+    that made new inputs and the number that matched existing ones.
+
+    Other databases number new inputs themselves (see _number_new_inputs),
+    and an input that a concurrent import added at the same moment is
+    counted as new by both.
+    """
+    use_copy = _can_copy(session)
+    assoc_columns = ['input_id', 'input_set_id']
+    if limit is not None:
+        rows = itertools.islice(rows, int(limit))
+    n_new, n_existing, n_added, t0 = 0, 0, 0, time.time()
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if len(chunk) == 0:
+            break
+        # keys with a NULL never collide, so those rows are always new
+        keyed = [row for row in chunk if None not in _natural_key(row)]
+        existing = _lookup_ids(session, map(_natural_key, keyed))
+        new_rows, seen = [], set()
+        for row in chunk:
+            key = _natural_key(row)
+            if None in key:
+                new_rows.append(row)
+            elif key not in existing and key not in seen:
+                seen.add(key)
+                new_rows.append(row)
+        to_insert = new_rows
+        if session.get_bind().dialect.name == 'postgresql':
+            for row, input_id in zip(new_rows, _allocate_ids(session, len(new_rows))):
+                row['id'] = input_id
+        else:
+            to_insert = _number_new_inputs(session, new_rows)
+        if len(to_insert) > 0:
+            _insert_new_inputs(session, to_insert, use_copy)
+        # pick up the ids the database gave our rows, or of rows a
+        # concurrent import got in first
+        resolved = dict(existing)
+        resolved.update(_lookup_ids(session, seen))
+        for row in to_insert:
+            row.setdefault('id', resolved[_natural_key(row)])
+        ids = []
+        for row in chunk:
+            key = _natural_key(row)
+            ids.append(row['id'] if None in key else resolved[key])
+            if ids[-1] == row.get('id'):
+                n_new += 1
+            else:
+                n_existing += 1
+        in_set = set()
+        for batch in _batches(set(ids)):
+            in_set.update(input_id for (input_id,) in
+                          session.query(input_association_table.c.input_id).filter(
+                              input_association_table.c.input_set_id == set_id,
+                              input_association_table.c.input_id.in_(batch)))
+        assocs = []
+        for input_id in ids:
+            if input_id not in in_set:
+                in_set.add(input_id)
+                assocs.append({'input_id': input_id, 'input_set_id': set_id})
+        if len(assocs) > 0:
+            if use_copy:
+                _copy_rows(session, input_association_table.name, assoc_columns, assocs)
+            else:
+                session.execute(input_association_table.insert(), assocs)
+        session.commit()
+        n_added += len(assocs)
+        elapsed = time.time() - t0
+        log.info('Imported %d new and %d existing inputs, %d added to set %d (%0.1f rows/sec)' %
+                 (n_new, n_existing, n_added, set_id,
+                  (n_new + n_existing) / elapsed if elapsed > 0 else 0.0), 'input.py')
+    return n_new, n_existing
+
+
+def add_natural_key(session):
+    """
+    Bring a database made before the input_natural_key index up to date:
+    merge inputs that share a natural key into the one with the lowest id,
+    pointing every reference to the others (input set memberships and the
+    tables that record jobs) at it, then create the unique index.  Returns
+    the number of duplicate inputs removed; does nothing if the index is
+    already there.
+    """
+    bind = session.connection()
+    if 'input_natural_key' in [ix['name'] for ix in inspect(bind).get_indexes('input')]:
+        return 0
+    meta = MetaData()
+    meta.reflect(bind=bind)
+    refs = [(table, fk.parent) for table in meta.sorted_tables for fk in table.foreign_keys
+            if fk.column.table.name == 'input' and table.name != input_association_table.name]
+    assoc = input_association_table
+    groups = session.query(func.min(Input.id), Input.acc_r, Input.acc_s, Input.url_1).filter(
+        Input.acc_r.isnot(None), Input.acc_s.isnot(None), Input.url_1.isnot(None)).group_by(
+        Input.acc_r, Input.acc_s, Input.url_1).having(func.count(Input.id) > 1).all()
+    n_removed = 0
+    for keep_id, acc_r, acc_s, url_1 in groups:
+        dup_ids = [input_id for (input_id,) in session.query(Input.id).filter(
+            Input.acc_r == acc_r, Input.acc_s == acc_s, Input.url_1 == url_1, Input.id != keep_id)]
+        for dup_id in dup_ids:
+            # a set holding both keeps only the survivor
+            keep_sets = [set_id for (set_id,) in
+                         session.query(assoc.c.input_set_id).filter(assoc.c.input_id == keep_id)]
+            for batch in _batches(keep_sets):
+                session.execute(assoc.delete().where(assoc.c.input_id == dup_id).where(
+                    assoc.c.input_set_id.in_(batch)))
+            session.execute(assoc.update().where(assoc.c.input_id == dup_id).values(input_id=keep_id))
+            for table, col in refs:
+                session.execute(table.update().where(col == dup_id).values({col.name: keep_id}))
+            session.execute(Input.__table__.delete().where(Input.id == dup_id))
+            n_removed += 1
+    [ix for ix in Input.__table__.indexes if ix.name == 'input_natural_key'][0].create(bind)
+    session.commit()
+    log.info('Removed %d duplicate inputs in %d groups and created input_natural_key' %
+             (n_removed, len(groups)), 'input.py')
+    return n_removed
+
+
+def _csv_rows(csv_fn):
+    """
+    Yield a dict of Input columns for each line of a 9-column CSV file
     """
-    input_set = InputSet(name=name)
-    n_added_input = 0
     with open(csv_fn, 'r') as csv_fh:
         for ln in csv_fh:
             ln = ln.rstrip()
@@ -227,17 +473,18 @@ def import_input_set(name, csv_fn, my_session):
             if len(toks) != 9:
                 raise ValueError('Line did not have 9 tokens: "%s"' % ln)
             toks = list(map(lambda x: None if x == 'NA' else x, toks))
-            acc_r, acc_s, url_1, url_2, url_3, checksum_1, checksum_2, checksum_3, retrieval_method = toks
-            input = Input(acc_r=acc_r, acc_s=acc_s, url_1=url_1, url_2=url_2, url_3=url_3,
-                          checksum_1=checksum_1, checksum_2=checksum_2, checksum_3=checksum_3,
-                          retrieval_method=retrieval_method)
-            my_session.add(input)
-            input_set.inputs.append(input)
-            n_added_input += 1
-    log.info('Imported %d items from input set' % len(input_set.inputs), 'input.py')
-    my_session.add(input_set)
-    my_session.commit()
-    return input_set.id, n_added_input
+            yield dict(zip(INPUT_COLUMNS, toks))
+
+
+def import_input_set(name, csv_fn, my_session, chunk_size=10000):
+    """
+    Import all the entries from the CSV file into a new InputSet of the given
+    name.
+    """
+    set_id = add_input_set(name, my_session)
+    n_new, n_existing = bulk_import(_csv_rows(csv_fn), set_id, my_session, chunk_size=chunk_size)
+    log.info('Imported %d items from input set' % (n_new + n_existing), 'input.py')
+    return set_id, n_new + n_existing
 
 
 def input_set_from_name(input_set_name, session, caller_name):
@@ -253,68 +500,64 @@ def input_set_from_name(input_set_name, session, caller_name):
     return set_id
 
 
-def import_text(fn, input_set_name, session, limit=None):
+def _text_rows(fh):
+    """
+    Yield a dict of Input columns for each record in a whitespace-separated
+    text file: study accession, run accession, then optionally a retrieval
+    method and ;-separated URLs
+    """
+    for ln in fh:
+        ln = ln.rstrip()
+        if len(ln) == 0:
+            continue
+        if ln[0] == '#':
+            continue
+
+        # This file is whitespace-separated, which contrasts with the
+        # comma-separated string that is ultimately passed to the Snakefile
+        toks = ln.split()
+        retrieval_method = 'sra'
+        assert 2 <= len(toks) <= 4, str(toks)
+        acc_s, acc_r = toks[0], toks[1]
+        url_1 = acc_r
+        url_2, url_3 = None, None
+
+        # Get retrieval method
+        if len(toks) >= 3:
+            retrieval_method = toks[2]
+
+        # Sort out the URL tokens
+        if len(toks) >= 4:
+            urls = toks[3]
+            url_toks = urls.split(';')
+            if len(url_toks) > 3:
+                raise ValueError('More than three ;-separated URL tokens: "%s"' % urls)
+            url_1 = url_toks[0]
+            if len(url_toks) > 1:
+                url_2 = url_toks[1]
+            if len(url_toks) > 2:
+                url_3 = url_toks[2]
+        yield {'acc_r': acc_r, 'acc_s': acc_s,
+               'url_1': url_1, 'url_2': url_2, 'url_3': url_3,
+               'checksum_1': None, 'checksum_2': None, 'checksum_3': None,
+               'retrieval_method': retrieval_method}
+
+
+def import_text(fn, input_set_name, session, limit=None, chunk_size=10000):
     log.info('Loading metadata from text file "%s"' % fn, 'input.py')
     if not os.path.exists(fn):
         raise RuntimeError('No such text file as "%s"' % fn)
-    inputs = []
-    with openex(fn) as fh:
-        for ln in fh:
-            ln = ln.rstrip()
-            if len(ln) == 0:
-                continue
-            if ln[0] == '#':
-                continue
-
-            # This file is whitespace-separated, which contrasts with the
-            # comma-separated string that is ultimately passed to the Snakefile
-            toks = ln.split()
-            retrieval_method = 'sra'
-            assert 2 <= len(toks) <= 4, str(toks)
-            acc_s, acc_r = toks[0], toks[1]
-            url_1 = acc_r
-            url_2, url_3 = None, None
-
-            # Get retrieval method
-            if len(toks) >= 3:
-                retrieval_method = toks[2]
-
-            # Sort out the URL tokens
-            if len(toks) >= 4:
-                urls = toks[3]
-                url_toks = urls.split(';')
-                if len(url_toks) > 3:
-                    raise ValueError('More than three ;-separated URL tokens: "%s"' % urls)
-                url_1 = url_toks[0]
-                if len(url_toks) > 1:
-                    url_2 = url_toks[1]
-                if len(url_toks) > 2:
-                    url_3 = url_toks[2]
-            inp = Input(acc_r=acc_r, acc_s=acc_s,
-                        url_1=url_1, url_2=url_2, url_3=url_3,
-                        checksum_1=None, checksum_2=None, checksum_3=None,
-                        retrieval_method=retrieval_method)
-            inputs.append(inp)
-            if limit is not None and len(inputs) >= int(limit):
-                break
-    session.add_all(inputs)
-    session.commit()
     set_id = input_set_from_name(input_set_name, session, 'import_text')
-    add_inputs_to_set([set_id] * len(inputs),
-                      list(map(lambda x: x.id, inputs)),
-                      session)
+    with openex(fn) as fh:
+        bulk_import(_text_rows(fh), set_id, session, chunk_size=chunk_size, limit=limit)
     return set_id
 
 
-def import_json(json_fn, input_set_name, session, limit=None):
-    log.info('Loading metadata from json file "%s"' % json_fn, 'input.py')
-    if not os.path.exists(json_fn):
-        raise RuntimeError('No such json file as "%s"' % json_fn)
-    js = json.load(openex(json_fn))
-    inputs = []
-    if len(js) == 0:
-        raise ValueError('Attempt to import from empty JSON file: "%s"' % json_fn)
-    for rec in js:
+def _json_rows(records):
+    """
+    Yield a dict of Input columns for each sradbv2 hit record
+    """
+    for rec in records:
         assert '_id' in rec
         assert '_source' in rec
         if 'study' in rec['_source']:
@@ -327,19 +570,24 @@ def import_json(json_fn, input_set_name, session, limit=None):
             assert 'study_accession' in rec['_source']
             acc_r = rec['_id']
             acc_s = rec['_source']['study_accession']
-        inp = Input(acc_r=acc_r, acc_s=acc_s,
-                    url_1=acc_r, url_2=None, url_3=None,
-                    checksum_1=None, checksum_2=None, checksum_3=None,
-                    retrieval_method='sra')
-        inputs.append(inp)
-        session.add(inp)
-        if limit is not None and len(inputs) >= int(limit):
-            break
-    session.commit()
-    set_id = input_set_from_name(input_set_name, session, 'import_text')
-    add_inputs_to_set([set_id] * len(inputs),
-                      list(map(lambda x: x.id, inputs)),
-                      session)
+        yield {'acc_r': acc_r, 'acc_s': acc_s,
+               'url_1': acc_r, 'url_2': None, 'url_3': None,
+               'checksum_1': None, 'checksum_2': None, 'checksum_3': None,
+               'retrieval_method': 'sra'}
+
+
+def import_json(json_fn, input_set_name, session, limit=None, chunk_size=10000):
+    log.info('Loading metadata from json file "%s"' % json_fn, 'input.py')
+    if not os.path.exists(json_fn):
+        raise RuntimeError('No such json file as "%s"' % json_fn)
+    with openex(json_fn) as fh:
+        records = iter_json_array(fh)
+        first = next(records, None)
+        if first is None:
+            raise ValueError('Attempt to import from empty JSON file: "%s"' % json_fn)
+        set_id = input_set_from_name(input_set_name, session, 'import_json')
+        bulk_import(_json_rows(itertools.chain([first], records)), set_id, session,
+                    chunk_size=chunk_size, limit=limit)
     return set_id
 
 
@@ -444,6 +692,107 @@ def test_import_json_2(session):
     assert 'SRR123456' == iset.inputs[3].acc_r
 
 
+def test_import_json_gz(session):
+    import gzip
+    tmpdir = tempfile.mkdtemp()
+    json_fn = os.path.join(tmpdir, 'import.json.gz')
+    with gzip.open(json_fn, 'wt') as fh:
+        fh.write('[' + ','.join('{"_id": "SRR%d", "_source": {"study_accession": "SRP1"}}' % i
+                                for i in range(25)) + ']')
+    iset_id = import_json(json_fn, 'iset1', session, limit=20, chunk_size=7)
+    iset = session.query(InputSet).get(iset_id)
+    assert ['SRR%d' % i for i in range(20)] == [inp.acc_r for inp in iset.inputs]
+    with gzip.open(json_fn, 'wt') as fh:
+        fh.write('[ ]')
+    with pytest.raises(ValueError):
+        import_json(json_fn, 'iset2', session)
+    assert 0 == session.query(InputSet).filter_by(name='iset2').count()
+    shutil.rmtree(tmpdir)
+
+
+def test_import_text_chunks(session):
+    tmpdir = tempfile.mkdtemp()
+    text_fn = os.path.join(tmpdir, 'import.txt')
+    with open(text_fn, 'w') as fh:
+        fh.write('# study run method urls\n')
+        for i in range(7):
+            fh.write('SRP%d SRR%d\n' % (i // 3, i))
+        fh.write('SRP9 SRR9 url http://a/1.fq;http://a/2.fq\n')
+    iset_id = import_text(text_fn, 'iset1', session, chunk_size=3)
+    iset = session.query(InputSet).get(iset_id)
+    assert ['SRR%d' % i for i in list(range(7)) + [9]] == [inp.acc_r for inp in iset.inputs]
+    assert 'http://a/2.fq' == iset.inputs[-1].url_2
+    assert 'sra' == iset.inputs[0].retrieval_method
+    # re-importing an updated list reuses existing inputs and adds new ones
+    with open(text_fn, 'a') as fh:
+        fh.write('SRP9 SRR10\nSRP9 SRR10\n')
+    other_id = input_set_from_name('iset2', session, 'test')
+    assert (0, 2) == bulk_import(_text_rows(['SRP0 SRR0', 'SRP0 SRR1']), other_id, session)
+    assert (1, 9) == bulk_import(_text_rows(open(text_fn)), iset_id, session, chunk_size=3)
+    session.expire_all()
+    iset = session.query(InputSet).get(iset_id)
+    assert ['SRR%d' % i for i in list(range(7)) + [9, 10]] == [inp.acc_r for inp in iset.inputs]
+    assert 9 == session.query(Input).count()
+    assert 11 == session.query(input_association_table).count()
+    shutil.rmtree(tmpdir)
+
+
+def test_import_big_chunk(session):
+    # more keys than SQLite allows variables in one statement
+    n = 3 * IN_BATCH
+    lines = ['SRP0 SRR%d' % i for i in range(n)]
+    set_id = input_set_from_name('iset1', session, 'test')
+    assert (n, 0) == bulk_import(_text_rows(lines), set_id, session, chunk_size=n)
+    assert (0, n) == bulk_import(_text_rows(lines), set_id, session, chunk_size=n)
+    assert n == session.query(input_association_table).count()
+
+
+def test_import_concurrent_ids(session, monkeypatch):
+    import sys
+    this = sys.modules[__name__]
+    insert_new = this._insert_new_inputs
+
+    def _racing_insert(session, rows, use_copy):
+        # another import takes the next id, for a different input, first
+        session.add(Input(acc_r='SRR99', acc_s='SRP9', url_1='SRR99', retrieval_method='sra'))
+        session.flush()
+        insert_new(session, rows, use_copy)
+
+    set_id = input_set_from_name('iset1', session, 'test')
+    assert (1, 0) == bulk_import(_text_rows(['SRP0 SRR0']), set_id, session)
+    monkeypatch.setattr(this, '_insert_new_inputs', _racing_insert)
+    rows = list(_text_rows(['SRP0 SRR1', 'SRP0 SRR2']))
+    rows.append(dict(rows[0], acc_r=None))
+    assert (3, 0) == bulk_import(iter(rows), set_id, session)
+    session.expire_all()
+    assert 5 == session.query(Input).count()
+    assert ['SRR0', 'SRR1', 'SRR2', None] == [inp.acc_r for inp in session.query(InputSet).get(set_id).inputs]
+
+
+def test_add_natural_key(session):
+    session.execute(text('DROP INDEX input_natural_key'))
+    for i in range(3):
+        session.add(Input(acc_r='SRR1', acc_s='SRP1', url_1='u', retrieval_method='sra'))
+    session.add(Input(acc_r='SRR2', acc_s='SRP1', url_1=None))
+    session.add(Input(acc_r='SRR2', acc_s='SRP1', url_1=None))
+    session.commit()
+    ids = sorted(inp.id for inp in session.query(Input).filter_by(acc_r='SRR1'))
+    set1 = input_set_from_name('iset1', session, 'test')
+    set2 = input_set_from_name('iset2', session, 'test')
+    add_inputs_to_set([set1, set1, set2], [ids[0], ids[1], ids[2]], session)
+    assert 2 == add_natural_key(session)
+    assert [ids[0]] == [inp.id for inp in session.query(Input).filter_by(acc_r='SRR1')]
+    assert 2 == session.query(Input).filter_by(acc_r='SRR2').count()  # NULLs never collide
+    assert [(ids[0], set1), (ids[0], set2)] == sorted(session.query(input_association_table))
+    assert 0 == add_natural_key(session)
+
+
+def test_copy_value():
+    assert '\\N' == _copy_value(None)
+    assert 'a\\tb\\\\c' == _copy_value('a\tb\\c')
+    assert '3' == _copy_value(3)
+
+
 def test_job_string1():
     inp1 = Input(id=1, acc_r='SRR123', acc_s='SRP123', retrieval_method="web",
                  url_1='url1', checksum_1='checksum1')
@@ -503,11 +852,16 @@ def go():
         elif args['import-json']:
             session_mk = session_maker_from_config(db_ini, args['--db-section'])
             print(import_json(args['<json-file>'], args['<input-set-name>'],
-                              session_mk(), limit=args['--limit']))
+                              session_mk(), limit=args['--limit'],
+                              chunk_size=int(args['--chunk-size'])))
         elif args['import-text']:
             session_mk = session_maker_from_config(db_ini, args['--db-section'])
             print(import_text(args['<file>'], args['<input-set-name>'],
-                              session_mk(), limit=args['--limit']))
+                              session_mk(), limit=args['--limit'],
+                              chunk_size=int(args['--chunk-size'])))
+        elif args['add-natural-key']:
+            session_mk = session_maker_from_config(db_ini, args['--db-section'])
+            print(add_natural_key(session_mk()))
     except Exception:
         log.error('Uncaught exception:', 'input.py')
         raise
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+
+# Author: Ben Langmead <ben.langmead@gmail.com>
+# License: MIT
+
+"""
+instance.py
+
+A long-lived container per worker, so that jobs don't each pay for
+mounting the image, conda activation and /startup.sh.  A Singularity
+instance (or a detached Docker container) is started with the reference,
+input, output and temp base directories bound at their host paths; each job
+is then an exec into it, with its own subdirectories passed via the usual
+RECOUNT_* environment variables.  The instance is recycled after a set
+number of jobs, after any failed job, or if the image or binds change.
+
+Each worker is its own process and runs one job at a time, so one instance
+per process is tracked in a module global.
+"""
+
+import os
+import socket
+import subprocess
+
+_current = None
+
+
+class ContainerInstance(object):
+
+    def __init__(self, system, image, binds, sudo=False, max_jobs=0, name=None):
+        """
+        binds is a list of (host, container) directory pairs.  max_jobs of 0
+        means no limit.
+        """
+        self.system = system
+        self.image = image
+        self.binds = sorted(binds)
+        self.sudo = sudo
+        self.max_jobs = max_jobs
+        self.name = name or 'recount-%s-%d' % (socket.gethostname().split('.')[0], os.getpid())
+        self.jobs = 0
+        self.running = False
+
+    def _bind_args(self):
+        args = []
+        for host, cont in self.binds:
+            args.append('-v' if self.system == 'docker' else '-B')
+            args.append('%s:%s' % (host, cont))
+        return ' '.join(args)
+
+    def _docker(self):
+        return 'sudo docker' if self.sudo else 'docker'
+
+    def start_command(self):
+        if self.system == 'docker':
+            return '%s run -d --rm --name %s %s --entrypoint /bin/sleep %s infinity' % \
+                   (self._docker(), self.name, self._bind_args(), self.image)
+        return 'singularity instance start %s %s %s' % (self._bind_args(), self.image, self.name)
+
+    def setup_command(self):
+        """
+        Things to do once per instance rather than once per job.
+        """
+        return self.exec_command([], '/bin/bash -c "source activate recount && /startup.sh"')
+
+    def exec_command(self, cmd_env, cmd_run):
+        if self.system == 'docker':
+            env = ' '.join(['-e ' + x for x in cmd_env])
+            return '%s exec %s %s %s' % (self._docker(), env, self.name, cmd_run)
+        env = ' '.join(['SINGULARITYENV_' + x for x in cmd_env])
+        return '%s singularity exec instance://%s %s' % (env, self.name, cmd_run)
+
+    def stop_command(self):
+        if self.system == 'docker':
+            return '%s rm -f %s' % (self._docker(), self.name)
+        return 'singularity instance stop %s' % self.name
+
+    def start(self, logger=None):
+        for cmd in [self.start_command(), self.setup_command()]:
+            logger is None or logger('instance command: ' + cmd)
+            ret = subprocess.call(cmd, shell=True)
+            if ret != 0:
+                self.stop(logger=logger)
+                raise RuntimeError('Command "%s" returned exitlevel %d' % (cmd, ret))
+        self.running = True
+
+    def stop(self, logger=None):
+        cmd = self.stop_command()
+        logger is None or logger('instance command: ' + cmd)
+        with open(os.devnull, 'w') as devnull:
+            subprocess.call(cmd, shell=True, stdout=devnull, stderr=devnull)
+        self.running = False
+
+    def compatible(self, system, image, binds, sudo):
+        return self.system == system and self.image == image and \
+            self.binds == sorted(binds) and self.sudo == sudo
+
+    def exhausted(self):
+        return self.max_jobs > 0 and self.jobs >= self.max_jobs
+
+
+def acquire(system, image, binds, sudo=False, max_jobs=0, logger=None):
+    """
+    Return this process's running instance, starting a new one if there is
+    none, or if the current one is used up or was started differently.
+    """
+    global _current
+    if _current is not None and (not _current.compatible(system, image, binds, sudo) or _current.exhausted()):
+        logger is None or logger('Recycling container instance %s after %d jobs' % (_current.name, _current.jobs))
+        _current.stop(logger=logger)
+        _current = None
+    if _current is None:
+        inst = ContainerInstance(system, image, binds, sudo=sudo, max_jobs=max_jobs)
+        logger is None or logger('Starting container instance %s' % inst.name)
+        inst.start(logger=logger)
+        _current = inst
+    return _current
+
+
+def job_finished(succeeded, logger=None):
+    """
+    Count a job against the current instance.  An instance is not trusted
+    after a failure, so it is stopped and the next job gets a fresh one.
+    """
+    global _current
+    if _current is None:
+        return
+    _current.jobs += 1
+    if not succeeded:
+        logger is None or logger('Stopping container instance %s after failed job' % _current.name)
+        _current.stop(logger=logger)
+        _current = None
+
+
+def shutdown(logger=None):
+    global _current
+    if _current is not None:
+        _current.stop(logger=logger)
+        _current = None
+
+
+def test_commands_singularity():
+    inst = ContainerInstance('singularity', '/images/rs5.sif', [('/out', '/out'), ('/refs', '/container-mounts/ref')],
+                             name='recount-test')
+    assert 'singularity instance start -B /out:/out -B /refs:/container-mounts/ref /images/rs5.sif recount-test' \
+           == inst.start_command()
+    assert 'SINGULARITYENV_RECOUNT_CPUS=4 singularity exec instance://recount-test /workflow.bash' \
+           == inst.exec_command(['RECOUNT_CPUS=4'], '/workflow.bash')
+    assert 'singularity instance stop recount-test' == inst.stop_command()
+
+
+def test_commands_docker():
+    inst = ContainerInstance('docker', 'quay.io/x/rs5:1.0', [('/out', '/out')], sudo=True, name='recount-test')
+    assert 'sudo docker run -d --rm --name recount-test -v /out:/out --entrypoint /bin/sleep quay.io/x/rs5:1.0 infinity' \
+           == inst.start_command()
+    assert 'sudo docker exec -e RECOUNT_CPUS=4 recount-test /workflow.bash' \
+           == inst.exec_command(['RECOUNT_CPUS=4'], '/workflow.bash')
+
+
+def test_recycle():
+    binds = [('/a', '/a'), ('/b', '/b')]
+    inst = ContainerInstance('docker', 'img', binds, max_jobs=2)
+    assert inst.compatible('docker', 'img', list(reversed(binds)), False)
+    assert not inst.compatible('docker', 'img2', binds, False)
+    assert not inst.exhausted()
+    inst.jobs = 2
+    assert inst.exhausted()
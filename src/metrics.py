@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+
+# Author: Ben Langmead <ben.langmead@gmail.com>
+# License: MIT
+
+"""
+metrics.py
+
+A channel for counters and timings from the container that doesn't go
+through its stdout.  run_job makes a named pipe in the job's temp directory
+and advertises its in-container path as RECOUNT_METRICS.  The workflow
+writes one event per line:
+
+    count <name> <value>
+    time <name> <seconds>
+
+e.g. from a Snakemake shell block:
+
+    [[ -p "$RECOUNT_METRICS" ]] && echo "time AlignBamSort 12.5" > $RECOUNT_METRICS
+
+Lines shorter than PIPE_BUF are written atomically, so concurrent rules may
+share the pipe.  The worker aggregates events per job into Metric objects
+(count, total, min, max and a log2 histogram) and flushes them once, when
+the job ends.
+"""
+
+import os
+import math
+import json
+import select
+import tempfile
+import threading
+import shutil
+
+METRICS_FIFO = 'metrics.fifo'
+
+
+class Metric(object):
+
+    def __init__(self, name, kind):
+        self.name = name
+        self.kind = kind
+        self.count = 0
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = None
+        self.histogram = {}
+
+    @staticmethod
+    def bucket(value):
+        """
+        Histogram bucket for value: b such that 2^(b-1) < value <= 2^b, or
+        None for values <= 0
+        """
+        if value <= 0:
+            return None
+        return int(math.ceil(math.log(value, 2) - 1e-9))
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.minimum = value if self.minimum is None else min(self.minimum, value)
+        self.maximum = value if self.maximum is None else max(self.maximum, value)
+        b = self.bucket(value)
+        key = 'le0' if b is None else str(b)
+        self.histogram[key] = self.histogram.get(key, 0) + 1
+
+    def percentile(self, pct):
+        """
+        Upper bound on the given percentile, from the histogram
+        """
+        if self.count == 0:
+            return None
+        target = pct / 100.0 * self.count
+        seen = self.histogram.get('le0', 0)
+        if seen >= target:
+            return 0.0
+        for b in sorted(int(k) for k in self.histogram.keys() if k != 'le0'):
+            seen += self.histogram[str(b)]
+            if seen >= target:
+                return min(2.0 ** b, self.maximum)
+        return self.maximum
+
+    def summary(self):
+        return '%s %s n=%d total=%0.3f min=%0.3f max=%0.3f p50<=%0.3f p90<=%0.3f' % \
+               (self.kind, self.name, self.count, self.total, self.minimum, self.maximum,
+                self.percentile(50), self.percentile(90))
+
+    def histogram_json(self):
+        return json.dumps(self.histogram, sort_keys=True)
+
+
+class JobMetrics(object):
+    """
+    All the metrics reported by one job
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self.bad_lines = 0
+
+    def add_line(self, line):
+        toks = line.split()
+        if len(toks) != 3 or toks[0] not in ['count', 'time']:
+            self.bad_lines += 1
+            return
+        kind, name, value = toks
+        try:
+            value = float(value)
+        except ValueError:
+            self.bad_lines += 1
+            return
+        self.add(kind, name, value)
+
+    def add(self, kind, name, value):
+        key = (kind, name)
+        if key not in self.metrics:
+            self.metrics[key] = Metric(name, kind)
+        self.metrics[key].add(value)
+
+    def __iter__(self):
+        for key in sorted(self.metrics.keys()):
+            yield self.metrics[key]
+
+    def __len__(self):
+        return len(self.metrics)
+
+
+class MetricsReader(threading.Thread):
+    """
+    Makes the named pipe and aggregates the events written to it until
+    finish() is called.  We hold the pipe open for writing ourselves so that
+    the read end doesn't see end-of-file each time a writer closes it.
+    """
+
+    def __init__(self, dirname, read_size=65536):
+        super(MetricsReader, self).__init__()
+        self.path = os.path.join(dirname, METRICS_FIFO)
+        os.mkfifo(self.path, 0o600)
+        self.rfd = os.open(self.path, os.O_RDONLY | os.O_NONBLOCK)
+        self.wfd = os.open(self.path, os.O_WRONLY)
+        self.read_size = read_size
+        self.job_metrics = JobMetrics()
+        self.stopping = False
+        self.daemon = True
+
+    def _consume(self, partial, buf):
+        lines = (partial + buf).split(b'\n')
+        for line in lines[:-1]:
+            if len(line.strip()) > 0:
+                self.job_metrics.add_line(line.decode('utf-8', 'replace'))
+        return lines[-1]
+
+    def run(self):
+        partial = b''
+        while True:
+            readable, _, _ = select.select([self.rfd], [], [], 0.5)
+            if len(readable) > 0:
+                partial = self._consume(partial, os.read(self.rfd, self.read_size))
+            elif self.stopping:
+                break
+        if len(partial.strip()) > 0:
+            self.job_metrics.add_line(partial.decode('utf-8', 'replace'))
+        os.close(self.rfd)
+        os.close(self.wfd)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def finish(self):
+        """
+        Stop once everything written so far is read; return the JobMetrics
+        """
+        self.stopping = True
+        self.join()
+        return self.job_metrics
+
+
+def test_metric():
+    m = Metric('Align', 'time')
+    for v in [1.0, 3.0, 3.5, 100.0]:
+        m.add(v)
+    assert 4 == m.count
+    assert 107.5 == m.total
+    assert 1.0 == m.minimum
+    assert 100.0 == m.maximum
+    assert {'0': 1, '2': 2, '7': 1} == m.histogram
+    assert 4.0 == m.percentile(50)
+    assert 100.0 == m.percentile(90)
+
+
+def test_job_metrics():
+    jm = JobMetrics()
+    jm.add_line('count AlignComplete 1')
+    jm.add_line('count AlignComplete 1')
+    jm.add_line('time Align 12.5')
+    jm.add_line('garbage')
+    jm.add_line('time Align twelve')
+    assert 2 == len(jm)
+    assert 2 == jm.bad_lines
+    assert ['AlignComplete', 'Align'] == [m.name for m in jm]
+    assert 2.0 == [m for m in jm][0].total
+
+
+def test_metrics_reader():
+    tmpdir = tempfile.mkdtemp()
+    reader = MetricsReader(tmpdir)
+    reader.start()
+    for i in range(3):
+        with open(os.path.join(tmpdir, METRICS_FIFO), 'w') as fh:
+            fh.write('time Sort %d\n' % (i + 1))
+    jm = reader.finish()
+    assert 1 == len(jm)
+    assert 6.0 == [m for m in jm][0].total
+    assert not os.path.exists(os.path.join(tmpdir, METRICS_FIFO))
+    shutil.rmtree(tmpdir)
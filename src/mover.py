@@ -7,6 +7,7 @@ Usage:
   mover put <source> <dest> [options]
   mover multi <source> <dest> <file>... [options]
   mover exists <file> [options]
+  mover report <transfer-log>... [options]
   mover nop
 
 Options:
@@ -37,15 +38,23 @@ import shutil
 from docopt import docopt
 import subprocess
 from functools import wraps
+from contextlib import contextmanager
+import transfers
+from transfers import TransferRecord, TransferStats, TransferCancelled, endpoint_of, append_log
 import threading
 import sys
 import log
+import download
 import boto3
+from boto3.s3.transfer import TransferConfig
+from staging import link_or_copy, link_or_copy_with_digest, HashingReader
 import botocore
 if sys.version[:1] == '2':
     from ConfigParser import RawConfigParser
+    from Queue import Queue, Empty
 else:
     from configparser import RawConfigParser
+    from queue import Queue, Empty
 
 """
 mover.py
@@ -103,6 +112,8 @@ def retry(exception_class, tries=4, delay=3, backoff=2, logger=None):
                 try:
                     return f(*args, **kwargs)
                 except exception_class as e:
+                    rec = transfers.current()
+                    rec is None or rec.retry()
                     msg = '%s, Retrying in %d seconds...' % (str(e), mdelay)
                     if logger is not None:
                         logger(msg)
@@ -147,11 +158,59 @@ def parse_s3_url(url):
     return url[start_index:next_slash], url[next_slash+1:], url[last_slash+1:]
 
 
+def parallel_apply(func, items, nthreads):
+    """
+    Call func on each item using up to nthreads threads.  If any call
+    raises, the first exception is re-raised once all threads are done.
+    """
+    if nthreads <= 1 or len(items) <= 1:
+        for item in items:
+            func(item)
+        return
+    work = Queue()
+    for item in items:
+        work.put(item)
+    errors = []
+
+    def _worker():
+        while len(errors) == 0:
+            try:
+                item = work.get_nowait()
+            except Empty:
+                break
+            try:
+                func(item)
+            except Exception as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=_worker) for _ in range(min(nthreads, len(items)))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if len(errors) > 0:
+        raise errors[0]
+
+
 class S3Mover(object):
 
-    def __init__(self, profile=None, endpoint_url=None):
+    def __init__(self, profile=None, endpoint_url=None, transfer=None):
+        """
+        transfer is a dictionary as returned by parse_s3_transfer_ini,
+        governing multipart part size and upload concurrency.
+        """
+        if transfer is None:
+            transfer = S3_TRANSFER_DEFAULTS
         self.session = boto3.Session(profile_name=profile)
         self.s3 = self.session.resource('s3', endpoint_url=endpoint_url)
+        # unlike resources, clients can be shared between threads
+        self.client = self.session.client('s3', endpoint_url=endpoint_url)
+        mb = 1024 * 1024
+        self.transfer_config = TransferConfig(
+            multipart_threshold=transfer['multipart_threshold_mb'] * mb,
+            multipart_chunksize=transfer['multipart_chunksize_mb'] * mb,
+            max_concurrency=transfer['max_concurrency'])
+        self.file_concurrency = transfer['file_concurrency']
 
     def close(self):
         pass
@@ -170,19 +229,37 @@ class S3Mover(object):
     def make_bucket(self, bucket):
         self.s3.create_bucket(Bucket=bucket).wait_until_exists()
 
-    def put(self, source, destination, logger=None):
+    def put(self, source, destination, logger=None, digest=False, callback=None):
+        """
+        Upload with a managed transfer, which switches to a parallel
+        multipart upload for files over the multipart threshold and so is
+        not subject to the 5 GB limit on a single PUT.  If digest is True,
+        (size, MD5 hex digest) is returned, computed as the file is read for
+        the upload.  The transfer manager reads parts from the (seekable)
+        file object in order, so the file is read once, and it holds at
+        most its max_in_memory_upload_chunks parts (10 by default) in
+        memory at a time.  Without digest, upload_file reads parts straight
+        from the file.  callback, if given, is called with byte counts as
+        the upload progresses.
+        """
         if source.startswith('local://'):
             source = source[len('local://'):]
         if not os.path.exists(source):
             raise RuntimeError('Source file "%s" does not exist' % source)
         bucket_str, path_str, file_str = parse_s3_url(destination)
-        logger is None or logger('Getting bucket "%s"' % bucket_str)
-        bucket = self.s3.Bucket(bucket_str)
-        with open(source, 'rb') as data:
-            logger is None or logger(
-                'Putting file "%s" at path "%s" in bucket "%s"' % 
-                (source, path_str, bucket_str))
-            bucket.put_object(Key=path_str, Body=data)
+        logger is None or logger(
+            'Putting file "%s" at path "%s" in bucket "%s"' %
+            (source, path_str, bucket_str))
+        if not digest:
+            self.client.upload_file(source, bucket_str, path_str, Config=self.transfer_config,
+                                    Callback=callback)
+            return None
+        with open(source, 'rb') as fh:
+            reader = HashingReader(fh)
+            self.client.upload_fileobj(reader, bucket_str, path_str, Config=self.transfer_config,
+                                       Callback=callback)
+            reader.catch_up()
+        return reader.size, reader.hexdigest()
 
     def remove(self, url):
         bucket_str, path_str, _ = parse_s3_url(url)
@@ -192,7 +269,12 @@ class S3Mover(object):
         bucket = self.s3.Bucket(bucket)
         bucket.delete()
 
-    def get(self, source, destination):
+    def get(self, source, destination, callback=None):
+        """
+        Download with a managed transfer, which fetches objects over the
+        multipart threshold as parallel ranged GETs of multipart_chunksize
+        each, max_concurrency at a time, written in place into the file.
+        """
         bucket_str, path_str, file_str = parse_s3_url(source)
         if destination.startswith('local://'):
             destination = destination[len('local://'):]
@@ -200,13 +282,98 @@ class S3Mover(object):
             destination = os.path.join(destination, file_str)
         if os.path.exists(destination):
             raise RuntimeError('Destination of get already exists: "%s"' % destination)
-        bucket = self.s3.Bucket(bucket_str)
-        bucket.download_file(path_str, destination)
+        self.client.download_file(bucket_str, path_str, destination, Config=self.transfer_config,
+                                  Callback=callback)
 
-    def multi(self, source, destination, files):
-        for file in files:
-            self.put(os.path.join(source, file),
-                     os.path.join(destination, file))
+    def open_stream(self, url, part_bytes=None, window=None, callback=None, tries=5, on_retry=None):
+        """
+        Yield the bytes of the object at url in order, as parts of
+        part_bytes (default multipart_chunksize) fetched with ranged GETs,
+        up to window (default max_concurrency) at once.  At most window
+        parts are held in memory, however slowly the caller consumes them.
+        A part that fails or comes back short is fetched again, up to tries
+        times, calling on_retry each time.
+        """
+        bucket_str, path_str, _ = parse_s3_url(url)
+        part_bytes = part_bytes or self.transfer_config.multipart_chunksize
+        window = window or self.transfer_config.max_concurrency
+        size = self.client.head_object(Bucket=bucket_str, Key=path_str)['ContentLength']
+        nparts = (size + part_bytes - 1) // part_bytes
+        cond = threading.Condition()
+        state = {'next_fetch': 0, 'next_yield': 0, 'parts': {}, 'error': None, 'closed': False}
+
+        def _fetcher():
+            while True:
+                with cond:
+                    while not state['closed'] and state['error'] is None and \
+                            state['next_fetch'] < nparts and state['next_fetch'] >= state['next_yield'] + window:
+                        cond.wait()
+                    if state['closed'] or state['error'] is not None or state['next_fetch'] >= nparts:
+                        return
+                    i = state['next_fetch']
+                    state['next_fetch'] += 1
+                start = i * part_bytes
+                end = min(size, start + part_bytes)
+                rng = 'bytes=%d-%d' % (start, end - 1)
+                for attempt in range(tries):
+                    if attempt > 0:
+                        on_retry is None or on_retry()
+                        time.sleep(min(2 ** (attempt - 1), 30))
+                    try:
+                        body = self.client.get_object(Bucket=bucket_str, Key=path_str, Range=rng)['Body'].read()
+                    except Exception as e:
+                        error = e
+                        continue
+                    if len(body) == end - start:
+                        break
+                    error = IOError('got %d bytes of %s for %s' % (len(body), rng, url))
+                else:
+                    with cond:
+                        state['error'] = error
+                        cond.notify_all()
+                    return
+                with cond:
+                    state['parts'][i] = body
+                    cond.notify_all()
+
+        threads = [threading.Thread(target=_fetcher) for _ in range(min(window, nparts))]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        try:
+            for i in range(nparts):
+                with cond:
+                    while i not in state['parts'] and state['error'] is None:
+                        cond.wait()
+                    if i not in state['parts']:
+                        raise state['error']
+                    body = state['parts'].pop(i)
+                    state['next_yield'] = i + 1
+                    cond.notify_all()
+                callback is None or callback(len(body))
+                yield body
+        finally:
+            with cond:
+                state['closed'] = True
+                cond.notify_all()
+
+    def multi(self, source, destination, files, logger=None, digests=None, callback=None):
+        """
+        Upload files from the source directory, file_concurrency at a time.
+        Largest files go first so that one big BAM doesn't start last.  If
+        digests is a dictionary, (size, MD5) of each file is added to it.
+        """
+        if source.startswith('local://'):
+            source = source[len('local://'):]
+        files = sorted(files, key=lambda x: -os.path.getsize(os.path.join(source, x)))
+
+        def _put(fn):
+            digest = self.put(os.path.join(source, fn), os.path.join(destination, fn),
+                              logger=logger, digest=digests is not None, callback=callback)
+            if digests is not None:
+                digests[fn] = digest
+
+        parallel_apply(_put, files, self.file_concurrency)
 
 
 def parse_globus_url(url):
@@ -242,18 +409,31 @@ class GlobusMover(object):
         assert self.is_uuid(eid)
         return eid
 
-    def __init__(self, ini_fn, globus_id, globus_secret, hours_per_activation=48):
+    def __init__(self, ini_fn, globus_id, globus_secret, hours_per_activation=48, listing_ttl=60):
         self.cfg = RawConfigParser()
         if not os.path.exists(ini_fn):
             raise RuntimeError('No such globus ini file: "%s"' % ini_fn)
         self.cfg.read(ini_fn)
+        # the authorizer renews its own access token as it nears expiry
         self.client = globus.new_transfer_client(globus_id, globus_secret)
         self.hours_per_activation = hours_per_activation
+        self.activations = {}  # endpoint name -> (endpoint id, expiry time)
+        self.listing_ttl = listing_ttl
+        self.listings = {}  # (endpoint id, directory) -> (time listed, set of file names)
 
     def close(self):
         pass
 
     def _activate(self, endpoint_name):
+        """
+        Activate the endpoint unless this mover already did so and the
+        activation has more than a tenth of its lifetime left
+        """
+        lifetime = self.hours_per_activation * 3600.0
+        if endpoint_name in self.activations:
+            eid, expires = self.activations[endpoint_name]
+            if expires - time.time() > lifetime / 10:
+                return eid
         resp = globus.globus_activate(self.cfg, self.client,
                                       'globus-' + endpoint_name,
                                       self.hours_per_activation)
@@ -261,19 +441,66 @@ class GlobusMover(object):
             raise RuntimeError('Bad response when attempting to activate globus endpoint "%s"' % endpoint_name)
         eid = self.eid_from_name(endpoint_name)
         assert self.is_uuid(eid)
+        self.activations[endpoint_name] = (eid, time.time() + lifetime)
         return eid
 
-    def exists(self, url, logger=None):
-        endpoint_name, path, path_upto_basename, basename = parse_globus_url(url)
+    def _listing(self, endpoint_name, dirname, logger=None):
+        """
+        Return the set of file names in a directory, listing it only if we
+        haven't in the last listing_ttl seconds.  A missing directory has no
+        files.
+        """
         endpoint_id = self._activate(endpoint_name)
-        for entry in self.client.operation_ls(endpoint_id, path=path_upto_basename):
-            if entry['DATA_TYPE'] == 'file' and basename == entry['name']:
-                return True
-        return False
+        key = (endpoint_id, dirname)
+        if key in self.listings and time.time() - self.listings[key][0] < self.listing_ttl:
+            return self.listings[key][1]
+        logger is None or logger('Listing globus directory "%s" on %s' % (dirname, endpoint_name))
+        names = set()
+        try:
+            for entry in self.client.operation_ls(endpoint_id, path=dirname):
+                if entry['DATA_TYPE'] == 'file':
+                    names.add(entry['name'])
+        except globus_sdk.exc.TransferAPIError as e:
+            if e.http_status != 404:
+                raise
+        self.listings[key] = (time.time(), names)
+        return names
+
+    def _invalidate(self, url, is_dir=False):
+        """
+        Forget the listing of the directory a transfer just wrote to: url
+        itself if is_dir, otherwise the directory containing it
+        """
+        endpoint_name, path, dirname, _ = parse_globus_url(url)
+        if is_dir:
+            dirname = path
+        if endpoint_name in self.activations:
+            self.listings.pop((self.activations[endpoint_name][0], dirname), None)
+
+    def exists(self, url, logger=None):
+        endpoint_name, _, path_upto_basename, basename = parse_globus_url(url)
+        return basename in self._listing(endpoint_name, path_upto_basename, logger=logger)
+
+    def exists_many(self, urls, logger=None):
+        """
+        Return a dictionary mapping each URL to whether it exists, listing
+        each distinct directory at most once
+        """
+        return dict((url, self.exists(url, logger=logger)) for url in urls)
 
     def make_bucket(self, url):
         raise RuntimeError('No way to make path with Globus mover')
 
+    def remove(self, url, timeout=3600, poll_interval=5, logger=None):
+        endpoint_name, path, _, _ = parse_globus_url(url)
+        ddata = globus_sdk.DeleteData(self.client, self._activate(endpoint_name), label='GlobusMover remove')
+        ddata.add_item(path)
+        task_id = self.client.submit_delete(ddata)['task_id']
+        logger is None or logger('Waiting for globus rm "%s" (task %s)' % (url, task_id))
+        if not self.client.task_wait(task_id, timeout, poll_interval):
+            raise RuntimeError('Globus rm "%s" (task %s) did not finish in %d secs' % (url, task_id, timeout))
+        self._invalidate(url)
+
     def _xfer_data(self, source, destination, typ):
         endpoint_name_src, path_src, _, _ = parse_globus_url(source)
         endpoint_name_dst, path_dst, _, _ = parse_globus_url(destination)
@@ -297,7 +524,11 @@ class GlobusMover(object):
                 'Waiting for globus cp "%s" -> "%s" (task %s)' %
                 (source, destination, task_id))
             self.client.task_wait(task_id, timeout, poll_interval)
-        final_status = self.client.get_task(task_id)['status']
+        task = self.client.get_task(task_id)
+        final_status = task['status']
+        rec = transfers.current()
+        if rec is not None and final_status == 'SUCCEEDED':
+            rec.add_bytes(task.get('bytes_transferred', 0))
         logger is None or logger(
             'Finished globus cp "%s" -> "%s" (task %s) with final status %s' %
             (source, destination, task_id, final_status))
@@ -308,6 +539,7 @@ class GlobusMover(object):
         tdata = self._xfer_data(source, destination, typ)
         tdata.add_item(path_src, path_dst)
         self._submit(tdata, source, destination, timeout, poll_interval, logger=logger)
+        self._invalidate(destination)
 
     def multi(self, source, destination, files, typ='multi', timeout=100000, poll_interval=5, logger=None):
         _, path_src, _, _ = parse_globus_url(source)
@@ -317,6 +549,7 @@ class GlobusMover(object):
             tdata.add_item(os.path.join(path_src, file),
                            os.path.join(path_dst, file))
         self._submit(tdata, source, destination, timeout, poll_interval, logger=logger)
+        self._invalidate(destination, is_dir=True)
 
     def get(self, source, destination, timeout=100000, poll_interval=5, logger=None):
         self.put(source, destination, typ='get', timeout=timeout,
@@ -406,10 +639,15 @@ class WebMover(object):
         For now, just distinguishes among S3, the local filesystem, and the
         web.
     """
-    def __init__(self, curl_exe='curl'):
-        """ curl_exe: curl executable
+    def __init__(self, curl_exe='curl', segments=4, stall_timeout=120):
+        """ curl_exe: curl executable, used for existence checks
+            segments: most parallel connections per download
+            stall_timeout: seconds without progress before a connection is
+                retried
         """
         self.curl = curl_exe
+        self.segments = segments
+        self.stall_timeout = stall_timeout
         self._osdevnull = open(os.devnull, 'w')
 
     def close(self):
@@ -439,86 +677,29 @@ class WebMover(object):
     def multi(self, source, destination, files):
         raise RuntimeError('Cannot upload to FTP, HTTP, or HTTPS.')
 
-    def get(self, source, destination='.'):
-        """ Retrieves file from web (http, https, ftp) source.
+    def get(self, source, destination='.', logger=None, callback=None, on_retry=None):
+        """ Retrieves file from web (http, https, ftp) source, in parallel
+            segments where the server allows, resuming after stalls and
+            interruptions (see download.py).
 
-            Note that if the destination has a file whose name is the same
-            as the source name, THAT FILE IS DELETED -- EVEN IF the destination
-            has a different filename! This is a curl quirk, and if it
-            becomes a problem in pipelines, it will be addressed.
-
-            source: filename of source
-            destination: filename of destination
+            source: URL of source
+            destination: existing directory to download into, or filename
+                of destination
+            callback: called with byte counts as the download progresses
+            on_retry: called each time a connection is retried
         """
-        oldp = os.getcwd()
-        try:
-            os.chdir(destination)
-        except OSError:
-            # destination doesn't exist; the filename is the destination
-            filename = os.path.abspath(destination)
-            try:
-                os.makedirs(os.path.dirname(os.path.abspath(filename)))
-            except OSError:
-                pass
-        else:
+        if os.path.isdir(destination):
             filename = os.path.join(os.path.abspath(destination),
                                     source.rpartition('/')[2])
-        command_list = ['curl', '-o', filename,
-                        '-s', '-O', '--connect-timeout', '600', source]
-        command = ' '.join(command_list)
-        tries = 0
-        curl_thread = None
-        while tries < 5:
-            break_outer_loop = False
-            curl_thread = CommandThread(command_list)
-            curl_thread.start()
-            last_print_time = time.time()
+        else:
+            filename = os.path.abspath(destination)
             try:
-                last_size = os.path.getsize(filename)
+                os.makedirs(os.path.dirname(filename))
             except OSError:
-                last_size = 0
-            while curl_thread.is_alive():
-                now_time = time.time()
-                if now_time - last_print_time > 160:
-                    try:
-                        new_size = os.path.getsize(filename)
-                    except OSError:
-                        new_size = 0
-                    if new_size == last_size:
-                        # Download stalled
-                        break_outer_loop = True
-                        break
-                    else:
-                        last_size = new_size
-                    last_print_time = now_time
-                    time.sleep(1)
-                time.sleep(1)
-            if break_outer_loop:
-                tries += 1
-                print('Download stalled on try %d.' % tries, file=sys.stderr)
-                try:
-                    curl_thread.process.kill()
-                except AttributeError:
-                    pass
-                try:
-                    os.remove(filename)
-                except OSError:
-                    pass
-                time.sleep(2)
-                continue
-            if curl_thread.process_return > 89 or curl_thread.process_return == 56:
-                '''If the exit code is greater than the highest-documented
-                curl exit code, there was a timeout.'''
-                print('Too many simultaneous connections; '
-                      'restarting in 10 s.', file=sys.stderr)
-                time.sleep(5)
-            else:
-                break
-        os.chdir(oldp)
-        if curl_thread is not None and curl_thread.process_return > 0:
-            raise RuntimeError(('Nonzero exitlevel %d from curl command '
-                                '"%s"')
-                               % (curl_thread.process_return, command))
+                pass
+        download.download(source, filename, segments=self.segments,
+                          stall_timeout=self.stall_timeout, logger=logger, progress=callback,
+                          on_retry=on_retry)
 
 
 class Mover(object):
@@ -537,12 +718,31 @@ class Mover(object):
                  enable_web=False,
                  enable_s3=False,
                  enable_globus=False,
-                 hours_per_activation=48):
+                 hours_per_activation=48,
+                 s3_transfer=None,
+                 local_concurrency=4,
+                 governor=None,
+                 transfer_log=None,
+                 staging_methods=None):
+        """ governor: a governor.Governor that every get, put and multi
+                waits on for a transfer slot and charges the bytes it moves
+                to, or None for no limits
+            transfer_log: file to append a JSON line to for each transfer
+                (see transfers.py), or None
+            staging_methods: how local transfers put files in place (see
+                staging.py), or None for staging.DEFAULT_STAGING_METHODS
+        """
         self.enable_web = enable_web
+        self.governor = governor
+        self.transfer_log = transfer_log
+        self.staging_methods = staging_methods
+        self.transfer_stats = TransferStats()
+        self.recorders = []  # callables given each TransferRecord
+        self.local_concurrency = local_concurrency
         self.enable_s3 = enable_s3
         self.enable_globus = enable_globus
         if enable_s3:
-            self.s3_mover = S3Mover(profile=profile, endpoint_url=endpoint_url)
+            self.s3_mover = S3Mover(profile=profile, endpoint_url=endpoint_url, transfer=s3_transfer)
         if enable_globus:
             self.globus_mover = GlobusMover(os.path.expanduser(globus_ini),
                                             globus_id=globus_id,
@@ -559,6 +759,83 @@ class Mover(object):
         if self.enable_web:
             self.web_mover.close()
 
+    @staticmethod
+    def _log_rate(what, nbytes, secs, logger):
+        if logger is not None:
+            rate = nbytes / secs / (1024 * 1024) if secs > 0 else 0.0
+            logger('Local %s: %d bytes in %0.3f secs (%0.1f MB/s)' % (what, nbytes, secs, rate))
+
+    @contextmanager
+    def _transfer(self, op, direction, url, priority, files=1, cancel=None):
+        """
+        Hold one of the governor's transfer slots for the direction, if
+        there's a governor, and yield a TransferRecord whose progress method
+        counts bytes and charges them to the governor, and stops the
+        transfer once cancel (a threading.Event) is set.  Time spent waiting
+        for the slot goes in the record's wait_secs rather than its secs.
+        The finished record goes to transfer_stats, the recorders and the
+        transfer log.
+        """
+        backend = 'web' if url.is_curlable else ('s3' if url.is_s3 else url.type)
+        rec = TransferRecord(op, backend, endpoint_of(url.to_url()), files=files)
+        rec.cancel = cancel
+        outcome = 'error'
+        try:
+            if self.governor is None:
+                transfers.set_current(rec)
+                yield rec
+            else:
+                with self.governor.transfer(direction, priority):
+                    rec.started()
+                    rec.throttle = self.governor.throttle(direction, priority)
+                    transfers.set_current(rec)
+                    try:
+                        yield rec
+                    finally:
+                        rec.throttle.flush()
+            outcome = 'ok'
+        except TransferCancelled:
+            outcome = 'cancelled'
+            raise
+        finally:
+            transfers.set_current(None)
+            rec.finish(outcome)
+            self.transfer_stats.add(rec)
+            for recorder in list(self.recorders):
+                recorder(rec)
+            if self.transfer_log is not None:
+                try:
+                    append_log(self.transfer_log, rec)
+                except (IOError, OSError):
+                    pass  # losing a record isn't worth failing the transfer
+
+    @staticmethod
+    def _charge_local(rec, method, nbytes):
+        # links and reflinks move no data, so only copies use up bandwidth
+        if method == 'copy':
+            rec.progress(nbytes)
+        else:
+            rec.add_bytes(nbytes)
+
+    def _local_copy(self, src, dst, logger=None, rec=None):
+        """
+        Put a copy of local file src at dst, replacing dst if it exists.
+        Hardlinks or reflinks when src and dst share a filesystem, otherwise
+        has the kernel copy the bytes, which are then charged to the
+        governor through rec.
+        """
+        dr = os.path.dirname(dst)
+        if len(dr) > 0 and not os.path.exists(dr):
+            logger is None or logger('Creating destination directory "%s"' % dr)
+            os.makedirs(dr)
+        if os.path.exists(dst):
+            os.remove(dst)
+        t0 = time.time()
+        method = link_or_copy(src, dst, methods=self.staging_methods)
+        if rec is not None:
+            self._charge_local(rec, method, os.path.getsize(dst))
+        self._log_rate('%s of "%s"' % (method, src), os.path.getsize(dst), time.time() - t0, logger)
+
     def exists(self, url, logger=None):
         """ Returns whether a given file exists. 
 
@@ -594,6 +871,22 @@ class Mover(object):
             logger is None or logger('Web exists for "%s"' % url)
             return self.web_mover.exists(url.to_url())
 
+    def exists_many(self, urls, logger=None):
+        """
+        Return a dictionary mapping each URL to whether it exists.  Globus
+        URLs in the same directory share one listing.
+        """
+        result = {}
+        globus_urls = [u for u in urls if Url(u).is_globus]
+        if len(globus_urls) > 0:
+            if not self.enable_globus:
+                raise RuntimeError('exists_many called on Globus URLs but Globus not enabled')
+            result.update(self.globus_mover.exists_many(globus_urls, logger=logger))
+        for url in urls:
+            if url not in result:
+                result[url] = self.exists(url, logger=logger)
+        return result
+
     def make_bucket(self, url, logger=None):
         url = Url(url)
         if url.is_local:
@@ -615,28 +908,53 @@ class Mover(object):
             logger is None or logger('Web make_bucket for "%s"' % url)
             return self.web_mover.make_bucket(url.to_url())
 
-    def get(self, url, destination='.', logger=None):
+    def remove(self, url, logger=None):
+        """ Removes the file at url, if it exists.  Web URLs are read-only. """
+        url = Url(url)
+        if url.is_local:
+            logger is None or logger('Local remove for "%s"' % url)
+            path = os.path.abspath(url.to_url())
+            if os.path.exists(path):
+                os.remove(path)
+        elif url.is_s3:
+            if not self.enable_s3:
+                raise RuntimeError('remove called on S3 URL "%s" but S3 not enabled' % url)
+            logger is None or logger('S3 remove for "%s"' % url)
+            self.s3_mover.remove(url.to_url())
+        elif url.is_globus:
+            if not self.enable_globus:
+                raise RuntimeError('remove called on Globus URL "%s" but Globus not enabled' % url)
+            logger is None or logger('Globus remove for "%s"' % url.to_url())
+            self.globus_mover.remove(url.to_url(), logger=logger)
+        else:
+            raise RuntimeError('Cannot remove web URL "%s"' % url)
+
+    def get(self, url, destination='.', logger=None, priority='normal', cancel=None):
         """ Copies a file at url to the local destination.
 
             url: URL-- can be local, on S3, or on the web
             destination: destination on local filesystem
+            priority: governor priority; "low" for prefetches
+            cancel: threading.Event that, once set, stops the transfer at
+                its next progress report (local copies report only once
+                done, and Globus transfers not at all)
 
             No return value.
         """
         url = Url(url)
+        with self._transfer('get', 'in', url, priority, cancel=cancel) as rec:
+            self._get(url, destination, logger, rec)
+
+    def _get(self, url, destination, logger, rec):
         src, dst = url.to_url(), destination
         if url.is_local:
             logger is None or logger('Local get from "%s" to "%s"' % (src, dst))
-            dr = os.path.dirname(dst)
-            if len(dr) > 0 and not os.path.exists(dr):
-                logger is None or logger('Creating destination directory "%s"' % dr)
-                os.makedirs(dr)
-            shutil.copyfile(src, dst)
+            self._local_copy(src, dst, logger=logger, rec=rec)
         elif url.is_s3:
             if not self.enable_s3:
                 raise RuntimeError('get called on S3 URL "%s" but S3 not enabled' % url)
             logger is None or logger('S3 get from "%s" to "%s"' % (src, dst))
-            self.s3_mover.get(src, dst)
+            self.s3_mover.get(src, dst, callback=rec.progress)
         elif url.is_globus:
             if not self.enable_globus:
                 raise RuntimeError('get called on Globus URL "%s" but Globus not enabled' % url)
@@ -646,31 +964,34 @@ class Mover(object):
             if not self.enable_web:
                 raise RuntimeError('get called on web URL "%s" but web not enabled' % url)
             logger is None or logger('Web get from "%s" to "%s"' % (src, dst))
-            self.web_mover.get(src, dst)
+            self.web_mover.get(src, dst, logger=logger, callback=rec.progress, on_retry=rec.retry)
 
-    def put(self, source, url, logger=None):
+    def put(self, source, url, logger=None, priority='high', cancel=None):
         """ Copies a file from source to the url .
 
             source: where to retrieve file from local filesystem
             destination: destination URL
+            priority: governor priority; uploads default to "high" so that
+                finished jobs aren't held up by downloads for new ones
+            cancel: as for get
 
             No return value.
         """
         url = Url(url)
+        with self._transfer('put', 'out', url, priority, cancel=cancel) as rec:
+            self._put(source, url, logger, rec)
+
+    def _put(self, source, url, logger, rec):
         dst = url.to_url()
         if url.is_local:
             source = Url(source).to_url()
             logger is None or logger('Local put from "%s" to "%s"' % (source, dst))
-            dr = os.path.dirname(dst)
-            if len(dr) > 0 and not os.path.exists(dr):
-                logger is None or logger('Creating destination directory "%s"' % dr)
-                os.makedirs(dr)
-            shutil.copyfile(source, dst)
+            self._local_copy(source, dst, logger=logger, rec=rec)
         elif url.is_s3:
             if not self.enable_s3:
                 raise RuntimeError('put called on S3 URL "%s" but S3 not enabled' % url)
             logger is None or logger('S3 put from "%s" to "%s"' % (source, dst))
-            self.s3_mover.put(source, dst)
+            self.s3_mover.put(source, dst, logger=logger, callback=rec.progress)
         elif url.is_globus:
             if not self.enable_globus:
                 raise RuntimeError('put called on Globus URL "%s" but Globus not enabled' % url)
@@ -682,15 +1003,25 @@ class Mover(object):
             logger is None or logger('Web put from "%s" to "%s"' % (source, dst))
             self.web_mover.put(source, dst)
 
-    def multi(self, source, url, files, logger=None):
+    def multi(self, source, url, files, logger=None, digests=None, priority='high', cancel=None):
         """ Copies a file from source to the url .
 
             source: where to retrieve file from local filesystem
             destination: destination URL
+            digests: if a dictionary, (size, MD5 hex digest) of each file
+                is added to it for local and S3 destinations, computed while
+                the file is copied or uploaded
+            priority: governor priority, as for put; the whole multi-put
+                takes one transfer slot
+            cancel: as for get
 
             No return value.
         """
         url = Url(url)
+        with self._transfer('multi', 'out', url, priority, files=len(files), cancel=cancel) as rec:
+            self._multi(source, url, files, logger, digests, rec)
+
+    def _multi(self, source, url, files, logger, digests, rec):
         dst = url.to_url()
         if url.is_local:
             source = Url(source).to_url()
@@ -699,13 +1030,29 @@ class Mover(object):
                 os.makedirs(dst)
             elif not os.path.isdir(dst):
                 raise ValueError('Destination "%s" exists but is not a directory' % dst)
-            for file in files:
-                shutil.copyfile(os.path.join(source, file), os.path.join(dst, file))
+            sizes = dict((fn, os.path.getsize(os.path.join(source, fn))) for fn in files)
+
+            def _stage(file):
+                dst_file = os.path.join(dst, file)
+                if os.path.exists(dst_file):
+                    os.remove(dst_file)
+                if digests is None:
+                    method = link_or_copy(os.path.join(source, file), dst_file, methods=self.staging_methods)
+                else:
+                    method, digests[file] = link_or_copy_with_digest(os.path.join(source, file), dst_file,
+                                                                     methods=self.staging_methods)
+                self._charge_local(rec, method, sizes[file])
+                logger is None or logger('Staged "%s" using %s' % (dst_file, method))
+
+            t0 = time.time()
+            # largest first, so one big file doesn't start last
+            parallel_apply(_stage, sorted(files, key=lambda x: -sizes[x]), self.local_concurrency)
+            self._log_rate('multi-put of %d files' % len(files), sum(sizes.values()), time.time() - t0, logger)
         elif url.is_s3:
             if not self.enable_s3:
                 raise RuntimeError('multi-put called on S3 URL "%s" but S3 not enabled' % url)
             logger is None or logger('S3 multi-put from "%s" to "%s"' % (source, dst))
-            self.s3_mover.multi(source, dst, files)
+            self.s3_mover.multi(source, dst, files, logger=logger, digests=digests, callback=rec.progress)
         elif url.is_globus:
             if not self.enable_globus:
                 raise RuntimeError('multi-put called on Globus URL "%s" but Globus not enabled' % url)
@@ -718,6 +1065,51 @@ class Mover(object):
             self.web_mover.multi(source, dst, files)
 
 
+    def open_stream(self, url, logger=None, priority='normal', chunk_bytes=1024 * 1024):
+        """ Yields the bytes of the file at url in order, so that they can
+            be processed (e.g. piped into tar) while still downloading.
+            S3 objects are fetched as parallel ranged GETs (see
+            S3Mover.open_stream).  Failed S3 parts and web connections are
+            retried, the latter from where they broke off (see
+            download.stream).  Not available for Globus.
+
+            url: URL-- can be local, on S3, or on the web
+            priority: governor priority, as for get
+        """
+        url = Url(url)
+        src = url.to_url()
+        with self._transfer('stream', 'in', url, priority) as rec:
+            if url.is_local:
+                logger is None or logger('Local stream of "%s"' % src)
+                with open(src, 'rb') as fh:
+                    while True:
+                        buf = fh.read(chunk_bytes)
+                        if not buf:
+                            break
+                        rec.progress(len(buf))
+                        yield buf
+            elif url.is_s3:
+                if not self.enable_s3:
+                    raise RuntimeError('open_stream called on S3 URL "%s" but S3 not enabled' % url)
+                logger is None or logger('S3 stream of "%s"' % src)
+                for buf in self.s3_mover.open_stream(src, callback=rec.progress, on_retry=rec.retry):
+                    yield buf
+            elif url.is_curlable:
+                if not self.enable_web:
+                    raise RuntimeError('open_stream called on web URL "%s" but web not enabled' % url)
+                logger is None or logger('Web stream of "%s"' % src)
+                for buf in download.stream(src, chunk_bytes=chunk_bytes, stall_timeout=self.web_mover.stall_timeout,
+                                           logger=logger, on_retry=rec.retry):
+                    rec.progress(len(buf))
+                    yield buf
+            else:
+                raise RuntimeError('open_stream not supported for "%s"' % src)
+
+
+# Movers made by MoverConfig.pooled_mover, keyed by (pid, config key)
+_mover_pool = {}
+
+
 class MoverConfig(object):
 
     def __init__(self,
@@ -731,9 +1123,11 @@ class MoverConfig(object):
         self.aws_profile = None
         self.aws_endpoint_url = None
         self.enable_s3 = False
+        self.s3_transfer = S3_TRANSFER_DEFAULTS
         if s3_ini is not None and os.path.exists(s3_ini):
             self.enable_s3, self.aws_endpoint_url, self.aws_profile = \
                 parse_s3_ini(s3_ini, s3_section, logger=logger)
+            self.s3_transfer = parse_s3_transfer_ini(s3_ini, s3_section)
         self.globus_ini = globus_ini
         self.globus_id, self.globus_secret = None, None
         self.enable_globus = False
@@ -744,6 +1138,16 @@ class MoverConfig(object):
             self.enable_globus = self.globus_id is not None
         self.enable_web = enable_web
         self.curl_exe = curl_exe
+        # set by cluster.py when a globus_batch.GlobusBatcher is running, along
+        # with the pid of the process it runs in
+        self.globus_batch_queue = None
+        self.globus_batch_pid = None
+        # set by cluster.py from cluster.ini; see governor.py
+        self.governor = None
+        # set by cluster.py from cluster.ini; see transfers.py
+        self.transfer_log = None
+        # set by cluster.py from cluster.ini; see staging.py
+        self.staging_methods = None
 
     def new_mover(self):
         return Mover(
@@ -756,7 +1160,41 @@ class MoverConfig(object):
             hours_per_activation=self.hours_per_activation,
             enable_web=self.enable_web,
             enable_s3=self.enable_s3,
-            enable_globus=self.enable_globus)
+            enable_globus=self.enable_globus,
+            s3_transfer=self.s3_transfer,
+            governor=self.governor,
+            transfer_log=self.transfer_log,
+            staging_methods=self.staging_methods)
+
+    def key(self):
+        return (self.aws_profile, self.aws_endpoint_url, self.curl_exe, self.globus_ini,
+                self.globus_id, self.hours_per_activation, self.enable_web, self.enable_s3,
+                self.enable_globus, tuple(sorted(self.s3_transfer.items())),
+                None if self.governor is None else self.governor.state_dir, self.transfer_log,
+                None if self.staging_methods is None else tuple(self.staging_methods))
+
+    def pooled_mover(self):
+        """
+        Return a Mover that lives as long as this process, so its boto3
+        session, S3 connection pools, Globus transfer client and endpoint
+        activations carry over from one job to the next.  boto3 and the
+        Globus authorizer renew their own credentials as they near expiry.
+        Keyed by pid so that a worker forked after the parent made a mover
+        doesn't share the parent's sockets.
+        """
+        key = (os.getpid(), self.key())
+        if key not in _mover_pool:
+            _mover_pool[key] = self.new_mover()
+        return _mover_pool[key]
+
+    def discard_pooled_mover(self):
+        """
+        Drop this process's pooled mover, e.g. after a failed job in case
+        its connections are what failed
+        """
+        mover = _mover_pool.pop((os.getpid(), self.key()), None)
+        if mover is not None:
+            mover.close()
 
 
 def parse_s3_ini(ini_fn, section='s3', logger=None):
@@ -785,6 +1223,31 @@ def parse_s3_ini(ini_fn, section='s3', logger=None):
     return enabled, aws_endpoint, aws_profile
 
 
+S3_TRANSFER_DEFAULTS = {'multipart_threshold_mb': 64,
+                        'multipart_chunksize_mb': 64,
+                        'max_concurrency': 8,
+                        'file_concurrency': 4}
+
+
+def parse_s3_transfer_ini(ini_fn, section='s3'):
+    """
+    Parse the optional settings governing S3 uploads from a s3.ini file:
+    size at which uploads become multipart and the part size (both in MB),
+    the number of threads used for the parts of one file, and the number of
+    files uploaded at once.  Unspecified settings take their defaults.
+    """
+    transfer = dict(S3_TRANSFER_DEFAULTS)
+    cfg = RawConfigParser()
+    cfg.read(ini_fn)
+    if cfg.has_section(section):
+        for nm in transfer.keys():
+            if cfg.has_option(section, nm) and len(cfg.get(section, nm)) > 0:
+                transfer[nm] = int(cfg.get(section, nm))
+                if transfer[nm] < 1:
+                    raise ValueError('%s in S3 ini file "%s" must be >= 1' % (nm, ini_fn))
+    return transfer
+
+
 def parse_globus_ini(ini_fn, section='recount-app', logger=None):
     """
     Parse and return the fields of a s3.ini file
@@ -888,6 +1351,210 @@ def test_multi():
     shutil.rmtree(dst)
 
 
+def test_governed_transfers():
+    from governor import Governor
+    src, dst, state_dir = tempfile.mkdtemp(), tempfile.mkdtemp(), tempfile.mkdtemp()
+    with open(os.path.join(src, 'temp1'), 'wt') as fh:
+        fh.write('temp1\n')
+    gov = Governor(state_dir, max_transfers={'in': 1, 'out': 1}, poll=0.01)
+    m = Mover(governor=gov)
+    m.multi(src, dst, ['temp1'])
+    m.put(os.path.join(src, 'temp1'), os.path.join(dst, 'temp2'))
+    m.get(os.path.join(dst, 'temp2'), os.path.join(src, 'temp3'), priority='low')
+    assert os.path.exists(os.path.join(src, 'temp3'))
+    with gov._state() as state:
+        assert [] == state['in']['active'] and [] == state['out']['active']
+    for dr in [src, dst, state_dir]:
+        shutil.rmtree(dr)
+
+
+def test_transfer_records():
+    src, dst = tempfile.mkdtemp(), tempfile.mkdtemp()
+    with open(os.path.join(src, 'temp1'), 'wt') as fh:
+        fh.write('temp1\n')
+    log_fn = os.path.join(dst, 'xfer.jsonl')
+    m = Mover(transfer_log=log_fn)
+    recs = []
+    m.recorders.append(recs.append)
+    m.put(os.path.join(src, 'temp1'), os.path.join(dst, 'temp2'))
+    with pytest.raises(OSError):
+        m.get(os.path.join(src, 'missing'), os.path.join(dst, 'temp3'))
+    assert [('put', 'local', 6, 'ok'), ('get', 'local', 0, 'error')] == \
+        [(r.op, r.backend, r.nbytes, r.outcome) for r in recs]
+    assert ['put', 'get'] == [r.op for r in transfers.read_log(log_fn)]
+    assert 2 == len(m.transfer_stats.report())
+    shutil.rmtree(src)
+    shutil.rmtree(dst)
+
+
+class _FakeBody(object):
+    def __init__(self, data):
+        self.data = data
+
+    def read(self):
+        return self.data
+
+
+class _FakeS3Client(object):
+    """
+    Serves one object from memory, recording the Range of each GET.  The
+    first GET of each range in flaky comes back short.
+    """
+
+    def __init__(self, data, flaky=()):
+        self.data = data
+        self.ranges = []
+        self.flaky = set(flaky)
+
+    def head_object(self, Bucket, Key):
+        return {'ContentLength': len(self.data)}
+
+    def get_object(self, Bucket, Key, Range):
+        self.ranges.append(Range)
+        a, b = Range.split('=')[1].split('-')
+        time.sleep(0.001 * (hash(Range) % 5))  # finish out of order
+        if Range in self.flaky:
+            self.flaky.remove(Range)
+            return {'Body': _FakeBody(self.data[int(a):int(b)])}
+        return {'Body': _FakeBody(self.data[int(a):int(b) + 1])}
+
+
+class _FakeUploadClient(object):
+    """
+    Reads an upload in parts as the transfer manager does, re-reading the
+    first part once as a retry would
+    """
+
+    def __init__(self):
+        self.uploaded = {}
+
+    def upload_fileobj(self, fileobj, bucket, key, Config=None, Callback=None):
+        parts = []
+        while True:
+            start = fileobj.tell()
+            part = fileobj.read(1000)
+            if not part:
+                break
+            if start == 0 and len(parts) == 0:
+                fileobj.seek(0)
+                part = fileobj.read(1000)
+            parts.append(part)
+        self.uploaded[(bucket, key)] = b''.join(parts)
+
+
+def test_s3_put_digest():
+    import hashlib
+    src = tempfile.mkdtemp()
+    fn = os.path.join(src, 'f')
+    data = os.urandom(3500)
+    with open(fn, 'wb') as fh:
+        fh.write(data)
+    s3 = S3Mover()
+    s3.client = _FakeUploadClient()
+    assert (3500, hashlib.md5(data).hexdigest()) == s3.put(fn, 's3://bucket/f', digest=True)
+    assert data == s3.client.uploaded[('bucket', 'f')]
+    shutil.rmtree(src)
+
+
+def test_s3_open_stream():
+    data = bytes(bytearray(i % 256 for i in range(10000)))
+    s3 = S3Mover()  # needs no network until a request is made
+    s3.client = _FakeS3Client(data)
+    got = []
+    chunks = list(s3.open_stream('s3://bucket/key', part_bytes=1000, window=3, callback=got.append))
+    assert data == b''.join(chunks)
+    assert 10 == len(s3.client.ranges)
+    assert [1000] * 10 == got
+    s3.client = _FakeS3Client(b'')
+    assert [] == list(s3.open_stream('s3://bucket/empty'))
+    s3.client = _FakeS3Client(data, flaky=['bytes=3000-3999'])
+    retries = []
+    assert data == b''.join(s3.open_stream('s3://bucket/key', part_bytes=1000, window=3,
+                                           on_retry=lambda: retries.append(1)))
+    assert 1 == len(retries)
+
+
+def test_local_open_stream():
+    src = tempfile.mkdtemp()
+    fn = os.path.join(src, 'f')
+    with open(fn, 'wb') as fh:
+        fh.write(b'x' * 2500)
+    m = Mover()
+    assert [1000, 1000, 500] == [len(b) for b in m.open_stream(fn, chunk_bytes=1000)]
+    shutil.rmtree(src)
+
+
+def test_parse_s3_transfer_ini():
+    tmpdir = tempfile.mkdtemp()
+    ini_fn = os.path.join(tmpdir, 's3.ini')
+    with open(ini_fn, 'w') as fh:
+        fh.write('[s3]\nenable=true\nmultipart_chunksize_mb=16\nfile_concurrency=2\n')
+    transfer = parse_s3_transfer_ini(ini_fn)
+    assert 16 == transfer['multipart_chunksize_mb']
+    assert 2 == transfer['file_concurrency']
+    assert S3_TRANSFER_DEFAULTS['max_concurrency'] == transfer['max_concurrency']
+    shutil.rmtree(tmpdir)
+
+
+def test_pooled_mover():
+    config = MoverConfig(enable_web=True)
+    mover = config.pooled_mover()
+    assert mover is config.pooled_mover()
+    assert mover is not MoverConfig(enable_web=False).pooled_mover()
+    config.discard_pooled_mover()
+    assert mover is not config.pooled_mover()
+    config.discard_pooled_mover()
+
+
+def test_globus_listing_cache():
+    class _Client(object):
+        calls = 0
+
+        def operation_ls(self, endpoint_id, path=None):
+            _Client.calls += 1
+            return [{'DATA_TYPE': 'file', 'name': 'a.done'}, {'DATA_TYPE': 'dir', 'name': 'b.done'}]
+
+    mover = GlobusMover.__new__(GlobusMover)
+    mover.client = _Client()
+    mover.hours_per_activation = 48
+    mover.activations = {'ep': ('eid', time.time() + 40 * 3600)}
+    mover.listing_ttl = 60
+    mover.listings = {}
+    found = mover.exists_many(['globus://ep/d/a.done', 'globus://ep/d/b.done', 'globus://ep/d/c.done'])
+    assert {'globus://ep/d/a.done': True, 'globus://ep/d/b.done': False, 'globus://ep/d/c.done': False} == found
+    assert mover.exists('globus://ep/d/a.done')
+    assert 1 == _Client.calls
+    mover._invalidate('globus://ep/d/a.done')
+    assert mover.exists('globus://ep/d/a.done')
+    assert 2 == _Client.calls
+
+
+def test_globus_activation_cache():
+    mover = GlobusMover.__new__(GlobusMover)
+    mover.hours_per_activation = 48
+    mover.activations = {'ep': ('eid', time.time() + 40 * 3600)}
+    assert 'eid' == mover._activate('ep')  # no client needed; nowhere near expiry
+
+
+def test_parallel_apply():
+    seen = []
+    lock = threading.Lock()
+
+    def _add(x):
+        with lock:
+            seen.append(x)
+
+    parallel_apply(_add, list(range(20)), 4)
+    assert list(range(20)) == sorted(seen)
+
+    def _fail(x):
+        if x == 3:
+            raise RuntimeError('fail')
+
+    with pytest.raises(RuntimeError):
+        parallel_apply(_fail, list(range(10)), 4)
+
+
 def test_get(test_file):
     m = Mover()
     dst = test_file + '.get'
@@ -897,6 +1564,18 @@ def test_get(test_file):
     os.remove(dst)
 
 
+def test_web_get():
+    payload = download._test_payload()
+    server, _ = download._serve(payload)
+    tmpdir = tempfile.mkdtemp()
+    m = Mover(enable_web=True)
+    m.get('http://127.0.0.1:%d/dir/f.bin' % server.server_address[1], tmpdir)
+    with open(os.path.join(tmpdir, 'f.bin'), 'rb') as fh:
+        assert payload == fh.read()
+    server.shutdown()
+    shutil.rmtree(tmpdir)
+
+
 def test_s3_1(s3_enabled, s3_service, test_file):
     if not s3_enabled:
         pytest.skip('Skipping S3 tests')
@@ -947,6 +1626,13 @@ def go():
         elif args['multi']:
             m = mover_config.new_mover()
             m.multi(args['<source>'], args['<dest>'], args['<file>'])
+        elif args['report']:
+            stats = TransferStats()
+            for log_fn in args['<transfer-log>']:
+                for rec in transfers.read_log(log_fn):
+                    stats.add(rec)
+            for line in stats.report():
+                print(line)
         elif args['nop']:
             pass
     except Exception:
@@ -30,7 +30,7 @@ import pytest
 import json
 import boto3
 from docopt import docopt
-from sqlalchemy import Column, ForeignKey, Integer, String, Sequence, DateTime
+from sqlalchemy import Column, ForeignKey, Integer, String, Sequence, DateTime, Float
 from base import Base
 from input import Input, InputSet
 from analysis import Analysis
@@ -176,6 +176,43 @@ class FailedTasks(Base):
             yield proj.to_job_string(input.to_job_string(), analysis_str, reference_str)
 
 
+class JobMetric(Base):
+    """
+    Table for metrics reported by a job attempt over the RECOUNT_METRICS
+    channel, one row per metric, with its histogram as JSON.
+    """
+    __tablename__ = 'job_metric'
+
+    id = Column(Integer, Sequence('job_metric_id_seq'), primary_key=True)
+    project_id = Column(Integer, ForeignKey('project.id'))
+    input_id = Column(Integer, ForeignKey('input.id'))
+    attempt_name = Column(String(1024), nullable=False)
+    time = Column(DateTime)
+    kind = Column(String(64), nullable=False)
+    name = Column(String(1024), nullable=False)
+    count = Column(Integer)
+    total = Column(Float)
+    minimum = Column(Float)
+    maximum = Column(Float)
+    histogram = Column(String(4096))
+
+
+def add_job_metrics(project_id, input_id, attempt_name, job_metrics, time, session):
+    """
+    Add one row per metric in a metrics.JobMetrics, committing them together
+    """
+    rows = []
+    for m in job_metrics:
+        rows.append(JobMetric(project_id=project_id, input_id=input_id,
+                              attempt_name=attempt_name, time=time,
+                              kind=m.kind, name=m.name, count=m.count,
+                              total=m.total, minimum=m.minimum, maximum=m.maximum,
+                              histogram=m.histogram_json()))
+    session.add_all(rows)
+    session.commit()
+    return len(rows)
+
+
 def add_project(name, analysis_id, input_set_id, reference_id, session):
     """
     Given a project name and csv file, populate the database with the
@@ -319,6 +356,19 @@ def _simple_project(session):
     return proj
 
 
+def test_add_job_metrics(session):
+    from metrics import JobMetrics
+    from datetime import datetime
+    jm = JobMetrics()
+    for line in ['time Align 10', 'time Align 30', 'count AlignComplete 1']:
+        jm.add_line(line)
+    assert 2 == add_job_metrics(None, None, 'proj1_in1_att0', jm, datetime.utcnow(), session)
+    rows = list(session.query(JobMetric).order_by(JobMetric.name))
+    assert ['Align', 'AlignComplete'] == [r.name for r in rows]
+    assert 40.0 == rows[0].total
+    assert '{"4": 1, "5": 1}' == rows[0].histogram
+
+
 def test_job_string_1():
     proj = Project(id=1, name='proj')
     st = proj.to_job_string('input-str', 'analysis-str', 'reference-str')
@@ -31,6 +31,12 @@ import shutil
 import json
 import time
 import stats
+import scratch
+import instance
+import globus_batch
+import transfers
+from metrics import MetricsReader, METRICS_FIFO
+from staging import link_or_copy, parse_staging_methods, file_digest, DEFAULT_STAGING_METHODS
 from docopt import docopt
 import subprocess
 import threading
@@ -46,6 +52,10 @@ directories and mounting patterns so that workflow can interact with host
 filesystem in predictable ways.
 """
 
+# what run_job returns for a job whose outputs it handed to the Globus
+# batcher, which decides later whether the job succeeded
+DEFERRED = 'deferred'
+
 
 def isdir(dr):
     if not os.path.exists(dr) or not os.path.isdir(dr):
@@ -92,14 +102,15 @@ def decode(st):
     return st if isinstance(st, str) else st.decode()
 
 
-def reader(node_name, worker_name, pipe, queue, nm, heartbeat_func):
+def relay_lines(node_name, worker_name, lines, queue, nm, heartbeat_func):
     """
-    Take messages from the pipe (either stdout or stderr from the container
-    process) and relay them back to cluster.py via the given queue.  The
-    only trick is that counter updates need to be relayed without any extra
-    fields before the counter string, so that they can be parsed properly.
+    Relay a batch of lines from the container back to cluster.py via the
+    given queue.  The only trick is that counter updates need to be relayed
+    without any extra fields before the counter string, so that they can be
+    parsed properly.
     """
-    for line in pipe:
+    msgs = []
+    for line in lines:
         line = decode(line.rstrip())
         msg = ' '.join([node_name, worker_name, nm, line])
         if line.startswith('COUNT_'):
@@ -108,10 +119,55 @@ def reader(node_name, worker_name, pipe, queue, nm, heartbeat_func):
             counter_shortname = counter_name[6:]
             if counter_shortname.endswith('Complete'):
                 heartbeat_func(counter_shortname)
-        if queue is None:
+        msgs.append(msg)
+    if queue is None:
+        for msg in msgs:
             log.info(msg, 'run.py')
-        else:
-            queue.put((msg, 'run.py'))
+    elif len(msgs) > 0:
+        queue.put((msgs, 'run.py'))
+
+
+def reader(node_name, worker_name, pipe, queue, nm, heartbeat_func, read_size=65536):
+    """
+    Take messages from the pipe (either stdout or stderr from the container
+    process) and relay them back to cluster.py via the given queue.  Whatever
+    lines are available from a single read are relayed together, so a chatty
+    container costs one queue put per read rather than one per line, while a
+    quiet one still has each line relayed as soon as it arrives.
+    """
+    fd = pipe.fileno()
+    partial = b''
+    while True:
+        buf = os.read(fd, read_size)
+        if len(buf) == 0:
+            break
+        lines = (partial + buf).split(b'\n')
+        partial = lines.pop()
+        relay_lines(node_name, worker_name, lines, queue, nm, heartbeat_func)
+    if len(partial) > 0:
+        relay_lines(node_name, worker_name, [partial], queue, nm, heartbeat_func)
+
+
+def supervise(cmd, node_name, worker_name, log_queue, heartbeat_func):
+    """
+    Run the container command, relaying its stdout and stderr, and return
+    its exitlevel.  We block in wait() rather than polling, so we return as
+    soon as the container process and its output streams are finished.
+    """
+    proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    t_out = threading.Thread(target=reader,
+                             args=[node_name, worker_name, proc.stdout, log_queue, 'out', heartbeat_func])
+    t_err = threading.Thread(target=reader,
+                             args=[node_name, worker_name, proc.stderr, log_queue, 'err', heartbeat_func])
+    t_out.start()
+    t_err.start()
+    log_info_detailed(node_name, worker_name, 'Waiting for container process %d' % proc.pid, log_queue)
+    proc.wait()
+    t_out.join()
+    t_err.join()
+    proc.stdout.close()
+    proc.stderr.close()
+    return proc.returncode
 
 
 def send_in_progress_to_destination(name, output_dir, source_prefix, mover, destination,
@@ -134,8 +190,140 @@ def send_in_progress_to_destination(name, output_dir, source_prefix, mover, dest
               logger=lambda x: log_info_detailed(node_name, worker_name, x, log_queue))
 
 
+def eager_eligible(fn):
+    """
+    Return True iff the output file named fn may be shipped to the
+    destination before the workflow finishes.  Per-run files that
+    copy_to_destination handles itself are excluded, as is the main
+    alignment BAM ({quad}~sorted.bam), which is deleted unless keep_bam is set.
+    """
+    if fn in ['stats.json', 'std.out'] or fn.startswith('.'):
+        return False
+    for ext in ['.manifest', '.done', '.sums', '.in_progress']:
+        if fn.endswith(ext):
+            return False
+    return '~' not in fn.split('.')[0]
+
+
+def output_signature(full_fn):
+    st = os.stat(full_fn)
+    return st.st_size, st.st_mtime
+
+
+class OutputWatcher(threading.Thread):
+    """
+    Ships finished outputs to the destination while the workflow is still
+    running.  Whenever a Snakemake rule completes (i.e. a COUNT_*Complete
+    line is relayed), the output directory is scanned, and files whose size
+    and mtime have not changed since the previous scan, and that haven't
+    been modified for quiet_secs, are shipped.  While files are waiting out
+    their quiet time, the directory is rescanned every quiet_secs.  Shipped
+    files and their signatures are recorded in self.shipped so that
+    copy_to_destination only re-sends those that changed afterwards.
+    """
+
+    def __init__(self, output_dir, source_prefix, mover, destination,
+                 log_queue=None, node_name='', worker_name='', quiet_secs=10.0):
+        super(OutputWatcher, self).__init__()
+        self.output_dir = output_dir
+        self.source_prefix = source_prefix
+        self.mover = mover
+        self.destination = destination
+        self.log_queue = log_queue
+        self.node_name = node_name
+        self.worker_name = worker_name
+        self.shipped = {}
+        self.digests = {}
+        self.last_seen = {}
+        self.quiet_secs = quiet_secs
+        self.pending = False  # whether files are waiting out their quiet time
+        self.wakeup = threading.Event()
+        self.stopping = False
+        self.daemon = True
+
+    def notify(self):
+        self.wakeup.set()
+
+    def finish(self):
+        """
+        Stop watching, waiting for any in-flight transfer to finish.
+        """
+        self.stopping = True
+        self.wakeup.set()
+        self.join()
+
+    def _log(self, msg):
+        log_info_detailed(self.node_name, self.worker_name, msg, self.log_queue)
+
+    def scan(self):
+        """
+        Return names of files that are stable since the previous scan,
+        unmodified for quiet_secs, and not yet shipped in their current form.
+        """
+        ready = []
+        seen = {}
+        self.pending = False
+        now = time.time()
+        for fn in os.listdir(self.output_dir):
+            full_fn = os.path.join(self.output_dir, fn)
+            if not eager_eligible(fn) or not os.path.isfile(full_fn):
+                continue
+            try:
+                sig = output_signature(full_fn)
+            except OSError:
+                continue  # removed out from under us
+            seen[fn] = sig
+            if self.shipped.get(fn) == sig:
+                continue
+            if self.last_seen.get(fn) == sig and now - sig[1] >= self.quiet_secs:
+                ready.append(fn)
+            else:
+                self.pending = True
+        self.last_seen = seen
+        return sorted(ready)
+
+    def run(self):
+        while True:
+            self.wakeup.wait(self.quiet_secs if self.pending else None)
+            self.wakeup.clear()
+            if self.stopping:
+                break
+            ready = self.scan()
+            if len(ready) == 0:
+                continue
+            sigs = dict((fn, self.last_seen[fn]) for fn in ready)
+            tot_sz = sum(sig[0] for sig in sigs.values())
+            self._log('Eagerly shipping %d files of total size %d: %s' % (len(ready), tot_sz, str(ready)))
+            try:
+                self.mover.multi(self.source_prefix + self.output_dir, self.destination, ready,
+                                 logger=self._log, digests=self.digests, priority='normal')
+            except Exception as e:
+                log_warn_detailed(self.node_name, self.worker_name,
+                                  'Eager shipping failed; leaving the rest for the end: %s' % str(e),
+                                  self.log_queue)
+                break
+            self.shipped.update(sigs)
+            log_info('COUNT_DestEagerBytesMoved %d' % tot_sz, self.log_queue)
+            log_info('COUNT_DestEagerFilesMoved %d' % len(ready), self.log_queue)
+
+
+def remove_shipped(dest_dir, fns, mover, log_queue=None, node_name='', worker_name=''):
+    """
+    Remove files shipped early from the destination directory, warning
+    about, but otherwise ignoring, any that can't be removed
+    """
+    for fn in fns:
+        try:
+            mover.remove(os.path.join(dest_dir, fn),
+                         logger=lambda x: log_info_detailed(node_name, worker_name, x, log_queue))
+        except Exception as e:
+            log_warn_detailed(node_name, worker_name,
+                              'could not remove "%s" from destination: %s' % (fn, str(e)), log_queue)
+
+
 def copy_to_destination(name, output_dir, source_prefix, extras, mover, destination,
-                        log_queue=None, node_name='', worker_name=''):
+                        log_queue=None, node_name='', worker_name='', staging_methods=None,
+                        shipped=None, shipped_digests=None, deferred=None):
     """
     There is one stats file per Snakemake invocation.  This function is
     currently assuming that there is one file in this batch to be copied to
@@ -143,7 +331,24 @@ def copy_to_destination(name, output_dir, source_prefix, extras, mover, destinat
     a single batch, all described by a single stats file.  I think that
     currently this will be copied to several subdirectories on the
     destination.
+
+    shipped maps names of files already sent by an OutputWatcher to their
+    (size, mtime) when sent; those still matching are not sent again.
+    shipped_digests holds the (size, MD5) the watcher computed for them.
+
+    Returns a dictionary mapping each file now at the destination to its
+    (size, MD5 hex digest).  Digests are computed during the transfer where
+    the mover can do so, otherwise by reading the local copy.
+
+    If deferred is a list, nothing is transferred; instead (source directory
+    URL, destination directory URL, file names) is appended to it for the
+    caller to hand to a globus_batch.GlobusBatcher.
     """
+    if shipped is None:
+        shipped = {}
+    if shipped_digests is None:
+        shipped_digests = {}
+    sums = {}
     log_info_detailed(node_name, worker_name,
                       'using mover to copy outputs from "%s" to "%s"' %
                       (output_dir, destination), log_queue)
@@ -158,7 +363,8 @@ def copy_to_destination(name, output_dir, source_prefix, extras, mover, destinat
             with open(fn, 'rt') as man_fh:
                 xfers = []
                 tot_sz = 0
-                for xfer_fn in man_fh.read().split():
+                manifest_fns = man_fh.read().split()
+                for xfer_fn in manifest_fns:
                     full_xfer_fn = os.path.join(output_dir, xfer_fn)
                     sz = os.path.getsize(full_xfer_fn)
                     log_info_detailed(node_name, worker_name,
@@ -168,6 +374,11 @@ def copy_to_destination(name, output_dir, source_prefix, extras, mover, destinat
                         raise RuntimeError('File "%s" was in manifest ("%s") '
                                            'but was not present in output '
                                            'directory' % (full_xfer_fn, fn))
+                    if shipped.get(xfer_fn) == output_signature(full_xfer_fn):
+                        log_info_detailed(node_name, worker_name,
+                                          'already shipped "%s"' % full_xfer_fn, log_queue)
+                        sums[xfer_fn] = shipped_digests.get(xfer_fn)
+                        continue
                     xfers.append(xfer_fn)
                     tot_sz += sz
                 for extra in extras:
@@ -179,8 +390,11 @@ def copy_to_destination(name, output_dir, source_prefix, extras, mover, destinat
                                           (full_extra, sz), log_queue)
                         new_name = srr + '.' + extra
                         new_name_full = os.path.join(output_dir, new_name)
-                        shutil.copy2(full_extra, new_name_full)
+                        method = link_or_copy(full_extra, new_name_full, methods=staging_methods)
                         assert os.path.exists(new_name_full)
+                        log_info_detailed(node_name, worker_name,
+                                          'staged extra file "%s" using %s' %
+                                          (new_name_full, method), log_queue)
                         xfers.append(new_name)
                         tot_sz += sz
                     else:
@@ -190,27 +404,132 @@ def copy_to_destination(name, output_dir, source_prefix, extras, mover, destinat
                 # name includes attempt
                 final_dest_dir = os.path.join(destination, name)
 
+                # files shipped early that the workflow didn't keep are junk
+                listed = set(manifest_fns) | set(xfers)
+                orphans = [fn for fn in sorted(shipped.keys()) if fn not in listed]
+                for fn_shipped in orphans:
+                    log_warn_detailed(node_name, worker_name,
+                                      'shipped "%s" early but it is not in manifest; removing it'
+                                      % fn_shipped, log_queue)
+                remove_shipped(final_dest_dir, orphans, mover, log_queue, node_name, worker_name)
+
                 log_info_detailed(node_name, worker_name,
                                   'Moving files of total size %d b: %s'
                                   % (tot_sz, str(xfers)), log_queue)
                 log_info('COUNT_DestXferPre 1', log_queue)
                 source = source_prefix + output_dir
-                mover.multi(source, final_dest_dir, xfers,
-                            logger=lambda x: log_info_detailed(node_name, worker_name, x, log_queue))
+                xfer_start = time.time()
+                if deferred is not None:
+                    deferred.append((source, final_dest_dir, list(xfers)))
+                elif len(xfers) > 0:
+                    mover.multi(source, final_dest_dir, xfers,
+                                logger=lambda x: log_info_detailed(node_name, worker_name, x, log_queue),
+                                digests=sums)
+                xfer_secs = time.time() - xfer_start
+                for xfer_fn in xfers:
+                    sums.setdefault(xfer_fn, None)
+                for xfer_fn in sums:
+                    if sums[xfer_fn] is None:
+                        sums[xfer_fn] = file_digest(os.path.join(output_dir, xfer_fn))
                 log_info('COUNT_DestXferPost 1', log_queue)
+                if deferred is not None:
+                    log_info_detailed(node_name, worker_name,
+                                      'Deferred moving %d files of total size %d to batcher'
+                                      % (len(xfers), tot_sz), log_queue)
+                    log_info('COUNT_DestBytesDeferred %d' % tot_sz, log_queue)
+                    break
                 log_info_detailed(node_name, worker_name,
-                                  'Finished moving %d files of total size %d'
-                                  % (len(xfers), tot_sz), log_queue)
+                                  'Finished moving %d files of total size %d in %0.3f secs'
+                                  % (len(xfers), tot_sz, xfer_secs), log_queue)
                 log_info('COUNT_DestBytesMoved %d' % tot_sz, log_queue)
                 log_info('COUNT_DestFilesMoved %d' % len(xfers), log_queue)
+                if tot_sz > 0 and xfer_secs > 0:
+                    log_info('COUNT_DestBytesPerSec %d' % int(tot_sz / xfer_secs), log_queue)
 
             break
+    return sums
+
+
+def write_sums(fn, sums):
+    """
+    Write a checksummed manifest: one "name<TAB>size<TAB>md5" line per file
+    """
+    with open(fn, 'wt') as fh:
+        for name in sorted(sums.keys()):
+            size, digest = sums[name]
+            fh.write('%s\t%d\t%s\n' % (name, size, digest))
+
+
+def flush_metrics(job_metrics, metrics_func, node_name, worker_name, log_queue):
+    """
+    Report a job's metrics: a summary line per metric to the log, counters
+    also as COUNT_ lines, then the whole batch to metrics_func.
+    """
+    if job_metrics.bad_lines > 0:
+        log_warn_detailed(node_name, worker_name, 'ignored %d malformed metrics lines'
+                          % job_metrics.bad_lines, log_queue)
+    if len(job_metrics) == 0:
+        return
+    for metric in job_metrics:
+        log_info_detailed(node_name, worker_name, 'metric ' + metric.summary(), log_queue)
+        if metric.kind == 'count':
+            log_info('COUNT_%s %d' % (metric.name, int(metric.total)), log_queue)
+    if metrics_func is not None:
+        try:
+            metrics_func(job_metrics)
+        except Exception as e:
+            log_warn_detailed(node_name, worker_name, 'could not record metrics: %s' % str(e), log_queue)
 
 
 def run_job(name, inputs, image_url, image_fn, config, cluster_ini, heartbeat_func,
             mover=None, destination=None, source_prefix=None,
             log_queue=None, fail_on_error=False, node_name='', worker_name='',
-            secure=False, keep=False, always_remove=True):
+            secure=False, keep=False, always_remove=True, metrics_func=None,
+            runtime_func=None, footprint=None, footprint_func=None, globus_batch_queue=None,
+            globus_batch_ticket=None, globus_batch_pid=None):
+    """
+    Run one job attempt in a container.  metrics_func, if given, is called
+    with the metrics.JobMetrics the container reported via RECOUNT_METRICS.
+    runtime_func, if given, is called after a successful attempt with the
+    (rule, seconds) pairs from its stats.json and its total input bases.
+    footprint, if given, is a scratch.FootprintModel prediction used in
+    place of the configured temp reservations.  footprint_func, if given, is
+    called with the attempt's peak usage (see scratch.FootprintSampler), its
+    input bases (or None) and whether it succeeded.  If globus_batch_queue
+    is given and both ends are Globus URLs, the outputs, .sums and .done are
+    handed to the node's globus_batch.GlobusBatcher rather than transferred
+    here, and it removes the output directory once they have landed.  The
+    job isn't finished then: run_job returns DEFERRED, and the batcher hands
+    globus_batch_ticket back to cluster.py once the job is published or
+    abandoned.  The job's output reservation, if any, then passes to the
+    batcher's process, globus_batch_pid, which releases it with the output
+    directory; the attempt's other scratch reservations are released
+    however it ends.
+    """
+    reserved = []  # (root, kind) of each scratch reservation the attempt holds
+    try:
+        return _run_job(name, inputs, image_url, image_fn, config, cluster_ini, heartbeat_func, reserved,
+                        mover=mover, destination=destination, source_prefix=source_prefix,
+                        log_queue=log_queue, fail_on_error=fail_on_error, node_name=node_name,
+                        worker_name=worker_name, secure=secure, keep=keep, always_remove=always_remove,
+                        metrics_func=metrics_func, runtime_func=runtime_func, footprint=footprint,
+                        footprint_func=footprint_func, globus_batch_queue=globus_batch_queue,
+                        globus_batch_ticket=globus_batch_ticket, globus_batch_pid=globus_batch_pid)
+    finally:
+        for root, kind in reserved:
+            scratch.release(root, name, kind=kind)
+
+
+def _run_job(name, inputs, image_url, image_fn, config, cluster_ini, heartbeat_func, reserved,
+             mover=None, destination=None, source_prefix=None,
+             log_queue=None, fail_on_error=False, node_name='', worker_name='',
+             secure=False, keep=False, always_remove=True, metrics_func=None,
+             runtime_func=None, footprint=None, footprint_func=None, globus_batch_queue=None,
+             globus_batch_ticket=None, globus_batch_pid=None):
+    """
+    Does the work of run_job, adding each scratch reservation it makes to
+    reserved and taking out any it hands over
+    """
     log_info_detailed(node_name, worker_name, 'job name: %s, image-url: "%s", image-fn: "%s"' %
                       (name, image_url, image_fn), log_queue)
     if not os.path.exists(cluster_ini):
@@ -227,10 +546,23 @@ def run_job(name, inputs, image_url, image_fn, config, cluster_ini, heartbeat_fu
     input_base = _expand(cfg.get(section, 'input_base'))
     output_base = _expand(cfg.get(section, 'output_base'))
     ref_base = _expand(cfg.get(section, 'ref_base'))
-    temp_base = _expand(cfg.get(section, 'temp_base'))
-    temp_big_base = None
+    # temp_base and temp_big_base may list several candidate roots; one of
+    # each is chosen below once they are known to exist
+    temp_roots = scratch.parse_roots(cfg.get(section, 'temp_base'))
+    temp_big_roots = None
     if cfg.has_option(section, 'temp_big_base'):
-        temp_big_base = _expand(cfg.get(section, 'temp_big_base'))
+        temp_big_roots = scratch.parse_roots(cfg.get(section, 'temp_big_base'))
+    temp_reserve_gb, temp_big_reserve_gb = 2.0, 20.0
+    if cfg.has_option(section, 'temp_reserve_gb'):
+        temp_reserve_gb = float(cfg.get(section, 'temp_reserve_gb'))
+    if cfg.has_option(section, 'temp_big_reserve_gb'):
+        temp_big_reserve_gb = float(cfg.get(section, 'temp_big_reserve_gb'))
+    footprint_interval = 60
+    if cfg.has_option(section, 'footprint_interval'):
+        footprint_interval = int(cfg.get(section, 'footprint_interval'))
+    io_weight = scratch.DEFAULT_IO_WEIGHT
+    if cfg.has_option(section, 'temp_io_weight_mb'):
+        io_weight = float(cfg.get(section, 'temp_io_weight_mb')) * 1024 * 1024
     system = 'docker'
     if cfg.has_option(section, 'system'):
         system = cfg.get(section, 'system')
@@ -244,24 +576,43 @@ def run_job(name, inputs, image_url, image_fn, config, cluster_ini, heartbeat_fu
     sudo = False
     if cfg.has_option(section, 'sudo'):
         sudo = cfg.get(section, 'sudo').lower() == 'true'
+    staging_methods = DEFAULT_STAGING_METHODS
+    if cfg.has_option(section, 'staging'):
+        staging_methods = parse_staging_methods(cfg.get(section, 'staging'))
+    persistent = False
+    if cfg.has_option(section, 'persistent'):
+        persistent = cfg.get(section, 'persistent').lower() == 'true'
+    persistent_max_jobs = 20
+    if cfg.has_option(section, 'persistent_max_jobs'):
+        persistent_max_jobs = int(cfg.get(section, 'persistent_max_jobs'))
+    eager_upload = False
+    if cfg.has_option(section, 'eager_upload'):
+        eager_upload = cfg.get(section, 'eager_upload').lower() == 'true'
+    remove_dir = shutil.rmtree
+    if scratch.cleanup_roots(cfg, section) is not None:
+        # leave the deleting to the node's scratch.Reaper
+        def remove_dir(path):
+            scratch.trash(path, logger=lambda x: log_info_detailed(node_name, worker_name, x, log_queue))
 
     input_base = os.path.expanduser(input_base)
     output_base = os.path.expanduser(output_base)
     ref_base = os.path.expanduser(ref_base)
-    temp_base = os.path.expanduser(temp_base)
-    if temp_big_base is not None: 
-        temp_big_base = os.path.expanduser(temp_big_base)
 
     log_info_detailed(node_name, worker_name, 'inputs: ' + str(inputs), log_queue)
     log_info_detailed(node_name, worker_name, 'using %s as container system' % system, log_queue)
     log_info_detailed(node_name, worker_name, 'using sudo: %s' % str(sudo), log_queue)
     log_info_detailed(node_name, worker_name, 'using %d cpus' % cpus, log_queue)
+    log_info_detailed(node_name, worker_name, 'staging methods: ' + ','.join(staging_methods), log_queue)
+    log_info_detailed(node_name, worker_name, 'eager upload: %s' % str(eager_upload), log_queue)
+    log_info_detailed(node_name, worker_name, 'async cleanup: %s' % str(remove_dir != shutil.rmtree), log_queue)
+    log_info_detailed(node_name, worker_name, 'persistent container: %s (max jobs %d)' %
+                      (str(persistent), persistent_max_jobs), log_queue)
     log_info_detailed(node_name, worker_name, 'input base: ' + input_base, log_queue)
     log_info_detailed(node_name, worker_name, 'output base: ' + output_base, log_queue)
     log_info_detailed(node_name, worker_name, 'reference base: ' + ref_base, log_queue)
-    log_info_detailed(node_name, worker_name, 'temp base: ' + temp_base, log_queue)
-    if temp_big_base is not None: 
-        log_info_detailed(node_name, worker_name, 'temp_big base: ' + temp_big_base, log_queue)
+    log_info_detailed(node_name, worker_name, 'temp base candidates: ' + ','.join(temp_roots), log_queue)
+    if temp_big_roots is not None:
+        log_info_detailed(node_name, worker_name, 'temp_big base candidates: ' + ','.join(temp_big_roots), log_queue)
 
     original_umask = None
     if system == 'docker' and secure:
@@ -285,25 +636,49 @@ def run_job(name, inputs, image_url, image_fn, config, cluster_ini, heartbeat_fu
         elif not os.path.isdir(output_base):
             raise RuntimeError('output_base "%s" exists but is not a directory' % output_base)
         isdir(output_base)
-        if not os.path.exists(temp_base):
-            try:
-                os.makedirs(temp_base)
-            except os.error:
-                pass
-        elif not os.path.isdir(temp_base):
-            raise RuntimeError('temp_base "%s" exists but is not a directory' % temp_base)
-        assert os.path.exists(temp_base) and os.path.isdir(temp_base)
-        if temp_big_base is not None: 
-            if not os.path.exists(temp_big_base):
+        for temp_root in temp_roots:
+            if not os.path.exists(temp_root):
+                try:
+                    os.makedirs(temp_root)
+                except os.error:
+                    pass
+            elif not os.path.isdir(temp_root):
+                raise RuntimeError('temp_base "%s" exists but is not a directory' % temp_root)
+            assert os.path.exists(temp_root) and os.path.isdir(temp_root)
+        for temp_root in (temp_big_roots or []):
+            if not os.path.exists(temp_root):
                 try:
-                    os.makedirs(temp_big_base)
+                    os.makedirs(temp_root)
                 except os.error:
                     pass
-            elif not os.path.isdir(temp_big_base):
-                raise RuntimeError('temp_base "%s" exists but is not a directory' % temp_big_base)
-            assert os.path.exists(temp_big_base) and os.path.isdir(temp_big_base)
+            elif not os.path.isdir(temp_root):
+                raise RuntimeError('temp_base "%s" exists but is not a directory' % temp_root)
+            assert os.path.exists(temp_root) and os.path.isdir(temp_root)
         isdir(ref_base)
 
+        gb = 1024 * 1024 * 1024
+        temp_need, temp_big_need = int(temp_reserve_gb * gb), int(temp_big_reserve_gb * gb)
+        if footprint is not None:
+            if footprint.get('temp') is not None:
+                temp_need = footprint['temp']
+                if temp_big_roots is None and footprint.get('big') is not None:
+                    temp_need += footprint['big']
+            if footprint.get('big') is not None:
+                temp_big_need = footprint['big']
+            if footprint.get('output') is not None:
+                scratch.reserve(output_base, name, footprint['output'], kind='output')
+                reserved.append((output_base, 'output'))
+        temp_base = scratch.place(name, temp_roots, temp_need, io_weight=io_weight,
+                                  logger=lambda x: log_info_detailed(node_name, worker_name, x, log_queue))
+        reserved.append((temp_base, 'temp'))
+        log_info_detailed(node_name, worker_name, 'temp base: ' + temp_base, log_queue)
+        temp_big_base = None
+        if temp_big_roots is not None:
+            temp_big_base = scratch.place(name, temp_big_roots, temp_big_need, kind='big',
+                                          io_weight=io_weight, logger=lambda x: log_info_detailed(node_name, worker_name, x, log_queue))
+            reserved.append((temp_big_base, 'big'))
+            log_info_detailed(node_name, worker_name, 'temp_big base: ' + temp_big_base, log_queue)
+
         subdir_clear(input_base, name)
         subdir_clear(output_base, name)
         subdir_clear(temp_base, name)
@@ -332,8 +707,9 @@ def run_job(name, inputs, image_url, image_fn, config, cluster_ini, heartbeat_fu
         for inp in inputs:
             assert os.path.exists(inp)
             dest = os.path.join(input_base_name, os.path.basename(inp))
-            shutil.copy2(inp, dest)
+            method = link_or_copy(inp, dest, methods=staging_methods)
             assert os.path.exists(dest)
+            log_info_detailed(node_name, worker_name, 'staged input "%s" using %s' % (dest, method), log_queue)
         staged_inputs = []
         for fn in os.listdir(input_base_name):
             full_fn = os.path.join(input_base_name, fn)
@@ -389,7 +765,8 @@ def run_job(name, inputs, image_url, image_fn, config, cluster_ini, heartbeat_fu
                'RECOUNT_TEMP=%s' % temp_mount,
                'RECOUNT_TEMP_BIG=%s' % temp_big_mount,
                'RECOUNT_CPUS=%d' % cpus,
-               'RECOUNT_REF=%s' % ref_mount]
+               'RECOUNT_REF=%s' % ref_mount,
+               'RECOUNT_METRICS=%s' % os.path.join(temp_mount, METRICS_FIFO)]
     cmd_run = '/bin/bash -c "source activate recount && /startup.sh && /workflow.bash"'
 
     # copy config into input directory
@@ -407,86 +784,275 @@ def run_job(name, inputs, image_url, image_fn, config, cluster_ini, heartbeat_fu
     if docker:
         if image.startswith('docker://'):
             image = image[len('docker://'):]
+    elif image_fn is not None and os.path.exists(image_fn):
+        image = image_fn
+    if persistent:
+        # The instance sees the base directories at their host paths, so
+        # per-job directories are named in the environment instead of being
+        # bound one by one.  The reference is bound once, where configured.
+        binds = [(d, d) for d in [input_base, output_base] + temp_roots + (temp_big_roots or [])]
+        binds.append((ref_base, ref_mount))
+        inst = instance.acquire(system, image, binds, sudo=sudo, max_jobs=persistent_max_jobs,
+                                logger=lambda x: log_info_detailed(node_name, worker_name, x, log_queue))
+        job_env = ['RECOUNT_JOB_ID=%s' % name,
+                   'RECOUNT_INPUT=%s' % input_base_name,
+                   'RECOUNT_OUTPUT=%s' % output_dir,
+                   'RECOUNT_TEMP=%s' % temp_base_name,
+                   'RECOUNT_TEMP_BIG=%s' % (temp_base_name if temp_big_base is None else temp_big_base_name),
+                   'RECOUNT_CPUS=%d' % cpus,
+                   'RECOUNT_REF=%s' % ref_mount,
+                   'RECOUNT_METRICS=%s' % os.path.join(temp_base_name, METRICS_FIFO)]
+        cmd = inst.exec_command(job_env, '/bin/bash -c "source activate recount && /workflow.bash"')
+    elif docker:
         cmd = 'docker'
         if sudo:
             cmd = 'sudo ' + cmd
         cmd += (' run %s %s %s %s' % (to_docker_env(cmd_env), ' '.join(mounts), image, cmd_run))
     else:
-        if image_fn is not None and os.path.exists(image_fn):
-            image = image_fn
         cmd = '%s singularity exec %s %s %s' % (to_singularity_env(cmd_env), ' '.join(mounts), image, cmd_run)
     log_info_detailed(node_name, worker_name, 'command: ' + cmd, log_queue)
-    proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    t_out = threading.Thread(target=reader,
-                             args=[node_name, worker_name, proc.stdout, log_queue, 'out', heartbeat_func])
-    t_err = threading.Thread(target=reader,
-                             args=[node_name, worker_name, proc.stderr, log_queue, 'err', heartbeat_func])
-    t_out.start()
-    t_err.start()
-    log_info_detailed(node_name, worker_name, 'Entering polling loop', log_queue)
-    while proc.poll() is None:
-        if not t_out.is_alive():
-            log.warning('Output reader thread ended prematurely', 'run.py')
-            t_out.join()
-        if not t_err.is_alive():
-            log.warning('Error reader thread ended prematurely', 'run.py')
-            t_err.join()
-        time.sleep(5)
-    proc.wait()
-    t_out.join()
-    t_err.join()
-    ret = proc.returncode
-    if not keep and (always_remove or ret == 0):
-        log_info_detailed(node_name, worker_name, 'Removing input & temporary directories', log_queue)
-        shutil.rmtree(os.path.join(input_base, name))
-        shutil.rmtree(os.path.join(temp_base, name))
-        if temp_big_base is not None: 
-            shutil.rmtree(os.path.join(temp_big_base, name))
-
-    if ret != 0 and fail_on_error:
-        for _ in range(50):
-            log_info('Container returned non-zero exitlevel %d' % ret, log_queue)
-        raise RuntimeError('Container returned non-zero exitlevel %d' % ret)
-
-    log_info('COUNT_RunWorkflowPost 1', log_queue)
-
-    stats_fn = os.path.join(output_dir, 'stats.json')
-    assert ret != 0 or (os.path.exists(stats_fn) and os.path.isfile(stats_fn))
-    if os.path.exists(stats_fn) and os.path.isfile(stats_fn):
-        for counter in stats.summarize(stats_fn):
-            log_info('COUNT_%sWallTime %0.3f' % (counter[0], counter[1]), log_queue)
-
-    if ret == 0:
-        # Copy files to ultimate destination, if one is specified
-        if mover is not None and destination is not None and len(destination) > 0:
-            log_info_detailed(node_name, worker_name, 'About to copy_to_destination', log_queue)
-            copy_to_destination(name, output_dir, source_prefix, ['stats.json'], mover,
-                                destination, log_queue, node_name, worker_name)
-
-            done_basename = name + '.done'
-            done_temp = os.path.join(output_dir, done_basename)
-            with open(done_temp, 'wt') as fh:
-                fh.write('Node: %s\n' % node_name)
-                fh.write('Worker: %s\n' % worker_name)
-
-            log_info_detailed(node_name, worker_name, 'About to put .done file', log_queue)
-            done_temp = source_prefix + done_temp
-            mover.put(done_temp, os.path.join(destination, done_basename),
-                      logger=lambda x: log_info_detailed(node_name, worker_name, x, log_queue))
-
-        if not keep:
-            shutil.rmtree(output_dir)
-
-        log_info('COUNT_RunWorkflowSuccess 1', log_queue)
-    else:
-        log_warn_detailed(node_name, worker_name, 'Non-0 exitlevel from container: %d' % ret, log_queue)
-        log_info('COUNT_RunWorkflowFailure 1', log_queue)
+    watcher = None
+    has_destination = mover is not None and destination is not None and len(destination) > 0
+    # the job's transfers are reported with its metrics when it's done
+    job_transfers = []
+    if mover is not None:
+        mover.recorders.append(job_transfers.append)
+
+    def _flush_transfers():
+        if mover is not None and job_transfers.append in mover.recorders:
+            mover.recorders.remove(job_transfers.append)
+            # the mover's histograms per endpoint, since the previous job
+            for line in mover.transfer_stats.report(reset=True):
+                log_info_detailed(node_name, worker_name, 'transfers ' + line, log_queue)
+            flush_metrics(transfers.job_metrics(job_transfers), metrics_func, node_name, worker_name, log_queue)
+
+    try:
+        metrics_reader, sampler, ret = None, None, None
+        try:
+            metrics_reader = MetricsReader(temp_base_name)
+            metrics_reader.start()
+            sampler = scratch.FootprintSampler({'temp': temp_base_name, 'output': output_dir,
+                                                'big': None if temp_big_base is None else temp_big_base_name},
+                                               interval=footprint_interval)
+            if footprint_interval > 0:
+                sampler.start()
+            if eager_upload and has_destination:
+                # name includes attempt
+                watcher = OutputWatcher(output_dir, source_prefix, mover, os.path.join(destination, name),
+                                        log_queue, node_name, worker_name)
+                watcher.start()
+
+                def _heartbeat(st):
+                    heartbeat_func(st)
+                    watcher.notify()
+
+                ret = supervise(cmd, node_name, worker_name, log_queue, _heartbeat)
+            else:
+                ret = supervise(cmd, node_name, worker_name, log_queue, heartbeat_func)
+        finally:
+            # stop the helper threads (and remove the metrics FIFO) even if
+            # the container couldn't be run; an instance that saw an error
+            # is recycled
+            if watcher is not None:
+                watcher.finish()
+            job_metrics = None if metrics_reader is None else metrics_reader.finish()
+            peaks = {} if sampler is None else sampler.finish()
+            if persistent:
+                instance.job_finished(ret == 0, logger=lambda x: log_info_detailed(node_name, worker_name, x, log_queue))
+        if ret != 0 and watcher is not None and len(watcher.shipped) > 0:
+            # no .sums or .done will vouch for what was shipped early
+            log_warn_detailed(node_name, worker_name, 'Removing %d eagerly shipped files from failed attempt' %
+                              len(watcher.shipped), log_queue)
+            remove_shipped(os.path.join(destination, name), sorted(watcher.shipped.keys()), mover,
+                           log_queue, node_name, worker_name)
+        flush_metrics(job_metrics, metrics_func, node_name, worker_name, log_queue)
+        log_info_detailed(node_name, worker_name, 'peak usage: ' +
+                          ', '.join('%s=%d' % (k, v) for k, v in sorted(peaks.items())), log_queue)
+        if footprint_func is not None:
+            try:
+                footprint_func(peaks, stats.input_bases(output_dir) if os.path.isdir(output_dir) else None, ret == 0)
+            except Exception as e:
+                log_warn_detailed(node_name, worker_name, 'could not record footprint: %s' % str(e), log_queue)
+        # temp space is free as soon as the container is done with it
+        scratch.release(temp_base, name)
+        if temp_big_base is not None:
+            scratch.release(temp_big_base, name, kind='big')
+        if not keep and (always_remove or ret == 0):
+            log_info_detailed(node_name, worker_name, 'Removing input & temporary directories', log_queue)
+            remove_dir(os.path.join(input_base, name))
+            remove_dir(os.path.join(temp_base, name))
+            if temp_big_base is not None: 
+                remove_dir(os.path.join(temp_big_base, name))
+
+        if ret != 0 and fail_on_error:
+            for _ in range(50):
+                log_info('Container returned non-zero exitlevel %d' % ret, log_queue)
+            raise RuntimeError('Container returned non-zero exitlevel %d' % ret)
+
+        log_info('COUNT_RunWorkflowPost 1', log_queue)
+
+        stats_fn = os.path.join(output_dir, 'stats.json')
+        assert ret != 0 or (os.path.exists(stats_fn) and os.path.isfile(stats_fn))
+        if os.path.exists(stats_fn) and os.path.isfile(stats_fn):
+            counters = stats.summarize(stats_fn)
+            for counter in counters:
+                log_info('COUNT_%sWallTime %0.3f' % (counter[0], counter[1]), log_queue)
+            if ret == 0 and runtime_func is not None:
+                try:
+                    runtime_func(counters, stats.input_bases(output_dir))
+                except Exception as e:
+                    log_warn_detailed(node_name, worker_name, 'could not record rule runtimes: %s' % str(e), log_queue)
+
+        deferred_to_batcher = False
+        if ret == 0:
+            keep_output = False
+            # Copy files to ultimate destination, if one is specified
+            if has_destination:
+                log_info_detailed(node_name, worker_name, 'About to copy_to_destination', log_queue)
+                deferred = None
+                if globus_batch_queue is not None and destination.startswith('globus://') and \
+                        source_prefix.startswith('globus://'):
+                    deferred = []
+                sums = copy_to_destination(name, output_dir, source_prefix, ['stats.json'], mover,
+                                           destination, log_queue, node_name, worker_name,
+                                           staging_methods=staging_methods,
+                                           shipped=None if watcher is None else watcher.shipped,
+                                           shipped_digests=None if watcher is None else watcher.digests,
+                                           deferred=deferred)
+
+                # checksummed manifest goes next to the .done file, and before it
+                sums_basename = name + '.sums'
+                sums_temp = os.path.join(output_dir, sums_basename)
+                write_sums(sums_temp, sums)
+                if deferred is None:
+                    log_info_detailed(node_name, worker_name, 'About to put .sums file', log_queue)
+                    mover.put(source_prefix + sums_temp, os.path.join(destination, sums_basename),
+                              logger=lambda x: log_info_detailed(node_name, worker_name, x, log_queue))
+
+                done_basename = name + '.done'
+                done_temp = os.path.join(output_dir, done_basename)
+                with open(done_temp, 'wt') as fh:
+                    fh.write('Node: %s\n' % node_name)
+                    fh.write('Worker: %s\n' % worker_name)
+
+                if deferred is None:
+                    log_info_detailed(node_name, worker_name, 'About to put .done file', log_queue)
+                    done_temp = source_prefix + done_temp
+                    mover.put(done_temp, os.path.join(destination, done_basename),
+                              logger=lambda x: log_info_detailed(node_name, worker_name, x, log_queue))
+                else:
+                    source, dest_dir, files = deferred[0] if len(deferred) > 0 else \
+                        (source_prefix + output_dir, os.path.join(destination, name), [])
+                    log_info_detailed(node_name, worker_name,
+                                      'Handing %d files to Globus batcher' % len(files), log_queue)
+                    reservation = None
+                    if not keep and (output_base, 'output') in reserved and globus_batch_pid is not None:
+                        # the output stays put until the batcher has shipped it
+                        scratch.hand_over(output_base, name, 'output', globus_batch_pid)
+                        reserved.remove((output_base, 'output'))
+                        reservation = (output_base, 'output')
+                    globus_batch.submit_job(globus_batch_queue, name, source, dest_dir, files,
+                                            [(source_prefix + done_temp, os.path.join(destination, done_basename))],
+                                            extras=[(source_prefix + sums_temp,
+                                                     os.path.join(destination, sums_basename))],
+                                            cleanup_dir=None if keep else output_dir,
+                                            ticket=globus_batch_ticket, reservation=reservation)
+                    keep_output = True  # the batcher removes it once it's shipped
+                    deferred_to_batcher = True
+
+            if not keep and not keep_output:
+                remove_dir(output_dir)
+
+            log_info('COUNT_RunWorkflowSuccess 1', log_queue)
+        else:
+            log_warn_detailed(node_name, worker_name, 'Non-0 exitlevel from container: %d' % ret, log_queue)
+            log_info('COUNT_RunWorkflowFailure 1', log_queue)
+    finally:
+        # whether or not the job got this far, stop collecting its transfers
+        _flush_transfers()
 
     # Special handling of stats.json so it can be converted to counters
 
+    if deferred_to_batcher:
+        return DEFERRED
     return ret == 0
 
 
+def _make_outputs(output_dir, names):
+    for fn in names:
+        with open(os.path.join(output_dir, fn), 'w') as fh:
+            fh.write(fn + '\n')
+
+
+def test_eager_eligible():
+    assert eager_eligible('q.all.bw')
+    assert eager_eligible('q.unmapped~sorted.bam')
+    assert not eager_eligible('q~sorted.bam')
+    assert not eager_eligible('q~sorted.bam.bai')
+    assert not eager_eligible('q.manifest')
+    assert not eager_eligible('job.sums')
+    assert not eager_eligible('stats.json')
+
+
+def test_output_watcher():
+    from mover import Mover
+    import tempfile
+    tmpdir = tempfile.mkdtemp()
+    output_dir, dest = os.path.join(tmpdir, 'out'), os.path.join(tmpdir, 'dest')
+    os.makedirs(output_dir)
+    _make_outputs(output_dir, ['q.all.bw', 'q~sorted.bam'])
+    watcher = OutputWatcher(output_dir, 'local://', Mover(), dest, quiet_secs=0.2)
+    assert [] == watcher.scan()  # nothing is stable yet
+    assert [] == watcher.scan()  # stable, but written too recently
+    assert watcher.pending
+    watcher.start()
+    watcher.notify()
+    for _ in range(100):
+        if len(watcher.shipped) > 0:
+            break
+        watcher.notify()
+        time.sleep(0.05)
+    watcher.finish()
+    assert ['q.all.bw'] == list(watcher.shipped.keys())
+    assert os.path.exists(os.path.join(dest, 'q.all.bw'))
+    assert not os.path.exists(os.path.join(dest, 'q~sorted.bam'))
+    shutil.rmtree(tmpdir)
+
+
+def test_copy_to_destination_shipped():
+    from mover import Mover
+    import tempfile
+    tmpdir = tempfile.mkdtemp()
+    output_dir, dest = os.path.join(tmpdir, 'out'), os.path.join(tmpdir, 'dest')
+    os.makedirs(output_dir)
+    _make_outputs(output_dir, ['q.a', 'q.b', 'q.c', 'stats.json'])
+    with open(os.path.join(output_dir, 'q.manifest'), 'w') as fh:
+        fh.write('q.a\nq.b\nq.c\n')
+    shipped = {'q.a': output_signature(os.path.join(output_dir, 'q.a')),
+               'q.b': (0, 0.0),  # changed since it was shipped
+               'q.tmp': (4, 0.0)}  # shipped, then deleted by the workflow
+    os.makedirs(os.path.join(dest, 'job'))
+    with open(os.path.join(dest, 'job', 'q.tmp'), 'w') as fh:
+        fh.write('tmp\n')
+    sums = copy_to_destination('job', output_dir, 'local://', ['stats.json'], Mover(), dest, shipped=shipped)
+    assert ['q.b', 'q.c', 'q.stats.json'] == sorted(os.listdir(os.path.join(dest, 'job')))
+    assert ['q.a', 'q.b', 'q.c', 'q.stats.json'] == sorted(sums.keys())
+    import hashlib
+    assert (4, hashlib.md5(b'q.a\n').hexdigest()) == sums['q.a']
+    assert (4, hashlib.md5(b'q.c\n').hexdigest()) == sums['q.c']
+    shutil.rmtree(tmpdir)
+
+
+def test_remove_shipped():
+    from mover import Mover
+    import tempfile
+    tmpdir = tempfile.mkdtemp()
+    _make_outputs(tmpdir, ['q.a', 'q.b'])
+    remove_shipped(tmpdir, ['q.a', 'q.missing'], Mover())
+    assert ['q.b'] == os.listdir(tmpdir)
+    shutil.rmtree(tmpdir)
+
+
 def go():
     args = docopt(__doc__)
 
@@ -512,6 +1078,12 @@ def go():
             run_job(args['<name>'], args['<input>'], args['<image-url>'],
                     args['<image-fn>'], config, cluster_ini, lambda x: True,
                     keep=args['--keep'], fail_on_error=args['--fail-on-error'])
+            # no reaper runs alongside a single job, so empty the trash here
+            cfg = RawConfigParser()
+            cfg.read(cluster_ini)
+            roots = scratch.cleanup_roots(cfg, cfg.sections()[0])
+            if roots is not None:
+                scratch.reap(roots)
     except Exception:
         log.error('Uncaught exception:', 'run.py')
         raise
@@ -0,0 +1,822 @@
+#!/usr/bin/env python
+
+# Author: Ben Langmead <ben.langmead@gmail.com>
+# License: MIT
+
+"""
+scratch.py
+
+Decide where a job's temporary files go.  temp_base and temp_big_base in
+cluster.ini may each be a comma-separated list of candidate roots (e.g. two
+local SSDs, or /dev/shm for the small temp directory).  For each job we
+pick the root with the best combination of free space, space already
+promised to other in-flight jobs, and recent IO throughput on its device.
+
+Promises are recorded as small reservation files under
+<root>/.reservations/, so that workers on the same node (or on different
+nodes sharing the root) see each other's claims before the space is
+actually used.
+
+FootprintModel predicts a job's peak temp, temp_big and output usage from
+earlier jobs (see stats.JobFootprint), and fits() checks a prediction
+against what the roots can spare, so a worker can pass on a job that would
+run out of space hours in.
+
+When async_cleanup is enabled, a finished job's directories are not deleted
+by the worker.  They are renamed into <root>/.trash/<host>/, which is quick
+even on Lustre/GPFS, and a low-priority Reaper process on the node deletes
+them in the background.
+"""
+
+import os
+import math
+import time
+import socket
+import tempfile
+import shutil
+import threading
+import multiprocessing
+import psutil
+import sys
+import log
+
+if sys.version[:1] == '2':
+    from ConfigParser import RawConfigParser
+else:
+    from configparser import RawConfigParser
+
+RESERVATION_DIR = '.reservations'
+TRASH_DIR = '.trash'
+
+# below this fraction of free space, the reaper stops pausing between entries
+DEFAULT_PRESSURE_FRAC = 0.1
+
+# passes over a trash entry that can't be fully deleted before it is set aside
+DEFAULT_REAP_ATTEMPTS = 5
+
+# IO throughput (bytes/sec) at which a device's free space counts half as much
+DEFAULT_IO_WEIGHT = 100 * 1024 * 1024
+
+
+def parse_roots(st):
+    """
+    Parse a comma-separated list of temp roots, expanding ~
+    """
+    return [os.path.expanduser(x.strip()) for x in st.split(',') if len(x.strip()) > 0]
+
+
+def free_bytes(root):
+    st = os.statvfs(root)
+    return st.f_bavail * st.f_frsize
+
+
+def device_name(path):
+    """
+    Return the kernel's name for the block device holding path (e.g.
+    "nvme0n1p1"), or None if it has none (tmpfs, overlay, NFS, ...)
+    """
+    dev = os.stat(path).st_dev
+    uevent = '/sys/dev/block/%d:%d/uevent' % (os.major(dev), os.minor(dev))
+    if not os.path.exists(uevent):
+        return None
+    with open(uevent) as fh:
+        for ln in fh:
+            if ln.startswith('DEVNAME='):
+                return ln.rstrip().split('=', 1)[1]
+    return None
+
+
+class IoMonitor(threading.Thread):
+    """
+    Samples every block device's combined read and write throughput
+    (bytes/sec) each interval seconds, so placing a job reads the latest
+    rates instead of waiting out a fresh sample.
+    """
+
+    def __init__(self, interval=0.5):
+        super(IoMonitor, self).__init__()
+        self.daemon = True
+        self.interval = interval
+        self.rates = {}
+        self.sampled = threading.Event()
+        self.pid = os.getpid()  # the process it samples for
+
+    def run(self):
+        before = psutil.disk_io_counters(perdisk=True)
+        while True:
+            time.sleep(self.interval)
+            after = psutil.disk_io_counters(perdisk=True)
+            rates = {}
+            for dev in after:
+                if dev in before:
+                    moved = (after[dev].read_bytes - before[dev].read_bytes) + \
+                            (after[dev].write_bytes - before[dev].write_bytes)
+                    rates[dev] = max(0, moved) / float(self.interval)
+            self.rates, before = rates, after
+            self.sampled.set()
+
+
+_io_monitor = None
+
+
+def io_monitor(interval=0.5):
+    """
+    Return this process's IoMonitor, starting one if needed.  Threads don't
+    survive a fork, so each worker process gets its own.
+    """
+    global _io_monitor
+    if _io_monitor is None or _io_monitor.pid != os.getpid():
+        _io_monitor = IoMonitor(interval=interval)
+        _io_monitor.start()
+    return _io_monitor
+
+
+def io_rates(roots, interval=0.5):
+    """
+    Return a dictionary mapping each root to the combined read and write
+    throughput (bytes/sec) of its device, as last sampled by the process's
+    IoMonitor.  Only the first call in a process waits, for one interval.
+    Roots without a block device are reported as idle.
+    """
+    devices = dict((root, device_name(root)) for root in roots)
+    if all(dev is None for dev in devices.values()):
+        return dict((root, 0.0) for root in roots)
+    monitor = io_monitor(interval=interval)
+    monitor.sampled.wait(2 * monitor.interval)
+    rates = monitor.rates
+    return dict((root, rates.get(dev, 0.0)) for root, dev in devices.items())
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == 1  # EPERM: exists, but not ours
+    return True
+
+
+def _read_reservation(fn):
+    """
+    Return (host, pid, bytes) for a reservation file, or None if it is
+    unreadable (e.g. being written).
+    """
+    try:
+        with open(fn) as fh:
+            host, pid, nbytes = fh.read().split()
+        return host, int(pid), int(nbytes)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def reservations(root):
+    """
+    Return a dictionary mapping reservation name ("<job>.<kind>") to
+    (host, pid, bytes) for each live reservation in root.  Reservations
+    made by processes on this host that have since died are removed.
+    """
+    res_dir = os.path.join(root, RESERVATION_DIR)
+    if not os.path.isdir(res_dir):
+        return {}
+    hostname = socket.gethostname()
+    live = {}
+    for name in os.listdir(res_dir):
+        fn = os.path.join(res_dir, name)
+        res = _read_reservation(fn)
+        if res is None:
+            continue
+        host, pid, _ = res
+        if host == hostname and not _pid_alive(pid):
+            try:
+                os.remove(fn)
+            except OSError:
+                pass
+            continue
+        live[name] = res
+    return live
+
+
+def reserved_bytes(root, exclude_pid=None):
+    """
+    Total bytes promised to in-flight jobs under root, not counting those
+    made by exclude_pid on this host.
+    """
+    hostname = socket.gethostname()
+    tot = 0
+    for host, pid, nbytes in reservations(root).values():
+        if host == hostname and pid == exclude_pid:
+            continue
+        tot += nbytes
+    return tot
+
+
+def _reservation_name(job, kind):
+    return '%s.%s' % (job, kind)
+
+
+def release(root, job, kind='temp'):
+    fn = os.path.join(root, RESERVATION_DIR, _reservation_name(job, kind))
+    if os.path.exists(fn):
+        os.remove(fn)
+
+
+def hand_over(root, job, kind, pid):
+    """
+    Make the given process, on this host, the owner of a reservation, so it
+    outlives the worker moving on to its next job.  The new owner releases
+    it.  Does nothing if there is no such reservation.
+    """
+    fn = os.path.join(root, RESERVATION_DIR, _reservation_name(job, kind))
+    res = _read_reservation(fn)
+    if res is None:
+        return
+    tmp_fn = '%s.%d' % (os.path.join(root, RESERVATION_DIR, '.' + _reservation_name(job, kind)), os.getpid())
+    with open(tmp_fn, 'w') as fh:
+        fh.write('%s %d %d\n' % (socket.gethostname(), pid, res[2]))
+    os.rename(tmp_fn, fn)
+
+
+def reserve(root, job, nbytes, kind='temp'):
+    """
+    Record that the given job expects to use nbytes under root for its
+    temp files of the given kind ("temp" or "big").  A worker runs one job
+    at a time, so reservations this process made for other jobs are dropped.
+    """
+    res_dir = os.path.join(root, RESERVATION_DIR)
+    if not os.path.exists(res_dir):
+        try:
+            os.makedirs(res_dir)
+        except OSError:
+            pass  # another worker made it
+    hostname, pid = socket.gethostname(), os.getpid()
+    for old_name, (host, old_pid, _) in reservations(root).items():
+        old_job, old_kind = old_name.rsplit('.', 1)
+        if host == hostname and old_pid == pid and old_job != job:
+            release(root, old_job, old_kind)
+    name = _reservation_name(job, kind)
+    tmp_fn = os.path.join(res_dir, '.%s.%d' % (name, pid))
+    with open(tmp_fn, 'w') as fh:
+        fh.write('%s %d %d\n' % (hostname, pid, nbytes))
+    os.rename(tmp_fn, os.path.join(res_dir, name))
+
+
+def score_roots(roots, need_bytes, io_weight=DEFAULT_IO_WEIGHT, interval=0.5):
+    """
+    Return a list of (score, root, free, reserved, io_rate) tuples, best
+    first.  The score is the space left once this job and other in-flight
+    jobs have what they need, discounted by how busy the device is.  Roots
+    without enough room score below all roots with enough room.
+    """
+    rates = io_rates(roots, interval=interval) if len(roots) > 1 else dict((r, 0.0) for r in roots)
+    scored = []
+    for root in roots:
+        free = free_bytes(root)
+        reserved = reserved_bytes(root, exclude_pid=os.getpid())
+        headroom = free - reserved - need_bytes
+        score = headroom / (1.0 + rates[root] / float(io_weight))
+        if headroom < 0:
+            score = -1e18 + free  # fall back to the root with most free space
+        scored.append((score, root, free, reserved, rates[root]))
+    scored.sort(key=lambda x: -x[0])
+    return scored
+
+
+def place(job, roots, need_bytes, kind='temp', io_weight=DEFAULT_IO_WEIGHT, interval=0.5, logger=None):
+    """
+    Choose a root for the job's temp files of the given kind, reserve
+    need_bytes there and return it.
+    """
+    if len(roots) == 0:
+        raise ValueError('No candidate temp roots')
+    scored = score_roots(roots, need_bytes, io_weight=io_weight, interval=interval)
+    for score, root, free, reserved, rate in scored:
+        logger is None or logger('temp root %s: free=%d, reserved=%d, io=%0.1f B/s, score=%0.1f' %
+                                 (root, free, reserved, rate, score))
+    root = scored[0][1]
+    if scored[0][0] < 0:
+        logger is None or logger('no temp root has %d bytes to spare; using %s' % (need_bytes, root))
+    reserve(root, job, need_bytes, kind=kind)
+    return root
+
+
+def dir_bytes(path):
+    """
+    Total size of the files under path; files that vanish mid-walk are
+    skipped
+    """
+    tot = 0
+    for dirpath, _, filenames in os.walk(path):
+        for fn in filenames:
+            try:
+                tot += os.lstat(os.path.join(dirpath, fn)).st_size
+            except OSError:
+                pass
+    return tot
+
+
+class FootprintSampler(threading.Thread):
+    """
+    Periodically measures the given directories (a dictionary from kind,
+    e.g. "temp", to path) and keeps the largest size seen for each.
+    """
+
+    def __init__(self, dirs, interval=60):
+        super(FootprintSampler, self).__init__()
+        self.dirs = dict((k, v) for k, v in dirs.items() if v is not None)
+        self.interval = interval
+        self.peaks = dict((k, 0) for k in self.dirs)
+        self.close_event = threading.Event()
+        self.daemon = True
+
+    def sample(self):
+        for kind, path in self.dirs.items():
+            if os.path.isdir(path):
+                self.peaks[kind] = max(self.peaks[kind], dir_bytes(path))
+
+    def run(self):
+        while not self.close_event.wait(self.interval):
+            self.sample()
+
+    def finish(self):
+        """
+        Take a last sample and return the peaks
+        """
+        self.close_event.set()
+        if self.is_alive():
+            self.join()
+        self.sample()
+        return self.peaks
+
+
+class FootprintModel(object):
+    """
+    Predicts peak bytes of each kind ("temp", "big", "output") for a job.
+    history is a list of (input_bases, temp, big, output) tuples from
+    successful jobs.  Given the job's input bases and enough history with
+    bases, the prediction is a least-squares line plus its largest
+    under-prediction so far.  Otherwise it is a high quantile of what
+    earlier jobs used.  Kinds with no history are predicted as None.
+    """
+
+    KINDS = ['temp', 'big', 'output']
+
+    def __init__(self, history, quantile=0.9, min_points=5):
+        self.history = history
+        self.quantile = quantile
+        self.min_points = min_points
+
+    @staticmethod
+    def fit(xs, ys):
+        """
+        Return (intercept, slope, largest positive residual)
+        """
+        n = float(len(xs))
+        mx, my = sum(xs) / n, sum(ys) / n
+        sxx = sum((x - mx) ** 2 for x in xs)
+        slope = 0.0 if sxx == 0 else sum((x - mx) * (y - my) for x, y in zip(xs, ys)) / sxx
+        intercept = my - slope * mx
+        margin = max(0.0, max(y - (intercept + slope * x) for x, y in zip(xs, ys)))
+        return intercept, slope, margin
+
+    def predict(self, bases=None):
+        pred = {}
+        for i, kind in enumerate(self.KINDS):
+            pts = [(h[0], h[i + 1]) for h in self.history if h[i + 1] is not None]
+            with_bases = [(x, y) for x, y in pts if x is not None]
+            if bases is not None and len(with_bases) >= self.min_points:
+                intercept, slope, margin = self.fit([x for x, _ in with_bases], [y for _, y in with_bases])
+                pred[kind] = int(max(0.0, intercept + slope * bases + margin))
+            elif len(pts) > 0:
+                ys = sorted(y for _, y in pts)
+                rank = int(math.ceil(self.quantile * len(ys))) - 1
+                pred[kind] = ys[max(0, min(rank, len(ys) - 1))]
+            else:
+                pred[kind] = None
+        return pred
+
+
+def available_bytes(roots):
+    """
+    Most bytes any one of the roots can spare after other workers'
+    reservations, or None if none of them exists yet
+    """
+    avail = [free_bytes(root) - reserved_bytes(root, exclude_pid=os.getpid())
+             for root in roots if os.path.isdir(root)]
+    return max(avail) if len(avail) > 0 else None
+
+
+def fits(need, temp_roots, temp_big_roots, output_root):
+    """
+    Check a FootprintModel prediction against the roots.  Without a
+    temp_big root, big temp files share the temp roots.  Returns (True, None)
+    or (False, reason).
+    """
+    checks = [('output', need.get('output') or 0, [output_root])]
+    if temp_big_roots is None:
+        checks.append(('temp', (need.get('temp') or 0) + (need.get('big') or 0), temp_roots))
+    else:
+        checks.append(('temp', need.get('temp') or 0, temp_roots))
+        checks.append(('big', need.get('big') or 0, temp_big_roots))
+    for kind, nbytes, roots in checks:
+        avail = available_bytes(roots)
+        if avail is not None and nbytes > avail:
+            return False, '%s needs %d bytes but at most %d are available' % (kind, nbytes, avail)
+    return True, None
+
+
+def trash_dir(root):
+    return os.path.join(root, TRASH_DIR, socket.gethostname().split('.')[0])
+
+
+def trash(path, logger=None):
+    """
+    Move directory path into its parent's trash area for the reaper to
+    delete later.  If it can't be renamed there (e.g. the trash is on
+    another filesystem), delete it now instead.
+    """
+    if not os.path.exists(path):
+        return
+    dest_dir = trash_dir(os.path.dirname(os.path.abspath(path)))
+    try:
+        if not os.path.exists(dest_dir):
+            try:
+                os.makedirs(dest_dir)
+            except OSError:
+                pass  # another worker made it
+        dest = os.path.join(dest_dir, '%s.%d.%d' % (os.path.basename(path), os.getpid(), int(time.time() * 1000)))
+        os.rename(path, dest)
+        logger is None or logger('moved %s to trash as %s' % (path, dest))
+    except OSError as e:
+        logger is None or logger('could not move %s to trash (%s); removing now' % (path, str(e)))
+        shutil.rmtree(path)
+
+
+def remove_tree(path, errors=None):
+    """
+    Delete path bottom-up, returning the (bytes, files) it held.  Errors
+    don't stop it; each is appended to errors, if given, as (path, message).
+    """
+    def _failed(full, e):
+        if errors is not None:
+            errors.append((full, str(e)))
+
+    nbytes, nfiles = 0, 0
+    for dirpath, dirnames, filenames in os.walk(path, topdown=False):
+        for fn in filenames:
+            full = os.path.join(dirpath, fn)
+            try:
+                nbytes += os.lstat(full).st_size
+                os.remove(full)
+                nfiles += 1
+            except OSError as e:
+                _failed(full, e)
+        for dn in dirnames:
+            full = os.path.join(dirpath, dn)
+            try:
+                if os.path.islink(full):
+                    os.remove(full)
+                else:
+                    os.rmdir(full)
+            except OSError as e:
+                _failed(full, e)
+    try:
+        os.rmdir(path)
+    except OSError as e:
+        _failed(path, e)
+    return nbytes, nfiles
+
+
+def stuck_dir(root):
+    """
+    Where trash entries the reaper gave up on are set aside, so they stop
+    counting toward the backlog
+    """
+    return trash_dir(root) + '.stuck'
+
+
+def backlog(roots):
+    """
+    Return (entries, age of oldest entry in seconds) over this host's trash
+    areas under the given roots
+    """
+    entries, oldest = 0, None
+    now = time.time()
+    for root in roots:
+        tdir = trash_dir(root)
+        if not os.path.isdir(tdir):
+            continue
+        for name in os.listdir(tdir):
+            try:
+                mtime = os.lstat(os.path.join(tdir, name)).st_mtime
+            except OSError:
+                continue
+            entries += 1
+            oldest = max(oldest or 0, now - mtime)
+    return entries, oldest or 0
+
+
+def under_pressure(root, pressure_frac=DEFAULT_PRESSURE_FRAC):
+    st = os.statvfs(root)
+    return st.f_blocks > 0 and st.f_bavail < pressure_frac * st.f_blocks
+
+
+def reap(roots, pause=0.0, pressure_frac=DEFAULT_PRESSURE_FRAC, should_stop=None, logger=None,
+         attempts=None, max_attempts=DEFAULT_REAP_ATTEMPTS, warn=None, gave_up=None):
+    """
+    Delete everything in this host's trash areas under the given roots,
+    oldest first, pausing between entries unless that root's filesystem is
+    short of space.  Returns the (bytes, files) deleted.
+
+    An entry that can't be fully deleted (e.g. root-owned container output)
+    is reported through warn.  attempts, a dictionary kept across calls,
+    counts the passes that failed on each entry; after max_attempts the
+    entry is moved to stuck_dir(root) for someone to clean up by hand and
+    its path is appended to gave_up, if given.
+    """
+    if attempts is None:
+        attempts = {}
+    tot_bytes, tot_files = 0, 0
+    for root in roots:
+        tdir = trash_dir(root)
+        if not os.path.isdir(tdir):
+            continue
+        names = []
+        for name in os.listdir(tdir):
+            try:
+                names.append((os.lstat(os.path.join(tdir, name)).st_mtime, name))
+            except OSError:
+                pass
+        for _, name in sorted(names):
+            if should_stop is not None and should_stop():
+                return tot_bytes, tot_files
+            entry = os.path.join(tdir, name)
+            errors = []
+            nbytes, nfiles = remove_tree(entry, errors=errors)
+            logger is None or logger('reaped %s: %d bytes in %d files' % (name, nbytes, nfiles))
+            tot_bytes += nbytes
+            tot_files += nfiles
+            if len(errors) > 0 and os.path.lexists(entry):
+                attempts[entry] = attempts.get(entry, 0) + 1
+                warn is None or warn('could not remove %d paths under %s (attempt %d of %d), e.g. %s: %s' %
+                                     ((len(errors), entry, attempts[entry], max_attempts) + errors[0]))
+                if attempts[entry] >= max_attempts:
+                    _set_aside(root, entry, warn)
+                    del attempts[entry]
+                    gave_up is None or gave_up.append(entry)
+            else:
+                attempts.pop(entry, None)
+            if pause > 0 and not under_pressure(root, pressure_frac):
+                time.sleep(pause)
+    return tot_bytes, tot_files
+
+
+def _set_aside(root, entry, warn=None):
+    sdir = stuck_dir(root)
+    try:
+        if not os.path.exists(sdir):
+            os.makedirs(sdir)
+        os.rename(entry, os.path.join(sdir, os.path.basename(entry)))
+        warn is None or warn('giving up on %s; moved it to %s' % (entry, sdir))
+    except OSError as e:
+        warn is None or warn('giving up on %s; could not move it to %s: %s' % (entry, sdir, str(e)))
+
+
+def job_roots(cfg, section):
+    """
+    Given a parsed cluster.ini, return (temp roots, temp_big roots or None,
+    output base)
+    """
+    temp_big_roots = None
+    if cfg.has_option(section, 'temp_big_base'):
+        temp_big_roots = parse_roots(cfg.get(section, 'temp_big_base'))
+    return parse_roots(cfg.get(section, 'temp_base')), temp_big_roots, \
+        os.path.expanduser(cfg.get(section, 'output_base'))
+
+
+def cleanup_roots(cfg, section):
+    """
+    Given a parsed cluster.ini, return the roots whose trash areas should be
+    reaped, or None if async_cleanup isn't enabled
+    """
+    if not cfg.has_option(section, 'async_cleanup') or cfg.get(section, 'async_cleanup').lower() != 'true':
+        return None
+    temp_roots, temp_big_roots, output_base = job_roots(cfg, section)
+    roots = [os.path.expanduser(cfg.get(section, 'input_base')), output_base] + temp_roots + (temp_big_roots or [])
+    return sorted(set(roots))
+
+
+class Reaper(multiprocessing.Process):
+    """
+    Background process that empties the trash areas every interval seconds
+    at the lowest CPU and IO priority, reporting the backlog as it goes.
+    Idle IO priority is only honored by some block-layer schedulers and not
+    at all by parallel filesystem metadata servers, so the pause between
+    entries is what keeps the reaper from crowding out running jobs.
+    """
+
+    def __init__(self, roots, log_queue=None, interval=30, pause=0.1, pressure_frac=DEFAULT_PRESSURE_FRAC):
+        super(Reaper, self).__init__()
+        self.roots = roots
+        self.log_queue = log_queue
+        self.interval = interval
+        self.pause = pause
+        self.pressure_frac = pressure_frac
+        self.close_event = multiprocessing.Event()
+        self.daemon = True
+
+    def log(self, msg):
+        if self.log_queue is None:
+            log.info(msg, 'scratch.py')
+        else:
+            self.log_queue.put((msg, 'scratch.py'))
+
+    def warn(self, msg):
+        if self.log_queue is None:
+            log.warning(msg, 'scratch.py')
+        else:
+            self.log_queue.put((msg, 'scratch.py'))
+
+    def _lower_priority(self):
+        try:
+            os.nice(19)
+        except OSError:
+            pass
+        try:
+            psutil.Process().ionice(psutil.IOPRIO_CLASS_IDLE)
+        except (AttributeError, psutil.Error, OSError, ValueError):
+            pass  # not Linux, or not permitted
+
+    def close(self):
+        self.close_event.set()
+
+    def run(self):
+        self._lower_priority()
+        attempts = {}  # trash entry -> passes that failed to delete it
+        while True:
+            entries, oldest = backlog(self.roots)
+            self.log('COUNT_ScratchTrashBacklog %d' % entries)
+            if entries > 0:
+                self.log('trash backlog: %d entries, oldest %0.1f seconds' % (entries, oldest))
+                gave_up = []
+                nbytes, nfiles = reap(self.roots, pause=self.pause, pressure_frac=self.pressure_frac,
+                                      should_stop=self.close_event.is_set, attempts=attempts,
+                                      warn=self.warn, gave_up=gave_up)
+                self.log('COUNT_ScratchReapedBytes %d' % nbytes)
+                self.log('COUNT_ScratchReapedFiles %d' % nfiles)
+                if len(gave_up) > 0:
+                    self.log('COUNT_ScratchReapGaveUp %d' % len(gave_up))
+            if self.close_event.wait(self.interval):
+                break
+
+
+def test_parse_roots():
+    assert ['/a', '/b'] == parse_roots('/a, /b,')
+    assert [os.path.expanduser('~/t')] == parse_roots('~/t')
+
+
+def test_reserve_release():
+    root = tempfile.mkdtemp()
+    reserve(root, 'job1', 1000)
+    reserve(root, 'job1', 2000, kind='big')
+    assert 3000 == reserved_bytes(root)
+    assert 0 == reserved_bytes(root, exclude_pid=os.getpid())
+    # same worker moving on to its next job drops the old reservations
+    reserve(root, 'job2', 500)
+    assert ['job2.temp'] == list(reservations(root).keys())
+    release(root, 'job2')
+    assert 0 == reserved_bytes(root)
+    shutil.rmtree(root)
+
+
+def test_hand_over():
+    root = tempfile.mkdtemp()
+    reserve(root, 'job1', 1000, kind='output')
+    hand_over(root, 'job1', 'output', os.getppid())
+    # the worker's next job leaves the handed-over reservation alone
+    reserve(root, 'job2', 500)
+    assert ['job1.output', 'job2.temp'] == sorted(reservations(root).keys())
+    assert 1000 == reserved_bytes(root, exclude_pid=os.getpid())
+    release(root, 'job1', kind='output')
+    release(root, 'job2')
+    assert 0 == reserved_bytes(root)
+    shutil.rmtree(root)
+
+
+def test_io_rates_sampled_in_background():
+    root = tempfile.mkdtemp()
+    io_rates([root], interval=0.05)
+    t0 = time.time()
+    for _ in range(10):
+        rates = io_rates([root], interval=0.05)
+    assert time.time() - t0 < 0.5
+    assert [root] == list(rates.keys())
+    shutil.rmtree(root)
+
+
+def test_reservation_dead_pid():
+    root = tempfile.mkdtemp()
+    res_dir = os.path.join(root, RESERVATION_DIR)
+    os.makedirs(res_dir)
+    with open(os.path.join(res_dir, 'job1.temp'), 'w') as fh:
+        fh.write('%s %d %d\n' % (socket.gethostname(), 2 ** 22 + 1, 1000))
+    assert 0 == reserved_bytes(root)
+    assert not os.path.exists(os.path.join(res_dir, 'job1.temp'))
+    shutil.rmtree(root)
+
+
+def test_place():
+    root1, root2 = tempfile.mkdtemp(), tempfile.mkdtemp()
+    # another worker's claim on most of root1's space steers us to root2
+    res_dir = os.path.join(root1, RESERVATION_DIR)
+    os.makedirs(res_dir)
+    with open(os.path.join(res_dir, 'other.temp'), 'w') as fh:
+        fh.write('otherhost 1 %d\n' % (free_bytes(root1) // 2))
+    assert root2 == place('job1', [root1, root2], 1000, interval=0.01)
+    assert 1000 == reserved_bytes(root2)
+    shutil.rmtree(root1)
+    shutil.rmtree(root2)
+
+
+def test_trash_and_reap():
+    root = tempfile.mkdtemp()
+    job_dir = os.path.join(root, 'job1')
+    os.makedirs(os.path.join(job_dir, 'sub'))
+    with open(os.path.join(job_dir, 'sub', 'a.txt'), 'w') as fh:
+        fh.write('hello')
+    os.symlink('sub/a.txt', os.path.join(job_dir, 'link'))
+    trash(job_dir)
+    assert not os.path.exists(job_dir)
+    assert 1 == backlog([root])[0]
+    assert (5 + len("sub/a.txt"), 2) == reap([root])  # file and symlink
+    assert (0, 0) == backlog([root])
+    trash(job_dir)  # already gone
+    shutil.rmtree(root)
+
+
+def test_reap_gives_up(monkeypatch):
+    root = tempfile.mkdtemp()
+    job_dir = os.path.join(root, 'job1')
+    os.makedirs(job_dir)
+    for fn in ['a.txt', 'stuck.txt']:
+        with open(os.path.join(job_dir, fn), 'w') as fh:
+            fh.write('hello')
+    trash(job_dir)
+    real_remove = os.remove
+
+    def _remove(path):
+        if path.endswith('stuck.txt'):
+            raise OSError(1, 'Operation not permitted')
+        real_remove(path)
+
+    monkeypatch.setattr(os, 'remove', _remove)
+    attempts, warnings, gave_up = {}, [], []
+    for _ in range(2):
+        reap([root], attempts=attempts, max_attempts=2, warn=warnings.append, gave_up=gave_up)
+    assert 3 == len(warnings)  # two failed passes, then giving up
+    assert 1 == len(gave_up) and {} == attempts
+    assert (0, 0) == backlog([root])
+    assert ['stuck.txt'] == os.listdir(os.path.join(stuck_dir(root), os.path.basename(gave_up[0])))
+    monkeypatch.undo()
+    shutil.rmtree(root)
+
+
+def test_cleanup_roots():
+    cfg = RawConfigParser()
+    cfg.add_section('c')
+    for k, v in [('input_base', '/in'), ('output_base', '/out'), ('temp_base', '/t1,/t2')]:
+        cfg.set('c', k, v)
+    assert cleanup_roots(cfg, 'c') is None
+    cfg.set('c', 'async_cleanup', 'true')
+    assert ['/in', '/out', '/t1', '/t2'] == cleanup_roots(cfg, 'c')
+
+
+def test_footprint_sampler():
+    root = tempfile.mkdtemp()
+    with open(os.path.join(root, 'a'), 'w') as fh:
+        fh.write('x' * 100)
+    sampler = FootprintSampler({'temp': root, 'big': None}, interval=60)
+    sampler.sample()
+    os.remove(os.path.join(root, 'a'))
+    assert {'temp': 100} == sampler.finish()
+    shutil.rmtree(root)
+
+
+def test_footprint_model():
+    history = [(b, 10 * b + 5, None, b) for b in range(1, 7)]
+    history.append((None, 1000, None, 3))
+    model = FootprintModel(history)
+    pred = model.predict(100)
+    assert pred['big'] is None
+    assert 100 == pred['output']
+    assert 1005 <= pred['temp'] < 1300
+    # without bases, a high quantile of everything seen
+    assert {'temp': 1000, 'big': None, 'output': 6} == model.predict()
+    assert {'temp': None, 'big': None, 'output': None} == FootprintModel([]).predict(100)
+
+
+def test_fits():
+    root = tempfile.mkdtemp()
+    free = free_bytes(root)
+    assert fits({'temp': 1000, 'big': None, 'output': 1000}, [root], None, root) == (True, None)
+    ok, reason = fits({'temp': 1000, 'big': free, 'output': 0}, [root], None, root)
+    assert not ok and reason.startswith('temp needs')
+    shutil.rmtree(root)
@@ -0,0 +1,382 @@
+#!/usr/bin/env python
+
+# Author: Ben Langmead <ben.langmead@gmail.com>
+# License: MIT
+
+"""
+staging.py
+
+Put a file at a new path without copying its bytes when we can get away with
+it.  Where the filesystem supports it (btrfs, XFS, ...) we clone the file with
+a reflink, and within a filesystem we can hardlink if the "staging" option in
+cluster.ini asks for it; otherwise we fall back to a copy
+done by the kernel (copy_file_range, which NFS 4.2 and some parallel
+filesystems can even do server-side, or sendfile) rather than a Python
+read/write loop.  Used to stage job inputs, to give output extras their
+per-run names, and for local destinations in the Mover.
+
+Also home to the helpers that compute a file's MD5.  A copy that needs one
+goes through a read/write loop that hashes each buffer on its way to dst,
+so src is read once; the kernel copy is only used when no MD5 is wanted.
+"""
+
+import os
+import sys
+import shutil
+import hashlib
+import tempfile
+
+if sys.version[:1] == '2':
+    from ConfigParser import RawConfigParser
+else:
+    from configparser import RawConfigParser
+
+# From linux/fs.h: _IOW(0x94, 9, int)
+_FICLONE = 0x40049409
+
+STAGING_METHODS = ['link', 'reflink', 'copy']
+
+# A hardlink shares its inode, so anything that writes to either copy in
+# place (or chmods it) changes both; only used when asked for.
+DEFAULT_STAGING_METHODS = ['reflink', 'copy']
+
+
+def same_filesystem(src, dst):
+    """
+    Return True iff src and the directory that will hold dst are on the same
+    device, which is a prerequisite for both hardlinks and reflinks.
+    """
+    dst_dir = os.path.dirname(os.path.abspath(dst))
+    try:
+        return os.stat(src).st_dev == os.stat(dst_dir).st_dev
+    except OSError:
+        return False
+
+
+def reflink(src, dst):
+    """
+    Clone src to dst with the FICLONE ioctl.  Raises OSError if the
+    filesystem (or platform) does not support it; dst is removed in that case.
+    """
+    if not sys.platform.startswith('linux'):
+        raise OSError('reflinks only attempted on Linux')
+    import fcntl
+    with open(src, 'rb') as ifh:
+        with open(dst, 'wb') as ofh:
+            try:
+                fcntl.ioctl(ofh.fileno(), _FICLONE, ifh.fileno())
+            except (IOError, OSError):
+                ofh.close()
+                os.remove(dst)
+                raise
+    shutil.copystat(src, dst)
+
+
+def _kernel_copy(ifd, ofd, nbytes):
+    """
+    Copy nbytes from ifd to ofd with copy_file_range, or sendfile where
+    that isn't available or isn't supported between these files.  Returns
+    False if neither can be used, having copied nothing.
+    """
+    for name in ['copy_file_range', 'sendfile']:
+        func = getattr(os, name, None)
+        if func is None:
+            continue
+        done = 0
+        try:
+            while done < nbytes:
+                if name == 'copy_file_range':
+                    n = func(ifd, ofd, nbytes - done)
+                else:
+                    n = func(ofd, ifd, done, nbytes - done)
+                if n == 0:
+                    break
+                done += n
+        except OSError:
+            if done == 0:
+                continue  # e.g. EXDEV or EINVAL; try the next way
+            raise
+        if done == nbytes:
+            return True
+        if done > 0:
+            raise IOError('%s stopped after %d of %d bytes' % (name, done, nbytes))
+    return False
+
+
+def fast_copy(src, dst):
+    """
+    Copy src to dst with its permissions and times, like shutil.copy2, using
+    the kernel to move the bytes where possible.  Returns the bytes copied.
+    """
+    nbytes = os.path.getsize(src)
+    with open(src, 'rb') as ifh:
+        with open(dst, 'wb') as ofh:
+            if nbytes == 0 or not _kernel_copy(ifh.fileno(), ofh.fileno(), nbytes):
+                shutil.copyfileobj(ifh, ofh, 1024 * 1024)
+    shutil.copystat(src, dst)
+    return nbytes
+
+
+def link_or_copy(src, dst, methods=None):
+    """
+    Make dst have the same contents as src, trying the given methods in order
+    ('reflink', then 'copy' by default).  Returns the name of the
+    method that worked.  A hardlink shares the inode with src, so callers
+    should only ask for one when neither copy will be modified in place.
+    """
+    if methods is None:
+        methods = DEFAULT_STAGING_METHODS
+    if os.path.exists(dst):
+        raise RuntimeError('Staging destination already exists: "%s"' % dst)
+    same_fs = same_filesystem(src, dst)
+    for method in methods:
+        if method == 'link' and same_fs:
+            try:
+                os.link(src, dst)
+                return method
+            except OSError:
+                pass
+        elif method == 'reflink' and same_fs:
+            try:
+                reflink(src, dst)
+                return method
+            except (IOError, OSError):
+                pass
+        elif method == 'copy':
+            fast_copy(src, dst)
+            return method
+    raise RuntimeError('Could not stage "%s" to "%s" using any of %s' % (src, dst, str(methods)))
+
+
+class HashingReader(object):
+    """
+    Wraps a file object open for reading at its start, keeping an MD5 and a
+    byte count of the file's contents as they are read through it.  seek
+    and tell pass through, so it can be handed to an uploader that seeks:
+    bytes read again after a seek back (a retried part) are hashed once,
+    and catch_up reads whatever a seek forward skipped.
+    """
+
+    def __init__(self, fh):
+        self.fh = fh
+        self.hash = hashlib.md5()
+        self.size = 0  # bytes hashed, always a prefix of the file
+        self.pos = 0
+
+    def read(self, size=-1):
+        buf = self.fh.read(size)
+        start, self.pos = self.pos, self.pos + len(buf)
+        if start <= self.size < self.pos:
+            self.hash.update(buf[self.size - start:])
+            self.size = self.pos
+        return buf
+
+    def seek(self, offset, whence=0):
+        self.fh.seek(offset, whence)
+        self.pos = self.fh.tell()
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def catch_up(self, bufsize=1024 * 1024):
+        """
+        Hash the rest of the file, if it wasn't all read in order
+        """
+        self.seek(self.size)
+        while len(self.read(bufsize)) > 0:
+            pass
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+
+def file_digest(fn, bufsize=1024 * 1024):
+    """
+    Return (size, MD5 hex digest) of a file
+    """
+    with open(fn, 'rb') as fh:
+        reader = HashingReader(fh)
+        while len(reader.read(bufsize)) > 0:
+            pass
+    return reader.size, reader.hexdigest()
+
+
+def copy_with_digest(src, dst, bufsize=1024 * 1024):
+    """
+    Copy src to dst like shutil.copy2, returning (size, MD5 hex digest) of
+    src.  The bytes are hashed as they are copied, so src is read once.
+    """
+    with open(src, 'rb') as ifh:
+        reader = HashingReader(ifh)
+        with open(dst, 'wb') as ofh:
+            shutil.copyfileobj(reader, ofh, bufsize)
+    shutil.copystat(src, dst)
+    return reader.size, reader.hexdigest()
+
+
+def link_or_copy_with_digest(src, dst, methods=None):
+    """
+    Like link_or_copy, but also return the (size, MD5 hex digest) of the
+    file.  A copy is hashed as it is made; a link or reflink reads no data,
+    so the file is read once afterwards to hash it.
+    """
+    if methods is None:
+        methods = DEFAULT_STAGING_METHODS
+    non_copy = [m for m in methods if m != 'copy']
+    if len(non_copy) > 0 and same_filesystem(src, dst):
+        try:
+            method = link_or_copy(src, dst, methods=non_copy)
+            return method, file_digest(dst)
+        except RuntimeError:
+            if os.path.exists(dst):
+                raise
+    if 'copy' not in methods:
+        raise RuntimeError('Could not stage "%s" to "%s" using any of %s' % (src, dst, str(methods)))
+    if os.path.exists(dst):
+        raise RuntimeError('Staging destination already exists: "%s"' % dst)
+    return 'copy', copy_with_digest(src, dst)
+
+
+def parse_staging_methods(st):
+    """
+    Parse a comma-separated list of staging methods, as given by the
+    "staging" option in cluster.ini.  'copy' is always the last resort.
+    """
+    methods = [x.strip() for x in st.split(',') if len(x.strip()) > 0]
+    for method in methods:
+        if method not in STAGING_METHODS:
+            raise ValueError('Bad staging method "%s"; must be one of %s' % (method, str(STAGING_METHODS)))
+    if 'copy' not in methods:
+        methods.append('copy')
+    return methods
+
+
+def staging_methods_from_ini(cluster_ini, section=None):
+    """
+    Return the staging methods named by the "staging" option in cluster.ini,
+    or DEFAULT_STAGING_METHODS if it's not set
+    """
+    cfg = RawConfigParser()
+    cfg.read(cluster_ini)
+    if len(cfg.sections()) == 0:
+        return list(DEFAULT_STAGING_METHODS)
+    section = section or cfg.sections()[0]
+    if not cfg.has_option(section, 'staging'):
+        return list(DEFAULT_STAGING_METHODS)
+    return parse_staging_methods(cfg.get(section, 'staging'))
+
+
+def test_link_or_copy_1():
+    tmpdir = tempfile.mkdtemp()
+    src, dst = os.path.join(tmpdir, 'src.txt'), os.path.join(tmpdir, 'dst.txt')
+    with open(src, 'w') as fh:
+        fh.write('hello\n')
+    assert link_or_copy(src, dst) in ['reflink', 'copy']
+    assert not os.path.samefile(src, dst)
+    link = os.path.join(tmpdir, 'link.txt')
+    assert 'link' == link_or_copy(src, link, methods=['link', 'copy'])
+    assert os.path.samefile(src, link)
+    shutil.rmtree(tmpdir)
+
+
+def test_link_or_copy_2():
+    tmpdir = tempfile.mkdtemp()
+    src, dst = os.path.join(tmpdir, 'src.txt'), os.path.join(tmpdir, 'dst.txt')
+    with open(src, 'w') as fh:
+        fh.write('hello\n')
+    assert 'copy' == link_or_copy(src, dst, methods=['copy'])
+    assert not os.path.samefile(src, dst)
+    with open(dst) as fh:
+        assert 'hello\n' == fh.read()
+    try:
+        link_or_copy(src, dst)
+        assert False
+    except RuntimeError:
+        pass
+    shutil.rmtree(tmpdir)
+
+
+def test_link_or_copy_with_digest():
+    import hashlib
+    tmpdir = tempfile.mkdtemp()
+    src = os.path.join(tmpdir, 'src.txt')
+    with open(src, 'w') as fh:
+        fh.write('hello\n')
+    expected = (6, hashlib.md5(b'hello\n').hexdigest())
+    assert expected == file_digest(src)
+    for i, methods in enumerate([['copy'], ['link', 'copy']]):
+        dst = os.path.join(tmpdir, 'dst%d.txt' % i)
+        method, digest = link_or_copy_with_digest(src, dst, methods=methods)
+        assert methods[0] == method
+        assert expected == digest
+    shutil.rmtree(tmpdir)
+
+
+def test_fast_copy():
+    tmpdir = tempfile.mkdtemp()
+    src, dst = os.path.join(tmpdir, 'src.bin'), os.path.join(tmpdir, 'dst.bin')
+    payload = os.urandom(3 * 1024 * 1024 + 17)
+    with open(src, 'wb') as fh:
+        fh.write(payload)
+    os.chmod(src, 0o640)
+    assert len(payload) == fast_copy(src, dst)
+    with open(dst, 'rb') as fh:
+        assert payload == fh.read()
+    assert 0o640 == os.stat(dst).st_mode & 0o777
+    open(src, 'w').close()
+    assert 0 == fast_copy(src, dst)
+    assert 0 == os.path.getsize(dst)
+    shutil.rmtree(tmpdir)
+
+
+def test_copy_with_digest():
+    import hashlib
+    tmpdir = tempfile.mkdtemp()
+    src, dst = os.path.join(tmpdir, 'src.bin'), os.path.join(tmpdir, 'dst.bin')
+    payload = os.urandom(3 * 1024 * 1024 + 17)
+    with open(src, 'wb') as fh:
+        fh.write(payload)
+    os.chmod(src, 0o640)
+    assert (len(payload), hashlib.md5(payload).hexdigest()) == copy_with_digest(src, dst)
+    with open(dst, 'rb') as fh:
+        assert payload == fh.read()
+    assert 0o640 == os.stat(dst).st_mode & 0o777
+    shutil.rmtree(tmpdir)
+
+
+def test_hashing_reader_seeks():
+    import hashlib
+    import io
+    payload = os.urandom(10000)
+    reader = HashingReader(io.BytesIO(payload))
+    assert payload[:4000] == reader.read(4000)
+    reader.seek(2000)  # a retried part
+    assert payload[2000:6000] == reader.read(4000)
+    reader.seek(8000)  # a gap
+    reader.read()
+    assert 6000 == reader.size
+    reader.catch_up()
+    assert (10000, hashlib.md5(payload).hexdigest()) == (reader.size, reader.hexdigest())
+
+
+def test_staging_methods_from_ini():
+    tmpdir = tempfile.mkdtemp()
+    ini = os.path.join(tmpdir, 'cluster.ini')
+    with open(ini, 'w') as fh:
+        fh.write('[cluster]\nname = c\n')
+    assert DEFAULT_STAGING_METHODS == staging_methods_from_ini(ini)
+    with open(ini, 'a') as fh:
+        fh.write('staging = link,reflink\n')
+    assert ['link', 'reflink', 'copy'] == staging_methods_from_ini(ini)
+    shutil.rmtree(tmpdir)
+
+
+def test_parse_staging_methods():
+    assert ['link', 'copy'] == parse_staging_methods('link')
+    assert ['reflink', 'copy'] == parse_staging_methods(' reflink , copy')
+    try:
+        parse_staging_methods('bind')
+        assert False
+    except ValueError:
+        pass
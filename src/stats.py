@@ -8,9 +8,19 @@
 Usage:
   stats summarize <stats-file> [options]
   stats snakefile <snakefile>... [options]
+  stats percentiles [options]
+  stats cost [options]
+  stats regressions <old-version> <new-version> [options]
 
 Options:
   --prefix <path>          Write plot files beginning with <path> [default: recount].
+  --by <fields>            Comma-separated fields to group by, from rule,
+                           node_type, node_name, cluster_name, reference,
+                           workflow_version [default: rule].
+  --project <id>           Only consider jobs from this project.
+  --per-gbase              Normalize runtimes by billions of input bases.
+  --threshold <frac>       Report rules whose median changed by more than
+                           this fraction [default: 0.1].
   --db-ini <ini>           Database ini file [default: ~/.recount/db.ini].
   --db-section <section>   ini file section for database [default: client].
   --log-ini <ini>          ini file for log aggregator [default: ~/.recount/log.ini].
@@ -23,9 +33,76 @@ Options:
 
 import os
 import re
+import math
 import json
+import socket
 import tempfile
+import itertools
+import log
 from docopt import docopt
+from sqlalchemy import Column, ForeignKey, Integer, String, Sequence, DateTime, Float, BigInteger, Boolean, \
+    cast, func
+from base import Base
+import pump  # for the tables referenced by RuleRuntime and JobFootprint
+from toolbox import session_maker_from_config
+
+
+class JobRuntime(Base):
+    """
+    One row per successful job attempt whose rule runtimes were recorded:
+    where and with what it ran.  input_bases is from fastq_check.
+    """
+    __tablename__ = 'job_runtime'
+
+    id = Column(Integer, Sequence('job_runtime_id_seq'), primary_key=True)
+    project_id = Column(Integer, ForeignKey('project.id'))
+    input_id = Column(Integer, ForeignKey('input.id'))
+    attempt_name = Column(String(1024), nullable=False)
+    time = Column(DateTime)
+    input_bases = Column(BigInteger)
+    node_name = Column(String(1024))
+    node_type = Column(String(256))
+    cluster_name = Column(String(256))
+    reference = Column(String(256))
+    workflow_version = Column(String(256))
+
+
+class RuleRuntime(Base):
+    """
+    One row per Snakemake rule per JobRuntime, from the job's stats.json,
+    so rule costs can be compared across the fleet.
+    """
+    __tablename__ = 'rule_runtime'
+
+    id = Column(Integer, Sequence('rule_runtime_id_seq'), primary_key=True)
+    job_runtime_id = Column(Integer, ForeignKey('job_runtime.id'), nullable=False, index=True)
+    rule = Column(String(256), nullable=False)
+    runtime = Column(Float, nullable=False)
+
+
+class JobFootprint(Base):
+    """
+    Peak disk usage of one job attempt's temp, temp_big and output
+    directories, for predicting how much room later jobs will need.
+    Failed attempts are kept too, since they may be all we know about an
+    input's size, but only successful ones are used to fit the model.
+    """
+    __tablename__ = 'job_footprint'
+
+    id = Column(Integer, Sequence('job_footprint_id_seq'), primary_key=True)
+    project_id = Column(Integer, ForeignKey('project.id'))
+    input_id = Column(Integer, ForeignKey('input.id'))
+    attempt_name = Column(String(1024), nullable=False)
+    time = Column(DateTime)
+    succeeded = Column(Boolean)
+    input_bases = Column(BigInteger)
+    temp_bytes = Column(BigInteger)
+    temp_big_bytes = Column(BigInteger)
+    output_bytes = Column(BigInteger)
+    node_name = Column(String(1024))
+
+
+GROUP_FIELDS = ['rule', 'node_type', 'node_name', 'cluster_name', 'reference', 'workflow_version']
 
 
 def to_camel_case(st):
@@ -67,6 +144,216 @@ def summarize(fn):
     return counters
 
 
+def input_bases(output_dir):
+    """
+    Total bases in the job's reads, from the "ALL" rows written by seqtk
+    fqchk in *.fastq_check.tsv, or None if there are none
+    """
+    tot, found = 0, False
+    for fn in os.listdir(output_dir):
+        if not fn.endswith('.fastq_check.tsv'):
+            continue
+        with open(os.path.join(output_dir, fn), 'rt') as fh:
+            for ln in fh:
+                toks = ln.split()
+                if len(toks) > 1 and toks[0] == 'ALL':
+                    tot += int(toks[1])
+                    found = True
+    return tot if found else None
+
+
+def workflow_version(image_url):
+    """
+    The workflow version is the image tag, which build.sh takes from ver.txt
+    """
+    base = image_url.split('/')[-1]
+    if ':' in base:
+        return base.split(':')[-1]
+    for ext in ['.sif', '.simg', '.img']:
+        if base.endswith(ext):
+            base = base[:-len(ext)]
+    m = re.search(r'[-_]v?(\d+(\.\d+)+)$', base)
+    return m.group(1) if m else None
+
+
+def node_type():
+    """
+    Describe this node's hardware well enough to group similar nodes
+    """
+    import psutil
+    model = 'unknown'
+    if os.path.exists('/proc/cpuinfo'):
+        with open('/proc/cpuinfo') as fh:
+            for ln in fh:
+                if ln.startswith('model name'):
+                    model = ln.split(':', 1)[1].strip()
+                    break
+    mem_gb = int(round(psutil.virtual_memory().total / float(1024 ** 3)))
+    return '%dc-%dg-%s' % (psutil.cpu_count(), mem_gb, re.sub(r'\s+', '_', model))
+
+
+def add_rule_runtimes(session, runtimes, time, input_bases=None, project_id=None, input_id=None,
+                      attempt_name='', node_name=None, node_type=None, cluster_name=None,
+                      reference=None, workflow_version=None):
+    """
+    Add a JobRuntime for the attempt and a RuleRuntime for each (rule,
+    seconds) in runtimes, committing them together
+    """
+    job = JobRuntime(project_id=project_id, input_id=input_id, attempt_name=attempt_name,
+                     time=time, input_bases=input_bases, node_name=node_name, node_type=node_type,
+                     cluster_name=cluster_name, reference=reference, workflow_version=workflow_version)
+    session.add(job)
+    session.flush()
+    rows = [RuleRuntime(job_runtime_id=job.id, rule=rule, runtime=secs) for rule, secs in runtimes]
+    session.add_all(rows)
+    session.commit()
+    return len(rows)
+
+
+def add_job_footprint(session, peaks, time, succeeded, input_bases=None, project_id=None,
+                      input_id=None, attempt_name='', node_name=None):
+    """
+    Record a job attempt's peak usage, given as a dictionary with "temp",
+    "big" and "output" byte counts
+    """
+    session.add(JobFootprint(project_id=project_id, input_id=input_id, attempt_name=attempt_name,
+                             time=time, succeeded=succeeded, input_bases=input_bases,
+                             temp_bytes=peaks.get('temp'), temp_big_bytes=peaks.get('big'),
+                             output_bytes=peaks.get('output'), node_name=node_name))
+    session.commit()
+
+
+def footprint_history(session, project_id=None, limit=1000):
+    """
+    Return (input_bases, temp, big, output) tuples for the most recent
+    successful attempts, for scratch.FootprintModel
+    """
+    q = session.query(JobFootprint.input_bases, JobFootprint.temp_bytes,
+                      JobFootprint.temp_big_bytes, JobFootprint.output_bytes)
+    q = q.filter(JobFootprint.succeeded == True)
+    if project_id is not None:
+        q = q.filter(JobFootprint.project_id == project_id)
+    return [tuple(row) for row in q.order_by(JobFootprint.id.desc()).limit(limit)]
+
+
+def known_input_bases(session, input_id):
+    """
+    Bases in an input, if an earlier attempt got far enough to count them
+    """
+    row = session.query(JobFootprint.input_bases)\
+        .filter(JobFootprint.input_id == input_id)\
+        .filter(JobFootprint.input_bases != None)\
+        .order_by(JobFootprint.id.desc()).first()
+    return None if row is None else row[0]
+
+
+def _group_columns(by):
+    for field in by:
+        if field not in GROUP_FIELDS:
+            raise ValueError('Cannot group by "%s"; must be one of %s' % (field, str(GROUP_FIELDS)))
+    return [RuleRuntime.rule if field == 'rule' else getattr(JobRuntime, field) for field in by]
+
+
+def _runtime_value(per_gbase):
+    if per_gbase:
+        return RuleRuntime.runtime * 1e9 / cast(JobRuntime.input_bases, Float)
+    return RuleRuntime.runtime
+
+
+def _runtime_query(session, columns, project_id=None, per_gbase=False, workflow_version=None):
+    """
+    Query the given columns over rule runtimes joined to their jobs, with
+    the filters the reports share
+    """
+    q = session.query(*columns).select_from(RuleRuntime).join(JobRuntime, RuleRuntime.job_runtime_id == JobRuntime.id)
+    if project_id is not None:
+        q = q.filter(JobRuntime.project_id == project_id)
+    if workflow_version is not None:
+        q = q.filter(JobRuntime.workflow_version == workflow_version)
+    if per_gbase:
+        q = q.filter(JobRuntime.input_bases > 0)
+    return q
+
+
+def percentile(sorted_values, pct):
+    """
+    Percentile of an already-sorted list, interpolating between the closest
+    ranks as PostgreSQL's percentile_cont does
+    """
+    assert len(sorted_values) > 0
+    pos = pct / 100.0 * (len(sorted_values) - 1)
+    lo = int(math.floor(pos))
+    hi = min(lo + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (pos - lo)
+
+
+def percentiles(session, by=None, project_id=None, per_gbase=False, pcts=(50, 90, 99), workflow_version=None):
+    """
+    Return rows of (group key, n, percentiles...) ordered by group key.
+    PostgreSQL computes them with percentile_cont; other databases stream
+    each group's runtimes to us in order and we interpolate them here.
+    """
+    cols = _group_columns(by or ['rule'])
+    value = _runtime_value(per_gbase)
+    if session.get_bind().dialect.name == 'postgresql':
+        aggs = [func.count(value)] + [func.percentile_cont(p / 100.0).within_group(value) for p in pcts]
+        q = _runtime_query(session, cols + aggs, project_id=project_id, per_gbase=per_gbase,
+                           workflow_version=workflow_version)
+        return [(tuple(row[:len(cols)]),) + tuple(row[len(cols):])
+                for row in q.group_by(*cols).order_by(*cols)]
+    q = _runtime_query(session, cols + [value], project_id=project_id, per_gbase=per_gbase,
+                       workflow_version=workflow_version)
+    results = []
+    for key, rows in itertools.groupby(q.order_by(*(cols + [value])).yield_per(10000),
+                                       key=lambda row: tuple(row[:-1])):
+        vals = [row[-1] for row in rows]
+        results.append((key, len(vals)) + tuple(percentile(vals, p) for p in pcts))
+    return results
+
+
+def cost(session, by=None, project_id=None):
+    """
+    Return rows of (group key, total seconds, fraction of all seconds),
+    biggest first, to show which rules dominate fleet-wide
+    """
+    cols = _group_columns(by or ['rule'])
+    total = func.sum(RuleRuntime.runtime)
+    q = _runtime_query(session, cols + [total], project_id=project_id)
+    totals = [(tuple(row[:-1]), row[-1]) for row in q.group_by(*cols).order_by(total.desc())]
+    grand = sum(t for _, t in totals) or 1.0
+    return [(key, tot, tot / grand) for key, tot in totals]
+
+
+def regressions(session, old_version, new_version, threshold=0.1, by=None, project_id=None, per_gbase=False):
+    """
+    Compare median runtime per group between two workflow versions.  Return
+    rows of (group key, old median, new median, ratio) for groups whose
+    median changed by more than the threshold fraction, worst first.
+    """
+    meds = []
+    for version in [old_version, new_version]:
+        rows = percentiles(session, by=by, project_id=project_id, per_gbase=per_gbase, pcts=(50,),
+                           workflow_version=version)
+        meds.append(dict((key, med) for key, _, med in rows))
+    results = []
+    for key in set(meds[0].keys()) & set(meds[1].keys()):
+        old, new = meds[0][key], meds[1][key]
+        ratio = new / old if old > 0 else float('inf')
+        if abs(ratio - 1.0) > threshold:
+            results.append((key, old, new, ratio))
+    return sorted(results, key=lambda x: -x[3])
+
+
+def _format_rows(header, rows):
+    lines = ['\t'.join(header)]
+    for row in rows:
+        key, rest = row[0], row[1:]
+        fields = ['/'.join(str(k) for k in key)]
+        fields += [('%0.3f' % x) if isinstance(x, float) else str(x) for x in rest]
+        lines.append('\t'.join(fields))
+    return '\n'.join(lines)
+
+
 def to_counter_updates(counters):
     updates = []
     for counter in counters:
@@ -120,13 +407,113 @@ def test_summarize_1():
     assert 80.8 == counters[1][1]
 
 
+def _add_test_rows(session):
+    import datetime
+    now = datetime.datetime.utcnow()
+    for i in range(10):
+        add_rule_runtimes(session, [('Align', 100.0 + i), ('Sort', 10.0)], now,
+                          input_bases=2 * 10 ** 9, attempt_name='a%d' % i,
+                          reference='hg38', workflow_version='1.0.8')
+        add_rule_runtimes(session, [('Align', 150.0 + i), ('Sort', 10.5)], now,
+                          input_bases=2 * 10 ** 9, attempt_name='b%d' % i,
+                          reference='hg38', workflow_version='1.0.9')
+
+
+def test_input_bases():
+    tmpdir = tempfile.mkdtemp()
+    assert input_bases(tmpdir) is None
+    with open(os.path.join(tmpdir, 'q.fastq_check.tsv'), 'wt') as fh:
+        fh.write('min_len: 76; max_len: 76; avg_len: 76.00; 37 distinct quality values\n')
+        fh.write('POS\t#bases\t%A\t%C\t%G\t%T\t%N\tavgQ\terrQ\t%low\t%high\n')
+        fh.write('ALL\t1000\t25.0\t25.0\t25.0\t25.0\t0.0\t35.0\t30.0\t1.0\t99.0\n')
+        fh.write('1\t10\t25.0\t25.0\t25.0\t25.0\t0.0\t35.0\t30.0\t1.0\t99.0\n')
+        fh.write('ALL\t500\t25.0\t25.0\t25.0\t25.0\t0.0\t35.0\t30.0\t1.0\t99.0\n')
+    assert 1500 == input_bases(tmpdir)
+    import shutil
+    shutil.rmtree(tmpdir)
+
+
+def test_workflow_version():
+    assert '1.0.9' == workflow_version('docker://quay.io/broadsword/recount-pump:1.0.9')
+    assert '1.0.9' == workflow_version('/images/recount-pump-1.0.9.sif')
+    assert workflow_version('docker://quay.io/broadsword/recount-pump') is None
+
+
+def test_percentiles(session):
+    _add_test_rows(session)
+    rows = percentiles(session, by=['rule', 'workflow_version'])
+    assert [('Align', '1.0.8'), ('Align', '1.0.9'), ('Sort', '1.0.8'), ('Sort', '1.0.9')] == [r[0] for r in rows]
+    key, n, p50, p90, p99 = rows[0]
+    assert 10 == n
+    assert abs(104.5 - p50) < 1e-9
+    assert abs(108.1 - p90) < 1e-9
+    rows = percentiles(session, by=['rule'], per_gbase=True)
+    assert ('Sort',) == rows[1][0]
+    assert abs(10.25 / 2 - rows[1][2]) < 1e-9
+    # the job's details are stored once, not per rule
+    assert 20 == session.query(JobRuntime).count()
+    assert 40 == session.query(RuleRuntime).count()
+
+
+def test_percentile():
+    assert 5.0 == percentile([5.0], 90)
+    assert 2.5 == percentile([1.0, 2.0, 3.0, 4.0], 50)
+    assert 4.0 == percentile([1.0, 2.0, 3.0, 4.0], 100)
+
+
+def test_cost_and_regressions(session):
+    _add_test_rows(session)
+    rows = cost(session)
+    assert ('Align',) == rows[0][0]
+    assert abs(1.0 - sum(r[2] for r in rows)) < 1e-9
+    rows = regressions(session, '1.0.8', '1.0.9', threshold=0.1)
+    assert 1 == len(rows)
+    assert ('Align',) == rows[0][0]
+    assert abs(154.5 / 104.5 - rows[0][3]) < 1e-9
+
+
+def test_footprint_history(session):
+    import datetime
+    now = datetime.datetime.utcnow()
+    add_job_footprint(session, {'temp': 100, 'output': 10}, now, True, input_bases=1000, attempt_name='a')
+    add_job_footprint(session, {'temp': 50, 'big': 5, 'output': 1}, now, False, input_bases=2000,
+                      input_id=7, attempt_name='b')
+    assert [(1000, 100, None, 10)] == footprint_history(session)
+    assert 2000 == known_input_bases(session, 7)
+    assert known_input_bases(session, 8) is None
+
+
 def go():
     args = docopt(__doc__)
 
+    def ini_path(argname):
+        path = args[argname]
+        if path.startswith('~/.recount/') and args['--ini-base'] is not None:
+            path = os.path.join(args['--ini-base'], path[len('~/.recount/'):])
+        return os.path.expanduser(path)
+
     if args['summarize']:
         print(to_counter_updates(summarize(args['<stats-file>'])))
     if args['snakefile']:
         print(from_snakefile(args['<snakefile>']))
+    if args['percentiles'] or args['cost'] or args['regressions']:
+        log_ini = ini_path('--log-ini')
+        log.init_logger(log.LOG_GROUP_NAME, log_ini=log_ini, agg_level=args['--log-level'])
+        session = session_maker_from_config(ini_path('--db-ini'), args['--db-section'])()
+        by = args['--by'].split(',')
+        project_id = None if args['--project'] is None else int(args['--project'])
+        if args['percentiles']:
+            print(_format_rows([args['--by'], 'n', 'p50', 'p90', 'p99'],
+                               percentiles(session, by=by, project_id=project_id,
+                                           per_gbase=args['--per-gbase'])))
+        elif args['cost']:
+            print(_format_rows([args['--by'], 'total_secs', 'fraction'],
+                               cost(session, by=by, project_id=project_id)))
+        elif args['regressions']:
+            print(_format_rows([args['--by'], 'old_median', 'new_median', 'ratio'],
+                               regressions(session, args['<old-version>'], args['<new-version>'],
+                                           threshold=float(args['--threshold']), by=by,
+                                           project_id=project_id, per_gbase=args['--per-gbase'])))
 
 
 if __name__ == '__main__':
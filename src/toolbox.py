@@ -3,8 +3,11 @@
 # Author: Ben Langmead <ben.langmead@gmail.com>
 # License: MIT
 
+import io
 import os
 import sys
+import gzip
+import json
 import hashlib
 import subprocess
 from sqlalchemy import create_engine
@@ -19,16 +22,75 @@ else:
 
 
 def openex(fn):
+    """
+    Open a possibly-compressed file for reading text.  .gz is read with the
+    gzip module; .zst/.zstd with the zstandard module if it's installed,
+    otherwise through a zstd -dc child process.
+    """
     if fn.endswith('.gz'):
-        pipe = subprocess.Popen('gzip -dc ' + fn, shell=True, stdout=subprocess.PIPE)
-        return pipe.stdout
+        return gzip.open(fn, 'rt')
     elif fn.endswith('.zstd') or fn.endswith('.zst'):
-        pipe = subprocess.Popen('zstd -dc ' + fn, shell=True, stdout=subprocess.PIPE)
-        return pipe.stdout
+        try:
+            import zstandard
+            reader = zstandard.ZstdDecompressor().stream_reader(open(fn, 'rb'), read_across_frames=True)
+            return io.TextIOWrapper(reader)
+        except ImportError:
+            pipe = subprocess.Popen(['zstd', '-dc', fn], stdout=subprocess.PIPE)
+            return io.TextIOWrapper(pipe.stdout)
     else:
         return open(fn, 'rt')
 
 
+def iter_json_array(fh, read_size=2**20):
+    """
+    Yield the elements of the JSON array making up the file fh, one at a
+    time, reading read_size characters at a time, so memory is bounded by
+    the largest element rather than the file.  Stray commas between
+    elements are skipped.
+    """
+    decoder = json.JSONDecoder()
+    buf, pos, eof = '', 0, False
+
+    def _more():
+        data = fh.read(read_size)
+        return buf[pos:] + data, 0, len(data) == 0
+
+    def _skip(chars):
+        p = pos
+        while p < len(buf) and buf[p] in chars:
+            p += 1
+        return p
+
+    started = False
+    while True:
+        pos = _skip(' \t\r\n' if not started else ' \t\r\n,')
+        if pos == len(buf):
+            if eof:
+                raise ValueError('JSON array ended early')
+            buf, pos, eof = _more()
+            continue
+        if not started:
+            if buf[pos] != '[':
+                raise ValueError('JSON does not start with an array')
+            pos, started = pos + 1, True
+            continue
+        if buf[pos] == ']':
+            return
+        try:
+            obj, end = decoder.raw_decode(buf, pos)
+        except ValueError:
+            if eof:
+                raise
+            buf, pos, eof = _more()
+            continue
+        if end == len(buf) and not eof:
+            # a number or literal cut off by the buffer's end would parse
+            buf, pos, eof = _more()
+            continue
+        pos = end
+        yield obj
+
+
 def generate_file_md5(fn, blocksize=2**20):
     """
     Return md5 checksum of file; based on:
@@ -105,3 +167,45 @@ def which(program):
                 return exe_file
 
     return None
+
+
+def test_iter_json_array():
+    js = '[ {"a": [1, 2]}, 12345, "x]", \n{"b": {"c": null}},, true ]'
+    expected = [{'a': [1, 2]}, 12345, 'x]', {'b': {'c': None}}, True]
+    for read_size in [1, 3, 1000]:
+        assert expected == list(iter_json_array(io.StringIO(js), read_size=read_size))
+    assert [] == list(iter_json_array(io.StringIO(' [ ] ')))
+    for bad in ['{"a": 1}', '[1, 2', '[1, {"a": ]']:
+        try:
+            list(iter_json_array(io.StringIO(bad), read_size=2))
+            assert False, bad
+        except ValueError:
+            pass
+
+
+def test_openex_gzip():
+    import shutil
+    import tempfile
+    tmpdir = tempfile.mkdtemp()
+    fn = os.path.join(tmpdir, 'a.txt.gz')
+    with gzip.open(fn, 'wt') as fh:
+        fh.write('line 1\nline 2\n')
+    with openex(fn) as fh:
+        assert ['line 1\n', 'line 2\n'] == list(fh)
+    shutil.rmtree(tmpdir)
+
+
+def test_openex_zstd():
+    import shutil
+    import tempfile
+    import pytest
+    if which('zstd') is None:
+        pytest.skip('zstd not installed')
+    tmpdir = tempfile.mkdtemp()
+    fn = os.path.join(tmpdir, 'a.txt')
+    with open(fn, 'w') as fh:
+        fh.write('line 1\nline 2\n')
+    subprocess.check_call(['zstd', '-q', fn])
+    with openex(fn + '.zst') as fh:
+        assert ['line 1\n', 'line 2\n'] == list(fh)
+    shutil.rmtree(tmpdir)
@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+
+# Author: Ben Langmead <ben.langmead@gmail.com>
+# License: MIT
+
+"""
+transfers.py
+
+Structured records of the transfers Mover makes.  Every get, put and
+multi-put produces a TransferRecord: operation, backend (local, s3, globus
+or web), endpoint (S3 bucket, Globus endpoint or web host), files, bytes,
+seconds, retries and outcome.  Records go to:
+
+- the Mover's TransferStats, which keeps per (backend, endpoint, operation)
+  histograms of size, duration and throughput until they're reported;
+  run_job logs them at the end of each job,
+- any recorders registered with the Mover, which is how run_job collects a
+  job's transfers and reports them with its counters (job_metrics), and
+- optionally a JSON-lines transfer log, which "mover report" summarizes.
+"""
+
+import os
+import sys
+import json
+import time
+import threading
+from metrics import Metric, JobMetrics
+
+if sys.version[:1] == '2':
+    from ConfigParser import RawConfigParser
+else:
+    from configparser import RawConfigParser
+
+_local = threading.local()
+
+
+class TransferCancelled(RuntimeError):
+    pass
+
+
+def current():
+    """
+    The record of the transfer this thread is making, if any, so that retry
+    loops deep in a backend can count themselves
+    """
+    return getattr(_local, 'record', None)
+
+
+def set_current(rec):
+    _local.record = rec
+
+
+def endpoint_of(url):
+    """
+    Coarse name for where a URL points: the S3 bucket, Globus endpoint or
+    web host, or "local"
+    """
+    if '://' not in url or url.startswith('local://'):
+        return 'local'
+    rest = url.split('://', 1)[1]
+    return rest.split('/', 1)[0] or 'local'
+
+
+class TransferRecord(object):
+
+    def __init__(self, op, backend, endpoint, files=1):
+        self.op = op
+        self.backend = backend
+        self.endpoint = endpoint
+        self.files = files
+        self.nbytes = 0
+        self.secs = 0.0
+        self.wait_secs = 0.0  # spent waiting for a transfer slot, not in secs
+        self.retries = 0
+        self.outcome = None
+        self.start = time.time()
+        self.throttle = None
+        self.cancel = None  # threading.Event set to abandon the transfer
+        self.lock = threading.Lock()
+
+    def add_bytes(self, nbytes):
+        with self.lock:
+            self.nbytes += nbytes
+
+    def progress(self, nbytes):
+        """
+        Count nbytes moved and charge them to throttle, if set; backends
+        call this as bytes arrive or leave.  Raises TransferCancelled once
+        cancel is set, which stops backends that report progress.
+        """
+        if self.cancel is not None and self.cancel.is_set():
+            raise TransferCancelled('%s to %s cancelled after %d bytes' % (self.op, self.endpoint, self.nbytes))
+        self.add_bytes(nbytes)
+        self.throttle is None or self.throttle(nbytes)
+
+    def started(self):
+        """
+        Call once the transfer has its slot and is about to move bytes; the
+        time since the record was made is counted as wait_secs, not secs
+        """
+        now = time.time()
+        self.wait_secs = now - self.start
+        self.start = now
+
+    def retry(self):
+        with self.lock:
+            self.retries += 1
+
+    def finish(self, outcome):
+        self.secs = time.time() - self.start
+        self.outcome = outcome
+
+    def mb_per_sec(self):
+        return self.nbytes / self.secs / (1024 * 1024) if self.secs > 0 else 0.0
+
+    def to_json(self):
+        return json.dumps({'op': self.op, 'backend': self.backend, 'endpoint': self.endpoint,
+                           'files': self.files, 'bytes': self.nbytes, 'secs': round(self.secs, 6),
+                           'wait_secs': round(self.wait_secs, 6), 'retries': self.retries, 'outcome': self.outcome, 'start': self.start},
+                          sort_keys=True)
+
+    @classmethod
+    def from_json(cls, line):
+        d = json.loads(line)
+        rec = cls(d['op'], d['backend'], d['endpoint'], files=d['files'])
+        rec.nbytes, rec.secs, rec.retries = d['bytes'], d['secs'], d['retries']
+        rec.outcome, rec.start = d['outcome'], d['start']
+        rec.wait_secs = d.get('wait_secs', 0.0)  # older logs don't have it
+        return rec
+
+
+class TransferStats(object):
+    """
+    Histograms of transfer size, duration and throughput per (backend,
+    endpoint, operation), plus failure and retry tallies
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.groups = {}
+
+    def add(self, rec):
+        key = (rec.backend, rec.endpoint, rec.op)
+        with self.lock:
+            if key not in self.groups:
+                self.groups[key] = {'bytes': Metric('bytes', 'count'), 'secs': Metric('secs', 'time'),
+                                    'mbps': Metric('mbps', 'rate'), 'files': 0, 'retries': 0, 'failures': 0}
+            group = self.groups[key]
+            group['bytes'].add(rec.nbytes)
+            group['secs'].add(rec.secs)
+            if rec.outcome == 'ok':
+                group['mbps'].add(rec.mb_per_sec())
+            else:
+                group['failures'] += 1
+            group['files'] += rec.files
+            group['retries'] += rec.retries
+
+    def report(self, reset=False):
+        """
+        Return one summary line per (backend, endpoint, operation).  If
+        reset, start afresh, so the next report covers only what follows.
+        """
+        lines = []
+        with self.lock:
+            for key in sorted(self.groups.keys()):
+                group = self.groups[key]
+                nbytes, secs, mbps = group['bytes'], group['secs'], group['mbps']
+                mb = nbytes.total / (1024 * 1024)
+                line = '%s %s %s: n=%d files=%d MB=%0.1f failures=%d retries=%d secs p50<=%0.3f p90<=%0.3f' % \
+                       (key[0], key[1], key[2], nbytes.count, group['files'], mb, group['failures'],
+                        group['retries'], secs.percentile(50), secs.percentile(90))
+                if mbps.count > 0:
+                    line += ' MB/s overall=%0.1f p10<=%0.1f p50<=%0.1f' % \
+                            (mb / secs.total if secs.total > 0 else 0.0, mbps.percentile(10), mbps.percentile(50))
+                lines.append(line)
+            if reset:
+                self.groups = {}
+        return lines
+
+
+def job_metrics(records):
+    """
+    Fold a job's transfer records into a metrics.JobMetrics, named like
+    XferS3PutBytes, so they're reported and stored with its other metrics.
+    Throughput of successful transfers goes in a "rate" metric, XferS3PutMBps.
+    """
+    jm = JobMetrics()
+    for rec in records:
+        prefix = 'Xfer%s%s' % (rec.backend.capitalize(), rec.op.capitalize())
+        jm.add_line('count %sBytes %d' % (prefix, rec.nbytes))
+        jm.add_line('time %sSecs %f' % (prefix, rec.secs))
+        if rec.wait_secs > 0:
+            jm.add_line('time %sWaitSecs %f' % (prefix, rec.wait_secs))
+        if rec.retries > 0:
+            jm.add_line('count %sRetries %d' % (prefix, rec.retries))
+        if rec.outcome != 'ok':
+            jm.add_line('count %sFailures 1' % prefix)
+        elif rec.nbytes > 0 and rec.secs > 0:
+            jm.add('rate', prefix + 'MBps', rec.mb_per_sec())
+    return jm
+
+
+def append_log(log_fn, rec):
+    """
+    Append a record to a JSON-lines transfer log.  Lines are short and
+    written with one O_APPEND write, so processes can share the log.
+    """
+    fd = os.open(log_fn, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, (rec.to_json() + '\n').encode())
+    finally:
+        os.close(fd)
+
+
+def log_from_ini(cluster_ini, section=None):
+    """
+    Return the path of the transfer log named by the transfer_log option in
+    cluster.ini, or None if it's not set
+    """
+    cfg = RawConfigParser()
+    cfg.read(cluster_ini)
+    if len(cfg.sections()) == 0:
+        return None
+    section = section or cfg.sections()[0]
+    if not cfg.has_option(section, 'transfer_log') or len(cfg.get(section, 'transfer_log')) == 0:
+        return None
+    return os.path.expanduser(cfg.get(section, 'transfer_log'))
+
+
+def read_log(log_fn):
+    with open(log_fn) as fh:
+        for line in fh:
+            line = line.strip()
+            if len(line) > 0:
+                yield TransferRecord.from_json(line)
+
+
+def test_record_and_stats():
+    rec = TransferRecord('put', 's3', 'bucket')
+    rec.add_bytes(1024 * 1024)
+    rec.add_bytes(1024 * 1024)
+    rec.retry()
+    rec.finish('ok')
+    rec.secs = 1.0
+    rec2 = TransferRecord.from_json(rec.to_json())
+    assert (2 * 1024 * 1024, 1, 'ok') == (rec2.nbytes, rec2.retries, rec2.outcome)
+    failed = TransferRecord('put', 's3', 'bucket')
+    failed.finish('error')
+    stats = TransferStats()
+    stats.add(rec2)
+    stats.add(failed)
+    lines = stats.report()
+    assert 1 == len(lines)
+    assert lines[0].startswith('s3 bucket put: n=2 files=2 MB=2.0 failures=1 retries=1')
+    assert 'overall=2.0' in lines[0]
+    assert lines == stats.report(reset=True)
+    assert [] == stats.report()
+
+
+def test_cancel():
+    rec = TransferRecord('get', 's3', 'bucket')
+    rec.cancel = threading.Event()
+    rec.progress(10)
+    rec.cancel.set()
+    try:
+        rec.progress(10)
+        assert False
+    except TransferCancelled:
+        pass
+    assert 10 == rec.nbytes
+
+
+def test_job_metrics():
+    rec = TransferRecord('get', 'web', 'example.org')
+    rec.add_bytes(10)
+    rec.finish('error')
+    names = sorted(m.name for m in job_metrics([rec]))
+    assert ['XferWebGetBytes', 'XferWebGetFailures', 'XferWebGetSecs'] == names
+    rec.wait_secs = 2.0
+    assert 'XferWebGetWaitSecs' in [m.name for m in job_metrics([rec])]
+    ok = TransferRecord('put', 's3', 'bucket')
+    ok.add_bytes(4 * 1024 * 1024)
+    ok.finish('ok')
+    ok.secs = 2.0
+    rates = [m for m in job_metrics([ok]) if m.kind == 'rate']
+    assert [('XferS3PutMBps', 2.0)] == [(m.name, m.total) for m in rates]
+
+
+def test_wait_not_counted():
+    rec = TransferRecord('put', 's3', 'bucket')
+    rec.start -= 5.0  # as if the slot took 5 seconds to come free
+    rec.started()
+    rec.finish('ok')
+    assert rec.wait_secs >= 5.0
+    assert rec.secs < 1.0
+    assert round(rec.wait_secs, 6) == TransferRecord.from_json(rec.to_json()).wait_secs
+
+
+def test_endpoint_of():
+    assert 'bucket' == endpoint_of('s3://bucket/a/b')
+    assert 'ep' == endpoint_of('globus://ep/a')
+    assert 'local' == endpoint_of('/tmp/a')
+    assert 'local' == endpoint_of('local:///tmp/a')
+
+
+def test_log_roundtrip():
+    import tempfile
+    import shutil
+    tmpdir = tempfile.mkdtemp()
+    log_fn = os.path.join(tmpdir, 'xfer.jsonl')
+    for op in ['get', 'put']:
+        rec = TransferRecord(op, 'local', 'local')
+        rec.finish('ok')
+        append_log(log_fn, rec)
+    assert ['get', 'put'] == [r.op for r in read_log(log_fn)]
+    ini = os.path.join(tmpdir, 'cluster.ini')
+    with open(ini, 'w') as fh:
+        fh.write('[cluster]\nname = c\n')
+    assert log_from_ini(ini) is None
+    with open(ini, 'a') as fh:
+        fh.write('transfer_log = %s\n' % log_fn)
+    assert log_fn == log_from_ini(ini)
+    shutil.rmtree(tmpdir)
@@ -1,3 +1,8 @@
 #!/bin/sh
 
-python -m pytest -v src/*.py src/*/*.py
+# amover.py uses yield from, which Python 2 can't compile
+if python -c 'import sys; sys.exit(sys.version_info < (3, 4))' ; then
+    python -m pytest -v src/*.py src/*/*.py
+else
+    python -m pytest -v $(ls src/*.py src/*/*.py | grep -v '/amover\.py$')
+fi
@@ -78,6 +78,10 @@ elif [[ -f /Snakefile ]] ; then
             temp_big="${RECOUNT_TEMP_BIG}" \
             2>&1 | tee ${RECOUNT_OUTPUT}/std.out
     popd
+    #report over the out-of-band metrics channel, if the worker provided one
+    if [[ -p "${RECOUNT_METRICS}" ]] ; then
+        echo "time WorkflowWallTime ${SECONDS}" > ${RECOUNT_METRICS}
+    fi
 else
     echo "Could not detect workflow script"
     exit 1